@@ -8,5 +8,11 @@ __version_info__ = tuple([ int(num) for num in __version__.split('.')])
 import ncbi
 import utils
 import package
+import columnar
+import lca
+from cache import LRUCache, StripedLRUCache
 from taxonomy import Taxonomy
+from memory import MemoryTaxonomy
+from snapshot import SnapshotTaxonomy
+from asynchronous import AsyncTaxonomy
 
@@ -0,0 +1,199 @@
+"""
+An interface to a Taxonomy for programs using asyncio (or trollius,
+its Python 2 port). Requires asyncio or trollius and
+concurrent.futures.
+
+Lookups are performed in a bounded pool of threads so that the event
+loop is not blocked. Lineages requested while a lookup of the same
+tax_id is pending share its result (each receiving a copy), and
+tax_ids requested within a short interval are looked up together
+using Taxonomy.lineages.
+
+Example:
+> tax = Taxonomy(engine, Taxonomy.ncbi.ranks, threadsafe=True)
+> atax = AsyncTaxonomy(tax)
+> lineage = yield From(atax.lineage('1280'))  # trollius
+> lineage = await atax.lineage('1280')  # asyncio
+"""
+
+import logging
+
+log = logging
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+# seconds to wait for more requests before looking up a batch
+batch_delay = 0.002
+
+# a batch is looked up as soon as it contains this many tax_ids
+max_batch = 500
+
+class AsyncTaxonomy(object):
+
+    def __init__(self, taxonomy, loop=None, max_workers=4,
+                 batch_delay=batch_delay, max_batch=max_batch):
+        """
+        Provides methods of taxonomy returning futures.
+
+        * taxonomy - a Taxonomy (or MemoryTaxonomy, etc); must have
+          been created with threadsafe=True if max_workers > 1.
+        * loop - the event loop; the default is the current one.
+        * max_workers - the number of threads performing lookups.
+        * batch_delay - seconds to wait after a lineage is requested
+          for further requests to look up in the same batch.
+        * max_batch - the maximum number of tax_ids in a batch.
+        """
+
+        if asyncio is None or ThreadPoolExecutor is None:
+            raise ImportError('AsyncTaxonomy requires asyncio (or trollius) and concurrent.futures')
+
+        if max_workers > 1 and not getattr(taxonomy, 'threadsafe', False):
+            raise ValueError('a Taxonomy used by more than one worker must be '
+                             'created with threadsafe=True')
+
+        self.taxonomy = taxonomy
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+
+        # keys: tax_id, vals: future of its lineage shared by the
+        # requests for tax_id (see lineage); contains the tax_ids of
+        # self._batch and of batches being looked up
+        self._pending = {}
+        self._batch = []
+        self._timer = None
+
+    def lineage(self, tax_id):
+        """
+        Returns a future of the lineage of tax_id (see
+        Taxonomy.lineage), which raises KeyError if tax_id is not
+        found. Each call returns a separate future, so cancelling one
+        (eg, following a timeout) does not affect other requests for
+        the same tax_id, and a separate copy of the lineage, so that
+        modifying one does not affect the others.
+        """
+
+        future = self._pending.get(tax_id)
+        if future is None:
+            future = self._pending[tax_id] = asyncio.Future(loop=self.loop)
+            self._batch.append(tax_id)
+
+            if len(self._batch) >= self.max_batch:
+                self.flush()
+            elif self._timer is None:
+                self._timer = self.loop.call_later(self.batch_delay, self.flush)
+
+        output = asyncio.Future(loop=self.loop)
+
+        def copy(future):
+            if output.done():
+                # cancelled
+                return
+            if future.cancelled():
+                output.cancel()
+            elif future.exception() is not None:
+                output.set_exception(future.exception())
+            else:
+                output.set_result(dict(future.result()))
+
+        future.add_done_callback(copy)
+        return output
+
+    def lineages(self, tax_ids):
+        """
+        Returns a future of a list of the lineages of tax_ids.
+        """
+
+        futures = [self.lineage(tax_id) for tax_id in tax_ids]
+        if not futures:
+            future = asyncio.Future(loop=self.loop)
+            future.set_result([])
+            return future
+        return asyncio.gather(*futures)
+
+    def call(self, name, *args, **kwargs):
+        """
+        Returns a future of the result of the method of the taxonomy
+        called name (eg, "primary_from_name") with the arguments
+        provided. These calls are not combined.
+        """
+
+        method = getattr(self.taxonomy, name)
+        return self.loop.run_in_executor(self.executor, lambda: method(*args, **kwargs))
+
+    def flush(self):
+        """
+        Starts the lookup of the lineages requested since the last
+        batch.
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        log.debug('looking up a batch of %s lineages' % len(batch))
+        done = self.loop.run_in_executor(self.executor, self._lookup, batch)
+        done.add_done_callback(lambda done: self._deliver(batch, done))
+
+    def _lookup(self, batch):
+        """
+        Returns a list of (lineage, exception) for each tax_id in
+        batch. Runs in a worker thread.
+        """
+
+        try:
+            return [(lineage, None) for lineage in self.taxonomy.lineages(batch)]
+        except KeyError:
+            # find the tax_ids that are missing
+            output = []
+            for tax_id in batch:
+                try:
+                    output.append((self.taxonomy.lineage(tax_id), None))
+                except KeyError, err:
+                    output.append((None, err))
+            return output
+
+    def _deliver(self, batch, done):
+        """
+        Sets the results of the futures of the tax_ids in batch.
+        """
+
+        if done.cancelled() or done.exception() is not None:
+            results = [(None, done.exception() if not done.cancelled() else
+                        asyncio.CancelledError())] * len(batch)
+        else:
+            results = done.result()
+
+        for tax_id, (lineage, err) in zip(batch, results):
+            future = self._pending.pop(tax_id)
+            if future.done():
+                continue
+            if err is None:
+                future.set_result(lineage)
+            else:
+                future.set_exception(err)
+
+    def close(self, wait=True):
+        """
+        Looks up any requested lineages and shuts down the worker
+        threads.
+        """
+
+        self.flush()
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,226 @@
+"""
+Caches used by the Taxonomy class.
+"""
+
+import collections
+import threading
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=None, weight=None):
+        """
+        A dict-like object that discards the least recently used
+        entries when the total size of its contents exceeds maxsize,
+        and counts cache hits, misses and evictions.
+
+        * maxsize - maximum total size of the entries, or None for
+          an unbounded cache.
+        * weight - function returning the size of a value; if None,
+          each entry has size 1 (ie, maxsize is the maximum number of
+          entries). For example, use weight=len to limit the total
+          length of the cached lineages.
+
+        Lookups using get() and [] are counted as hits or misses;
+        membership tests ("key in cache") are not counted and do not
+        affect the order of eviction.
+        """
+
+        self.maxsize = maxsize
+        self.weight = weight
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+        # the order of entries is only maintained if it will be used
+        self._data = collections.OrderedDict() if maxsize is not None else {}
+
+    def _weight(self, value):
+        return self.weight(value) if self.weight else 1
+
+    def _touch(self, key, value):
+        if self.maxsize is not None:
+            # move key to the most recently used position
+            del self._data[key]
+            self._data[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        self.hits += 1
+        self._touch(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self.size -= self._weight(self._data.pop(key))
+
+        self._data[key] = value
+        self.size += self._weight(value)
+
+        # evict least recently used entries, but never the newest one
+        if self.maxsize is not None:
+            while self.size > self.maxsize and len(self._data) > 1:
+                old_key, old_value = self._data.popitem(last=False)
+                self.size -= self._weight(old_value)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        self.size -= self._weight(self._data.pop(key))
+
+    def pop(self, key, *default):
+        if key in self._data:
+            value = self._data[key]
+            del self[key]
+            return value
+        return self._data.pop(key, *default)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+        Returns a dict describing the use of the cache.
+        """
+
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self._data), size=self.size, maxsize=self.maxsize)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+                '%s=%s' % item for item in sorted(self.stats().items())))
+
+class StripedLRUCache(object):
+
+    def __init__(self, maxsize=None, weight=None, stripes=16):
+        """
+        A thread-safe version of LRUCache. Entries are divided by the
+        hash of their key among a number of LRUCaches ("stripes"),
+        each guarded by its own lock, so that threads using different
+        keys rarely wait for one another.
+
+        * maxsize, weight - see LRUCache; maxsize is divided evenly
+          among the stripes, and entries are evicted from each stripe
+          independently.
+        * stripes - the number of stripes.
+
+        Iteration, keys(), values() and items() return a snapshot of
+        each stripe in turn rather than of the whole cache.
+        """
+
+        self.maxsize = maxsize
+        self.weight = weight
+        stripe_size = None if maxsize is None else max(1, maxsize // stripes)
+        self._stripes = [LRUCache(stripe_size, weight) for i in xrange(stripes)]
+        self._locks = [threading.Lock() for i in xrange(stripes)]
+
+    def _stripe(self, key):
+        i = hash(key) % len(self._stripes)
+        return self._stripes[i], self._locks[i]
+
+    def get(self, key, default=None):
+        stripe, lock = self._stripe(key)
+        with lock:
+            return stripe.get(key, default)
+
+    def __getitem__(self, key):
+        stripe, lock = self._stripe(key)
+        with lock:
+            return stripe[key]
+
+    def __setitem__(self, key, value):
+        stripe, lock = self._stripe(key)
+        with lock:
+            stripe[key] = value
+
+    def __delitem__(self, key):
+        stripe, lock = self._stripe(key)
+        with lock:
+            del stripe[key]
+
+    def pop(self, key, *default):
+        stripe, lock = self._stripe(key)
+        with lock:
+            return stripe.pop(key, *default)
+
+    def __contains__(self, key):
+        stripe, lock = self._stripe(key)
+        with lock:
+            return key in stripe
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self._stripes)
+
+    def _each(self, method):
+        output = []
+        for stripe, lock in zip(self._stripes, self._locks):
+            with lock:
+                output.extend(getattr(stripe, method)())
+        return output
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self._each('keys')
+
+    def values(self):
+        return self._each('values')
+
+    def items(self):
+        return self._each('items')
+
+    def clear(self):
+        for stripe, lock in zip(self._stripes, self._locks):
+            with lock:
+                stripe.clear()
+
+    def stats(self):
+        """
+        Returns a dict describing the use of the cache (see
+        LRUCache.stats), summed over the stripes.
+        """
+
+        output = dict(hits=0, misses=0, evictions=0, entries=0, size=0)
+        for stripe in self._stripes:
+            for key, value in stripe.stats().items():
+                if key in output:
+                    output[key] += value
+        output['maxsize'] = self.maxsize
+        return output
+
+    hits = property(lambda self: self.stats()['hits'])
+    misses = property(lambda self: self.stats()['misses'])
+    evictions = property(lambda self: self.stats()['evictions'])
+    size = property(lambda self: self.stats()['size'])
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+                '%s=%s' % item for item in sorted(self.stats().items())))
@@ -0,0 +1,232 @@
+"""
+A binary columnar format for the lineage table produced by
+Taxonomy.write_table and Taxonomy.export_all.
+
+A table is a directory containing one file per column in NumPy's
+documented .npy format (version 1.0), which can be written without
+numpy and loaded by numpy (or pandas) without copying using
+numpy.load(fname, mmap_mode='r'), and a file "manifest.json"
+describing the table:
+
+* tax_id.npy, parent_id.npy - int64 tax_ids
+* rank.npy - uint16 code of the rank of each row; the rank with code
+  i is manifest["ranks"][i]
+* one int64 column "<rank>.npy" for each rank in manifest["ranks"]
+  containing the tax_id of the ancestor at that rank, or -1
+* tax_name_offsets.npy, tax_name_bytes.npy - the utf-8 encoded
+  tax_name of row i is tax_name_bytes[offsets[i]:offsets[i+1]] (an
+  empty string if the taxon has no name)
+
+tax_ids that are not integers (for example, those of nodes added
+using Taxonomy.add_node) are represented by the value -2 - k, where k
+is the position of the tax_id in manifest["tax_id_strings"].
+
+The manifest is written last, so a directory without one does not
+contain a complete table.
+"""
+
+import json
+import logging
+import os
+import struct
+
+log = logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+format_name = 'taxonomy-columnar'
+version = 1
+
+manifest_name = 'manifest.json'
+
+# value of tax_id columns for ranks not represented in a lineage
+missing = -1
+
+# each .npy header (including the magic string) is padded to this
+# length so that it can be rewritten once the number of rows is known
+_header_size = 128
+
+class _NpyFile(object):
+    """
+    A one-dimensional .npy file written incrementally.
+    """
+
+    def __init__(self, fname, descr, bufsize=65536):
+        self.fname, self.descr, self.bufsize = fname, descr, bufsize
+        self.item = descr[-2:]
+        self.count = 0
+        self.buffer = []
+        self.fobj = open(fname, 'wb')
+        self.fobj.write(self._header())
+
+    def _header(self):
+        header = "{'descr': '%s', 'fortran_order': False, 'shape': (%s,), }" % \
+            (self.descr, self.count)
+        header = header.ljust(_header_size - 10 - 1) + '\n'
+        return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+    def write(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        fmt = {'i8': 'q', 'u2': 'H'}[self.item]
+        self.fobj.write(struct.pack('<%s%s' % (len(self.buffer), fmt), *self.buffer))
+        self.count += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.fobj.seek(0)
+        self.fobj.write(self._header())
+        self.fobj.close()
+
+class _NpyBytes(_NpyFile):
+    """
+    A .npy file of unsigned bytes written incrementally from strings.
+    """
+
+    def __init__(self, fname):
+        _NpyFile.__init__(self, fname, '|u1')
+
+    def write(self, value):
+        self.fobj.write(value)
+        self.count += len(value)
+
+    def flush(self):
+        pass
+
+class ColumnarWriter(object):
+
+    def __init__(self, dirname, fields):
+        """
+        Writes rows (dicts like those returned by Taxonomy.lineage)
+        to a table in directory dirname, which is created if
+        necessary. fields is a list of column names as used for csv
+        output: "tax_id", "parent_id", "rank", "tax_name" followed by
+        the ranks. close() must be called once all rows are written.
+        """
+
+        self.dirname = dirname
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.ranks = [field for field in fields
+                      if field not in ('tax_id', 'parent_id', 'rank', 'tax_name')]
+        self.rank_codes = dict((rank, i) for i, rank in enumerate(self.ranks))
+        self.rank_names = list(self.ranks)
+
+        self.tax_id_strings = []
+        self.tax_id_codes = {}
+
+        self.rows = 0
+        self.name_offset = 0
+
+        def npy(name, descr):
+            return _NpyFile(os.path.join(dirname, name + '.npy'), descr)
+
+        self.columns = [(name, npy(name, '<i8')) for name in ['tax_id', 'parent_id'] + self.ranks]
+        self.rank = npy('rank', '<u2')
+        self.name_offsets = npy('tax_name_offsets', '<i8')
+        self.name_bytes = _NpyBytes(os.path.join(dirname, 'tax_name_bytes.npy'))
+        self.name_offsets.write(0)
+
+    def _id(self, tax_id):
+        """
+        Returns the integer representing tax_id.
+        """
+
+        if tax_id is None or tax_id == '':
+            return missing
+
+        try:
+            return int(tax_id)
+        except ValueError:
+            code = self.tax_id_codes.get(tax_id)
+            if code is None:
+                code = self.tax_id_codes[tax_id] = -2 - len(self.tax_id_strings)
+                self.tax_id_strings.append(tax_id)
+            return code
+
+    def writerow(self, row):
+        for name, column in self.columns:
+            column.write(self._id(row.get(name)))
+
+        rank = row['rank']
+        code = self.rank_codes.get(rank)
+        if code is None:
+            code = self.rank_codes[rank] = len(self.rank_names)
+            self.rank_names.append(rank)
+        self.rank.write(code)
+
+        tax_name = row.get('tax_name') or ''
+        if isinstance(tax_name, unicode):
+            tax_name = tax_name.encode('utf-8')
+        self.name_bytes.write(tax_name)
+        self.name_offset += len(tax_name)
+        self.name_offsets.write(self.name_offset)
+
+        self.rows += 1
+
+    def close(self):
+        """
+        Completes the column files and writes the manifest.
+        """
+
+        for name, column in self.columns:
+            column.close()
+        for column in [self.rank, self.name_offsets, self.name_bytes]:
+            column.close()
+
+        manifest = {
+            'format': format_name,
+            'version': version,
+            'rows': self.rows,
+            'columns': ['tax_id', 'parent_id', 'rank', 'tax_name'] + self.ranks,
+            'ranks': self.rank_names,
+            'tax_id_strings': self.tax_id_strings,
+            }
+
+        with open(os.path.join(self.dirname, manifest_name), 'w') as fobj:
+            json.dump(manifest, fobj, indent=1)
+
+        log.info('wrote %s rows to %s' % (self.rows, self.dirname))
+
+def read_manifest(dirname):
+    """
+    Returns the manifest of the table in dirname as a dict.
+    """
+
+    with open(os.path.join(dirname, manifest_name)) as fobj:
+        manifest = json.load(fobj)
+
+    if manifest.get('format') != format_name:
+        raise ValueError('%s does not contain a columnar lineage table' % dirname)
+    if manifest.get('version') != version:
+        raise ValueError('%s has unsupported version %s' % (dirname, manifest.get('version')))
+
+    return manifest
+
+def read_table(dirname, mmap_mode='r'):
+    """
+    Returns (manifest, columns), where columns is a dict of {name:
+    numpy array} for each .npy file in the table in dirname (see
+    above). With the default mmap_mode, the arrays are memory-mapped
+    rather than read. Requires numpy.
+    """
+
+    if numpy is None:
+        raise ImportError('reading a columnar table requires numpy')
+
+    manifest = read_manifest(dirname)
+
+    names = ['tax_id', 'parent_id', 'rank'] + manifest['columns'][4:] + \
+        ['tax_name_offsets', 'tax_name_bytes']
+    columns = dict((name, numpy.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode))
+                   for name in names)
+
+    return manifest, columns
@@ -0,0 +1,242 @@
+"""
+An index supporting lowest common ancestor (LCA) queries by binary
+lifting, and its file format.
+
+Nodes are identified by their position in an array of parents (the
+root is its own parent; see Taxonomy._node_arrays). The index holds
+the depth of each node and, for k = 0, 1, ..., the position of each
+node's ancestor 2**k levels up (or the root). The LCA of two nodes is
+found in O(log(depth)) steps by raising the deeper node to the depth
+of the other and then raising both nodes together by decreasing
+powers of two while their ancestors differ.
+
+File format (all integers little-endian): magic string 'TAXLCA\\0\\0',
+format version (uint32), number of nodes (uint32), number of levels
+(uint32), a key (float64 and uint64; see LcaIndex.save), a checksum of
+the nodes (uint32; see checksum) followed by the depths and then each
+level as arrays of int32.
+"""
+
+import array
+import logging
+import os
+import struct
+import sys
+import tempfile
+import zlib
+
+log = logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+magic = 'TAXLCA\x00\x00'
+version = 2
+
+_header = struct.Struct('<8sIIIdQI')
+
+def _read_array(fobj, count):
+    a = array.array('i')
+    a.fromfile(fobj, count)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+def _int32(values):
+    """
+    Returns the bytes of the sequence of integers values as
+    little-endian int32.
+    """
+
+    a = array.array('i', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tostring()
+
+def checksum(ids, parents):
+    """
+    Returns a checksum (a 32-bit unsigned integer) of the nodes
+    described by the list of tax_ids ids and the array of parents
+    (see LcaIndex.build), so that an index is not used with nodes
+    that were read in a different order.
+    """
+
+    ids = '\x00'.join(tax_id.encode('utf-8') if isinstance(tax_id, unicode) else tax_id
+                      for tax_id in ids)
+    return zlib.crc32(ids, zlib.crc32(_int32(parents))) & 0xffffffff
+
+class LcaIndex(object):
+
+    def __init__(self, depths, levels):
+        """
+        An LCA index; use LcaIndex.build or LcaIndex.load to create
+        one.
+
+        * depths - array of the depth of each node (0 for the root)
+        * levels - list of arrays; levels[k][i] is the position of
+          the ancestor of node i 2**k levels up, or of the root
+        """
+
+        self.depths = depths
+        self.levels = levels
+
+    @classmethod
+    def build(cls, parents, order):
+        """
+        Returns an index of the nodes described by the array parents,
+        where order lists the nodes with parents before children
+        (see Taxonomy._depth_first).
+        """
+
+        n = len(parents)
+        depths = array.array('i', [0]) * n
+        for i in order:
+            parent = parents[i]
+            if parent != i:
+                depths[i] = depths[parent] + 1
+
+        height = max(depths) if n else 0
+        levels = [array.array('i', parents)]
+        while (1 << len(levels)) <= height:
+            up = levels[-1]
+            if numpy is not None:
+                a = numpy.frombuffer(up, dtype=numpy.int32)
+                levels.append(array.array('i', a[a].tostring()))
+            else:
+                levels.append(array.array('i', (up[j] for j in up)))
+
+        log.info('built lca index of %s nodes with %s levels' % (n, len(levels)))
+        return cls(depths, levels)
+
+    @classmethod
+    def load(cls, fname, key, crc):
+        """
+        Returns the index saved in fname, or None if the file does
+        not exist, is truncated, or was saved with a different key
+        or checksum (see save).
+        """
+
+        if not os.path.isfile(fname):
+            return None
+
+        with open(fname, 'rb') as fobj:
+            header = fobj.read(_header.size)
+            if len(header) != _header.size:
+                return None
+            _magic, _version, n, nlevels, mtime, size, _crc = _header.unpack(header)
+            if (_magic != magic or _version != version or
+                (mtime, size) != tuple(key) or _crc != crc):
+                log.info('%s is out of date' % fname)
+                return None
+            try:
+                depths = _read_array(fobj, n)
+                levels = [_read_array(fobj, n) for k in xrange(nlevels)]
+            except EOFError:
+                log.warning('%s is truncated' % fname)
+                return None
+
+        log.info('read lca index from %s' % fname)
+        return cls(depths, levels)
+
+    def save(self, fname, key, crc):
+        """
+        Writes the index to fname. key is a pair of numbers (a
+        float and a non-negative integer) identifying the state of
+        the nodes from which the index was built (for example, the
+        modification time and size of the database), and crc is the
+        checksum of the nodes (see checksum); load returns None
+        unless it is provided the same key and checksum. The index
+        is written to a temporary file that then replaces fname, so
+        that threads or processes loading the index never read a
+        partially written file.
+        """
+
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+                                       prefix=os.path.basename(fname))
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                mtime, size = key
+                fobj.write(_header.pack(magic, version, len(self.depths), len(self.levels),
+                                        mtime, size, crc))
+                for a in [self.depths] + self.levels:
+                    if sys.byteorder != 'little':
+                        a = array.array('i', a)
+                        a.byteswap()
+                    a.tofile(fobj)
+            # mkstemp creates files readable only by their owner
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, fname)
+        except:
+            os.remove(tmpname)
+            raise
+
+    def __len__(self):
+        return len(self.depths)
+
+    def lca(self, i, j):
+        """
+        Returns the position of the lowest common ancestor of nodes i
+        and j, or -1 if they are in different trees.
+        """
+
+        depths, levels = self.depths, self.levels
+
+        if depths[i] < depths[j]:
+            i, j = j, i
+
+        diff, k = depths[i] - depths[j], 0
+        while diff:
+            if diff & 1:
+                i = levels[k][i]
+            diff >>= 1
+            k += 1
+
+        if i == j:
+            return i
+
+        for up in reversed(levels):
+            if up[i] != up[j]:
+                i, j = up[i], up[j]
+
+        return levels[0][i] if levels[0][i] == levels[0][j] else -1
+
+    def lca_all(self, nodes):
+        """
+        Returns the position of the lowest common ancestor of all of
+        the positions in the sequence nodes, or -1.
+        """
+
+        nodes = iter(nodes)
+        i = next(nodes)
+        for j in nodes:
+            if i < 0:
+                break
+            i = self.lca(i, j)
+        return i
+
+    def lca_arrays(self, i, j):
+        """
+        Returns a numpy array containing the lowest common ancestor
+        of each pair of nodes in the numpy arrays i and j (or -1).
+        Requires numpy.
+        """
+
+        depths = numpy.frombuffer(self.depths, dtype=numpy.int32)
+        levels = [numpy.frombuffer(up, dtype=numpy.int32) for up in self.levels]
+
+        swap = depths[i] < depths[j]
+        i, j = numpy.where(swap, j, i), numpy.where(swap, i, j)
+
+        diff = depths[i] - depths[j]
+        for k, up in enumerate(levels):
+            i = numpy.where((diff >> k) & 1, up[i], i)
+
+        for up in reversed(levels):
+            a, b = up[i], up[j]
+            differ = a != b
+            i, j = numpy.where(differ, a, i), numpy.where(differ, b, j)
+
+        parent_i, parent_j = levels[0][i], levels[0][j]
+        return numpy.where(i == j, i, numpy.where(parent_i == parent_j, parent_i, -1))
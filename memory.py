@@ -0,0 +1,565 @@
+"""
+An implementation of Taxonomy that holds the nodes of the taxonomy in
+memory as compact arrays.
+"""
+
+import array
+import logging
+import os
+
+log = logging
+
+from sqlalchemy.sql import select
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from taxonomy import Taxonomy
+from lca import LcaIndex, checksum
+
+def _as_numpy(values, dtype):
+    """
+    Returns the sequence of integers values (an array.array or an
+    object supporting len and iteration) as a new numpy array.
+    """
+
+    if isinstance(values, array.array):
+        return numpy.frombuffer(values, dtype=values.typecode).astype(dtype)
+    return numpy.fromiter(values, dtype, len(values))
+
+class MemoryTaxonomy(Taxonomy):
+
+    def __init__(self, engine, ranks, undefined_rank='no_rank', undef_prefix='below',
+                 cache=None, name_cache_size=None, threadsafe=False, track_requested=None):
+        """
+        Provides the same interface as Taxonomy, but loads table
+        "nodes", the primary names and table "merged" into memory
+        when the object is created, after which node and lineage
+        lookups (_node, primary_from_id, _fetch_lineage, lineage,
+        tree_lineage) do not query the database. Lookups by name
+        (primary_from_name, synonyms) still use the database.
+
+        Nodes are identified internally by an integer index; the
+        parent and rank of each node and the offset of its name in a
+        single string of names are stored in arrays:
+
+        * self._ids - list of tax_ids, by index
+        * self._index - dict of {tax_id: index}
+        * self._parents - array of the index of each node's parent
+          (the root is its own parent)
+        * self._rank_codes - array of the index of each node's rank
+          in self._rank_names
+        * self._name_offsets, self._name_heap - the primary name of
+          node i is self._name_heap[offsets[i]:offsets[i+1]] (utf-8);
+          the heap is a bytearray, so that names of added nodes are
+          appended in place
+        * self._merged - dict of {old_tax_id: new_tax_id}
+
+        See Taxonomy for a description of the arguments.
+        """
+
+        Taxonomy.__init__(self, engine, ranks, undefined_rank=undefined_rank,
+                          undef_prefix=undef_prefix, cache=cache,
+                          name_cache_size=name_cache_size, threadsafe=threadsafe,
+                          track_requested=track_requested)
+        self._load()
+        self._reset_derived()
+
+        # table "merged" is always in memory
+        self.preload_merged = True
+
+    def _load(self):
+        """
+        Read nodes, primary names and merged tax_ids from the database.
+        """
+
+        merged = self.merged
+        api_id = self._api_id
+
+        # the modification time and size of the database when it is
+        # read (see _lca_file)
+        url = self.engine.url
+        if url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:'):
+            stat = os.stat(url.database)
+            self._source_key = stat.st_mtime, stat.st_size
+        else:
+            self._source_key = None
+
+        (self._ids, self._parents, self._rank_names, self._rank_codes,
+         name) = Taxonomy._node_arrays(self)
+        self._index = dict((tax_id, i) for i, tax_id in enumerate(self._ids))
+
+        primary = [name(i) for i in xrange(len(self._ids))]
+        primary = [None if tax_name is None else tax_name.encode('utf-8')
+                   for tax_name in primary]
+
+        offsets = array.array('L', [0])
+        for tax_name in primary:
+            offsets.append(offsets[-1] + len(tax_name or ''))
+        self._name_offsets = offsets
+        self._name_heap = bytearray().join(tax_name or '' for tax_name in primary)
+        self._has_name = array.array('B', (tax_name is not None for tax_name in primary))
+        del primary
+
+        s = select([merged.c.old_tax_id, merged.c.new_tax_id])
+        self._merged = dict((api_id(old), api_id(new)) for old, new in s.execute())
+
+    def _reset_derived(self):
+        """
+        Discards the arrays derived from the nodes by at_rank and lca.
+        """
+
+        # keys: rank, vals: array (see _rank_table)
+        self._rank_tables = {}
+        # (rank_names, rank_codes) after renaming undefined ranks
+        self._renamed = None
+        # nodes in depth-first order (see Taxonomy._depth_first)
+        self._order = None
+        # (values, lookup) (see _id_arrays)
+        self._id_array_pair = None
+        # see _lca_index
+        self._lca = None
+        # (pre, last) (see _intervals)
+        self._interval_pair = None
+
+    def _merged_map(self):
+        return self._merged
+
+    def _node_arrays(self):
+        return self._ids, self._parents, self._rank_names, self._rank_codes, self._name
+
+    def _append(self, tax_id, parent_id, rank, tax_name):
+        """
+        Add a node to the arrays; returns its index.
+        """
+
+        if rank not in self._rank_names:
+            self._rank_names.append(rank)
+
+        i = len(self._ids)
+        self._ids.append(tax_id)
+        self._index[tax_id] = i
+        self._parents.append(self._lookup(parent_id))
+        self._rank_codes.append(self._rank_names.index(rank))
+
+        tax_name = tax_name.encode('utf-8') if isinstance(tax_name, unicode) else tax_name
+        self._name_heap.extend(tax_name)
+        self._name_offsets.append(self._name_offsets[-1] + len(tax_name))
+        self._has_name.append(1)
+        self._reset_derived()
+
+        return i
+
+    def _pop(self):
+        """
+        Remove the most recently appended node.
+        """
+
+        tax_id = self._ids.pop()
+        del self._index[tax_id]
+        self._parents.pop()
+        self._rank_codes.pop()
+        self._name_offsets.pop()
+        del self._name_heap[self._name_offsets[-1]:]
+        self._has_name.pop()
+        self._reset_derived()
+
+    def _lookup(self, tax_id, retry=True):
+        """
+        Returns the index of tax_id, following merged tax_ids if retry is True.
+        """
+
+        i = self._index.get(tax_id)
+        if i is None:
+            new_tax_id = self._merged.get(tax_id) if retry else None
+            if new_tax_id is None:
+                raise KeyError('value "%s" not found in nodes.tax_id' % tax_id)
+            return self._lookup(new_tax_id, retry=False)
+
+        return i
+
+    def _tax_id(self, i):
+        return self._ids[i]
+
+    def _parent(self, i):
+        return self._parents[i]
+
+    def _rank(self, i):
+        return self._rank_names[self._rank_codes[i]]
+
+    def _name(self, i):
+        """
+        Returns the primary name of node i, or None if it has none.
+        """
+
+        if not self._has_name[i]:
+            return None
+
+        offsets = self._name_offsets
+        return self._name_heap[offsets[i]:offsets[i+1]].decode('utf-8')
+
+    def _node(self, tax_id, retry = True):
+        """
+        Returns parent, rank
+        """
+
+        i = self._lookup(tax_id, retry)
+        return self._tax_id(self._parent(i)), self._rank(i)
+
+    def _nodes(self, tax_ids):
+        """
+        Returns a dict of {tax_id: (parent_id, rank)} for each of
+        tax_ids that is a node.
+        """
+
+        output = {}
+        for tax_id in tax_ids:
+            i = self._index.get(tax_id)
+            if i is not None:
+                output[tax_id] = (self._tax_id(self._parent(i)), self._rank(i))
+
+        return output
+
+    def primary_from_id(self, tax_id, retry = True):
+        """
+        Returns primary taxonomic name associated with tax_id
+        """
+
+        try:
+            tax_name = self._name(self._lookup(tax_id, retry))
+        except KeyError:
+            tax_name = None
+
+        if tax_name is None:
+            raise KeyError('value "%s" not found in names.tax_id' % tax_id)
+
+        return tax_name
+
+    def _fetch_lineage(self, tax_id, retry=True):
+        """
+        Returns the lineage of tax_id as a list of (rank, tax_id)
+        tuples, root first.
+        """
+
+        i = self._lookup(tax_id, retry)
+        lineage = [(self._rank(i), tax_id)]
+
+        parent = self._parent(i)
+        while parent != i:
+            i = parent
+            lineage.append((self._rank(i), self._tax_id(i)))
+            parent = self._parent(i)
+
+        lineage.reverse()
+        return lineage
+
+    def lineages(self, tax_ids):
+        """
+        Returns a list of lineages (see Taxonomy.lineage) for each of
+        tax_ids in the order provided.
+        """
+
+        return [self.lineage(tax_id) for tax_id in tax_ids]
+
+    def _depth_first_order(self):
+        if self._order is None:
+            self._order = self._depth_first(self._parents)
+        return self._order
+
+    def _rank_table(self, rank):
+        """
+        Returns an array containing, for each node, the index of its
+        ancestor at rank (the node itself if it has that rank), or -1
+        if its lineage does not include rank. The array is computed
+        for all nodes the first time rank is requested: using numpy,
+        by repeatedly replacing each node's parent pointer with its
+        grandparent (so that the number of steps grows with the
+        logarithm of the depth of the taxonomy), or otherwise in a
+        single pass over the nodes with parents before children.
+        """
+
+        table = self._rank_tables.get(rank)
+        if table is not None:
+            return table
+
+        if rank in self._rank_names and rank != self.undefined_rank:
+            rank_names, rank_codes = self._rank_names, self._rank_codes
+        else:
+            # rank may be the new name of an undefined rank
+            if self._renamed is None:
+                self._renamed = self._rename_ranks(
+                    self._parents, self._depth_first_order(), self._rank_names, self._rank_codes)
+            rank_names, rank_codes = self._renamed
+
+        code = rank_names.index(rank) if rank in rank_names else -1
+        parents = self._parents
+
+        if numpy is not None:
+            pointers = _as_numpy(parents, numpy.int64)
+            table = numpy.where(_as_numpy(rank_codes, numpy.int64) == code,
+                                numpy.arange(len(pointers)), -1)
+
+            # table[i] describes the nodes from i up to but not
+            # including pointers[i]; each step doubles that distance
+            while True:
+                table = numpy.where(table >= 0, table, table[pointers])
+                jumped = pointers[pointers]
+                if (jumped == pointers).all():
+                    break
+                pointers = jumped
+        else:
+            table = array.array('l', [-1]) * len(parents)
+            for i in self._depth_first_order():
+                if rank_codes[i] == code:
+                    table[i] = i
+                elif parents[i] != i:
+                    table[i] = table[parents[i]]
+
+        self._rank_tables[rank] = table
+        return table
+
+    def _id_arrays(self):
+        """
+        Returns (values, lookup), two numpy int64 arrays: values
+        contains each node's tax_id as an integer (-2 if the tax_id is
+        not an integer), and lookup[tax_id] is the index of the node
+        with integer tax_id or -1. lookup includes merged tax_ids.
+        """
+
+        if self._id_array_pair is None:
+            values = numpy.fromiter((int(tax_id) if tax_id.isdigit() else -2
+                                     for tax_id in self._ids), numpy.int64, len(self._ids))
+            merged = [(int(old), self._index.get(new)) for old, new in self._merged.items()
+                      if old.isdigit()]
+
+            size = max([values.max()] + [old for old, i in merged]) + 1
+            lookup = numpy.empty(size, dtype=numpy.int64)
+            lookup.fill(-1)
+            for old, i in merged:
+                if i is not None:
+                    lookup[old] = i
+            integer = values >= 0
+            lookup[values[integer]] = numpy.flatnonzero(integer)
+
+            self._id_array_pair = values, lookup
+
+        return self._id_array_pair
+
+    def at_rank(self, tax_ids, rank, missing=None):
+        """
+        See Taxonomy.at_rank. Does not query the database: the
+        ancestors of all nodes at rank are found once (see
+        _rank_table), after which each tax_id requires a single
+        lookup. If numpy is available and tax_ids is a numpy array of
+        integers, the lookups are vectorized and the output is a numpy
+        int64 array, in which case missing must be an integer (the
+        default is -1).
+        """
+
+        table = self._rank_table(rank)
+
+        if numpy is not None and isinstance(tax_ids, numpy.ndarray) and tax_ids.dtype.kind in 'iu':
+            return self._at_rank_array(tax_ids, table, -1 if missing is None else missing)
+
+        tax_ids = list(tax_ids)
+        ids, lookup = self._ids, self._lookup
+
+        found = {}
+        for tax_id in set(tax_ids):
+            i = lookup(tax_id)
+            j = table[i]
+            # as in lineage, a merged tax_id replaces the current one
+            found[tax_id] = missing if j < 0 else tax_id if j == i else ids[j]
+
+        return [found[tax_id] for tax_id in tax_ids]
+
+    def _at_rank_array(self, tax_ids, table, missing):
+        """
+        at_rank for a numpy array of integer tax_ids.
+        """
+
+        values, lookup = self._id_arrays()
+
+        tax_ids = tax_ids.astype(numpy.int64)
+        outside = (tax_ids < 0) | (tax_ids >= len(lookup))
+        indices = numpy.where(outside, -1, lookup[numpy.where(outside, 0, tax_ids)])
+        if (indices < 0).any():
+            tax_id = tax_ids[numpy.flatnonzero(indices < 0)[0]]
+            raise KeyError('value "%s" not found in nodes.tax_id' % tax_id)
+
+        ancestors = table[indices]
+        output = numpy.where(ancestors == indices, tax_ids, values[ancestors])
+        if ((ancestors >= 0) & (output == -2)).any():
+            raise ValueError('an ancestor at this rank has a tax_id that is not an integer')
+
+        return numpy.where(ancestors >= 0, output, missing)
+
+    def _lca_file(self):
+        """
+        Returns (fname, key), where fname is the file in which the
+        index used by lca is saved (the name of the database followed
+        by ".lca") and key is the modification time and size of the
+        database when the nodes were read, or None if the database
+        is not a file.
+        """
+
+        if self._source_key is None:
+            return None
+        return self.engine.url.database + '.lca', self._source_key
+
+    def _lca_checksum(self):
+        """
+        Returns a checksum of the nodes (see lca.checksum).
+        """
+
+        return checksum(self._ids, self._parents)
+
+    def _lca_index(self):
+        """
+        Returns an LcaIndex of the nodes, which is read from the file
+        named by _lca_file if it is up to date, or otherwise built
+        and saved to that file.
+        """
+
+        if self._lca is not None:
+            return self._lca
+
+        cache = self._lca_file()
+        crc = self._lca_checksum() if cache else None
+        index = LcaIndex.load(cache[0], cache[1], crc) if cache else None
+        if index is not None and len(index) != len(self._ids):
+            index = None
+
+        if index is None:
+            index = LcaIndex.build(self._parents, self._depth_first_order())
+            if cache:
+                try:
+                    index.save(cache[0], cache[1], crc)
+                except (IOError, OSError), err:
+                    log.warning('could not save lca index: %s' % err)
+
+        self._lca = index
+        return index
+
+    def lca_many(self, groups):
+        """
+        See Taxonomy.lca_many. Does not query the database: uses an
+        index of the nodes (see module lca) that is built on first
+        use and saved next to the database, after which each lowest
+        common ancestor of two nodes requires O(log(depth)) steps. If
+        numpy is available, the groups are processed together, one
+        position at a time.
+        """
+
+        index = self._lca_index()
+        lookup = self._lookup
+
+        groups = [[lookup(tax_id) for tax_id in group] for group in groups]
+        if not all(groups):
+            raise ValueError('lca requires at least one tax_id')
+
+        if numpy is not None and groups:
+            found = numpy.array([group[0] for group in groups], dtype=numpy.int64)
+            for p in xrange(1, max(len(group) for group in groups)):
+                rows = numpy.array([k for k, group in enumerate(groups)
+                                    if len(group) > p and found[k] >= 0], dtype=numpy.int64)
+                if len(rows):
+                    others = numpy.array([groups[k][p] for k in rows], dtype=numpy.int64)
+                    found[rows] = index.lca_arrays(found[rows], others)
+        else:
+            found = [index.lca_all(group) for group in groups]
+
+        return [self._tax_id(i) if i >= 0 else None for i in found]
+
+    def _intervals(self):
+        """
+        Returns (pre, last), arrays containing for each node its
+        position in depth-first order (see _depth_first_order) and
+        the largest position among its descendants (or its own), so
+        that node j is below node i if pre[i] < pre[j] <= last[i].
+        """
+
+        if self._interval_pair is None:
+            order, parents = self._depth_first_order(), self._parents
+
+            pre = array.array('l', [0]) * len(order)
+            for k, i in enumerate(order):
+                pre[i] = k
+
+            last = array.array('l', pre)
+            for i in reversed(order):
+                parent = parents[i]
+                if last[i] > last[parent]:
+                    last[parent] = last[i]
+
+            self._interval_pair = pre, last
+
+        return self._interval_pair
+
+    def descendants(self, tax_id, rank=None):
+        """
+        Returns a list of the tax_ids of all descendants of tax_id
+        (not including tax_id itself), or only of those with the
+        given rank if rank is provided. The descendants are a slice
+        of the nodes in depth-first order (see _intervals).
+        """
+
+        i = self._lookup(tax_id)
+        pre, last = self._intervals()
+        below = self._depth_first_order()[pre[i] + 1:last[i] + 1]
+
+        if rank is not None:
+            code = self._rank_names.index(rank) if rank in self._rank_names else -1
+            rank_codes = self._rank_codes
+            below = [j for j in below if rank_codes[j] == code]
+
+        return [self._tax_id(j) for j in below]
+
+    def is_descendant(self, tax_id, ancestor_id):
+        """
+        See Taxonomy.is_descendant; compares the positions of the two
+        nodes (see _intervals).
+        """
+
+        i, j = self._lookup(tax_id), self._lookup(ancestor_id)
+        pre, last = self._intervals()
+        return pre[j] < pre[i] <= last[j]
+
+    def add_node(self, tax_id, parent_id, rank, tax_name, source_id=None, source_name=None, **kwargs):
+
+        self._check_writable()
+
+        if tax_id in self._index:
+            # let the database report the duplicate
+            return Taxonomy.add_node(self, tax_id, parent_id, rank, tax_name,
+                                     source_id=source_id, source_name=source_name, **kwargs)
+
+        self._append(tax_id, parent_id, rank, tax_name)
+        try:
+            return Taxonomy.add_node(self, tax_id, parent_id, rank, tax_name,
+                                     source_id=source_id, source_name=source_name, **kwargs)
+        except:
+            self._pop()
+            raise
+
+    def _insert_nodes(self, rows):
+        """
+        See Taxonomy._insert_nodes; also adds the nodes to the arrays.
+        """
+
+        if any(row['tax_id'] in self._index for row in rows):
+            # let the database report the duplicate
+            return Taxonomy._insert_nodes(self, rows)
+
+        appended = 0
+        try:
+            for row in rows:
+                self._append(row['tax_id'], row['parent_id'], row['rank'], row['tax_name'])
+                appended += 1
+            Taxonomy._insert_nodes(self, rows)
+        except:
+            for j in xrange(appended):
+                self._pop()
+            raise
@@ -3,18 +3,41 @@ Methods and variables specific to the NCBI taxonomy.
 """
 
 import sqlite3
+import contextlib
+import io
 import itertools
 import logging
+import multiprocessing
 import pprint
 import os
+import traceback
 import urllib
 import zipfile
+from Queue import Empty
+
+from utils import normalize_name
 
 log = logging
 
 ncbi_data_url = 'ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdmp.zip'
 
-db_schema = """
+# size of the read buffer used when streaming rows from .dmp files
+read_bufsize = 1024 * 1024
+
+# tables and the .dmp files in the NCBI archive used to populate them
+dump_files = [('nodes', 'nodes.dmp'), ('names', 'names.dmp'), ('merged', 'merged.dmp')]
+
+# number of rows passed at a time from parsing processes to the
+# database writer, and the maximum number of these lists waiting in
+# the queue (see parallel_insert)
+parse_chunksize = 10000
+parse_queue_size = 16
+
+# seconds the writer waits for rows before checking that the parsing
+# processes are still running (see parallel_insert)
+parse_poll_interval = 1.0
+
+db_tables = """
 -- nodes.dmp specifies additional columns but these are not implemented yet
 CREATE TABLE nodes(
 tax_id        TEXT UNIQUE PRIMARY KEY NOT NULL,
@@ -49,23 +72,146 @@ INSERT INTO "source"
   (id, name, description)
 VALUES
   (1, "NCBI", "NCBI taxonomy");
+"""
 
+# indices are defined separately so that they can be created after a
+# bulk load (see db_load)
+db_indexes = """
 -- indices on nodes
-CREATE INDEX nodes_tax_id ON nodes(tax_id);
-CREATE INDEX nodes_parent_id ON nodes(parent_id);
-CREATE INDEX nodes_rank ON nodes(rank);
+CREATE INDEX IF NOT EXISTS nodes_tax_id ON nodes(tax_id);
+CREATE INDEX IF NOT EXISTS nodes_parent_id ON nodes(parent_id);
+CREATE INDEX IF NOT EXISTS nodes_rank ON nodes(rank);
 
 -- indices on names
-CREATE INDEX names_tax_id ON names(tax_id);
-CREATE INDEX names_tax_name ON names(tax_name);
-CREATE INDEX names_is_primary ON names(is_primary);
-CREATE INDEX names_taxid_is_primary ON names(tax_id, is_primary);
-CREATE INDEX names_name_is_primary ON names(tax_name, is_primary);
+CREATE INDEX IF NOT EXISTS names_tax_id ON names(tax_id);
+CREATE INDEX IF NOT EXISTS names_tax_name ON names(tax_name);
+CREATE INDEX IF NOT EXISTS names_is_primary ON names(is_primary);
+CREATE INDEX IF NOT EXISTS names_taxid_is_primary ON names(tax_id, is_primary);
+CREATE INDEX IF NOT EXISTS names_name_is_primary ON names(tax_name, is_primary);
 
 -- CREATE UNIQUE INDEX names_id_name ON names(tax_id, tax_name, is_primary);
+"""
+
+db_schema = db_tables + db_indexes
+
+# A variant of the schema in which tax_ids are stored as integers;
+# nodes.tax_id is an alias for the rowid, so the index on
+# nodes.tax_id is unnecessary. Taxonomy detects this schema and
+# continues to accept and return tax_ids as strings. Note that
+# custom (non-numeric) tax_ids cannot be represented.
+db_tables_integer = """
+CREATE TABLE nodes(
+tax_id        INTEGER PRIMARY KEY NOT NULL,
+parent_id     INTEGER,
+rank          TEXT,
+embl_code     TEXT,
+division_id   INTEGER,
+source_id     INTEGER DEFAULT 1
+);
+
+CREATE TABLE names(
+tax_id        INTEGER REFERENCES nodes(tax_id),
+tax_name      TEXT,
+unique_name   TEXT,
+name_class    TEXT,
+is_primary    INTEGER
+);
+
+CREATE TABLE merged(
+old_tax_id    INTEGER,
+new_tax_id    INTEGER REFERENCES nodes(tax_id)
+);
+
+CREATE TABLE source(
+id            INTEGER PRIMARY KEY AUTOINCREMENT,
+name          TEXT UNIQUE,
+description   TEXT
+);
 
+INSERT INTO "source"
+  (id, name, description)
+VALUES
+  (1, "NCBI", "NCBI taxonomy");
+"""
+
+db_indexes_integer = '\n'.join(
+    line for line in db_indexes.splitlines() if 'nodes_tax_id' not in line)
+
+db_schema_integer = db_tables_integer + db_indexes_integer
+
+# Optional table of (tax_id, ancestor_id) pairs (the transitive closure
+# of nodes.parent_id) supporting single-query lineages; see
+# build_ancestors.
+ancestors_schema = """
+CREATE TABLE ancestors(
+tax_id        %(id_type)s NOT NULL,
+ancestor_id   %(id_type)s NOT NULL,
+depth         INTEGER NOT NULL -- number of generations from tax_id to ancestor_id
+);
 """
 
+ancestors_indexes = """
+CREATE INDEX IF NOT EXISTS ancestors_tax_id_depth ON ancestors(tax_id, depth);
+CREATE INDEX IF NOT EXISTS ancestors_ancestor_id ON ancestors(ancestor_id);
+"""
+
+# populates table "ancestors" for the nodes selected by %(where)s
+ancestors_insert = """
+INSERT INTO ancestors (tax_id, ancestor_id, depth)
+WITH RECURSIVE chain(tax_id, ancestor_id, depth) AS (
+  SELECT tax_id, tax_id, 0 FROM nodes %(where)s
+  UNION ALL
+  SELECT chain.tax_id, nodes.parent_id, chain.depth + 1
+  FROM chain JOIN nodes ON nodes.tax_id = chain.ancestor_id
+  WHERE nodes.parent_id != nodes.tax_id AND chain.depth < ?
+)
+SELECT tax_id, ancestor_id, depth FROM chain
+"""
+
+# Optional table of nested-set intervals supporting descendant and
+# ancestry queries without recursion; see build_intervals.
+intervals_schema = """
+CREATE TABLE intervals(
+tax_id        %(id_type)s UNIQUE NOT NULL,
+lft           INTEGER NOT NULL, -- position of tax_id in a depth-first traversal
+rgt           INTEGER NOT NULL  -- largest lft among tax_id and its descendants
+);
+"""
+
+intervals_indexes = """
+CREATE INDEX IF NOT EXISTS intervals_lft ON intervals(lft);
+"""
+
+# Optional table of normalized names supporting case-insensitive,
+# prefix and approximate name searches; see build_name_index.
+name_index_schema = """
+CREATE TABLE name_index(
+key           TEXT NOT NULL, -- tax_name normalized by utils.normalize_name
+rkey          TEXT NOT NULL, -- key reversed, for searches by suffix
+tax_id        %(id_type)s NOT NULL,
+tax_name      TEXT,
+is_primary    INTEGER
+);
+"""
+
+# covering indexes, so that searches do not read the table itself
+name_index_indexes = """
+CREATE INDEX IF NOT EXISTS name_index_key ON name_index(key, tax_id, is_primary);
+CREATE INDEX IF NOT EXISTS name_index_rkey ON name_index(rkey, key, tax_id, is_primary);
+"""
+
+# lineages are assumed to be no deeper than this
+max_lineage_depth = 1000
+
+# pragmas used during a bulk load; the previous values are restored
+# once the load is complete. A negative cache_size is in KiB.
+bulk_pragmas = [
+    ('journal_mode', 'OFF'),
+    ('synchronous', 'OFF'),
+    ('cache_size', -512 * 1024),
+    ('temp_store', 'MEMORY'),
+    ]
+
 # define headers in names.dmp, etc (may not correspond to table columns above)
 merged_keys = 'old_tax_id new_tax_id'.split()
 
@@ -117,40 +263,473 @@ def db_connect(dbname='ncbi_taxonomy.db', schema=db_schema, new=False):
             pass
 
     con = sqlite3.connect(dbname)
+    execute_script(con, schema)
+
+    return con
+
+def execute_script(con, script):
+    """
+    Execute each of the semicolon-delimited statements in script.
+    """
+
     cur = con.cursor()
 
-    cmds = [cmd.strip() for cmd in schema.split(';') if cmd.strip()]
+    cmds = [cmd.strip() for cmd in script.split(';') if cmd.strip()]
     for cmd in cmds:
         log.info(cmd)
         cur.execute(cmd)
 
-        # try:
+    con.commit()
 
-        # except sqlite3.OperationalError:
-        #     break
+def set_pragmas(con, pragmas):
+    """
+    Set each (name, value) pair in pragmas and return a list of
+    (name, value) pairs containing the previous settings.
+    """
 
-    return con
+    cur = con.cursor()
+    previous = []
+    for name, value in pragmas:
+        previous.append((name, cur.execute('PRAGMA %s' % name).fetchone()[0]))
+        log.info('PRAGMA %s = %s' % (name, value))
+        cur.execute('PRAGMA %s = %s' % (name, value))
+
+    return previous
+
+def db_load(con, archive, root_name='root', maxrows=None, bulk=False,
+            indexes=db_indexes, processes=None, ancestors=False, intervals=False,
+            name_index=False):
+    """
+    Load the contents of the NCBI taxonomy archive into the database.
+
+    * con - connection to a database containing the tables defined in
+      db_schema (or db_tables).
+    * archive - path to the zip archive (see fetch_data).
+    * root_name - string identifying the root node.
+    * maxrows - maximum number of rows to insert into each table.
+    * bulk - if True, load all tables in a single transaction with
+      the pragmas in bulk_pragmas, then create indexes. Intended for
+      a fresh database created using
+      db_connect(dbname, schema=db_tables, new=True).
+    * indexes - indexes to create following a bulk load.
+    * processes - if provided, the number of worker processes used to
+      parse the .dmp files (see parallel_insert); otherwise the files
+      are parsed and inserted one after another.
+    * ancestors - if True, build the table "ancestors" once the
+      other tables are loaded (see build_ancestors).
+    * intervals - if True, build the table "intervals" once the
+      other tables are loaded (see build_intervals).
+    * name_index - if True, build the table "name_index" once the
+      other tables are loaded (see build_name_index).
+    """
+
+    if bulk:
+        previous = set_pragmas(con, bulk_pragmas)
+
+    try:
+        if processes:
+            parallel_insert(con, archive, root_name, maxrows,
+                            processes=processes, commit=not bulk)
+        else:
+            for tablename, fname in dump_files:
+                rows = read_dump(archive, fname, root_name)
+                do_insert(con, tablename, rows, maxrows, commit=not bulk)
+
+        if bulk:
+            con.commit()
+            execute_script(con, indexes)
+
+        if ancestors:
+            build_ancestors(con)
+
+        if intervals:
+            build_intervals(con)
+
+        if name_index:
+            build_name_index(con)
+    finally:
+        if bulk:
+            # restore the previous settings even if the load failed;
+            # uncommitted rows are discarded first because
+            # journal_mode can't be changed within a transaction
+            con.rollback()
+            set_pragmas(con, previous)
+
+def db_update(con, archive, root_name='root', max_depth=max_lineage_depth):
+    """
+    Update a database loaded using db_load to match a newer NCBI
+    taxonomy archive, changing only the rows that differ, and return
+    the number of rows changed as a dict of {tablename: {action:
+    count}}, where the actions are "inserted", "updated" (nodes
+    only) and "deleted".
+
+    * con - connection to a database created by db_load.
+    * archive - path to the zip archive (see fetch_data).
+    * root_name - string identifying the root node (as for db_load).
+    * max_depth - see build_ancestors.
+
+    The new .dmp files are loaded into temporary tables and compared
+    with tables "nodes", "names" and "merged", and the differences
+    are applied in a single transaction along with the corresponding
+    changes to the optional tables "ancestors" and "name_index" (if
+    present); only the lineages of moved, added or deleted nodes and
+    the names of changed tax_ids are rewritten. Table "intervals" (if
+    present) is renumbered if any node was added, deleted or moved.
+    Nodes from other sources (source_id != 1) and their names are
+    preserved; an NCBI node with the tax_id of such a node is skipped.
+    """
+
+    tables = set(row[0] for row in con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    cur = con.cursor()
+
+    def execute(cmd, *args):
+        log.info(cmd)
+        return cur.execute(cmd, args).rowcount
+
+    counts = dict(nodes={}, names={}, merged={})
+
+    execute('BEGIN')
+    try:
+        for tablename, fname in dump_files:
+            execute('CREATE TEMP TABLE "new_%s" AS SELECT * FROM "%s" WHERE 0' % (tablename, tablename))
+            rows = read_dump(archive, fname, root_name)
+            row = rows.next()
+            cmd = 'INSERT INTO "new_%s" VALUES (%s)' % (tablename, ', '.join(['?']*len(row)))
+            cur.executemany(cmd, itertools.chain([row], rows))
+
+        execute('CREATE TEMP TABLE custom AS SELECT tax_id FROM nodes WHERE source_id != 1')
+        skipped = execute('DELETE FROM new_nodes WHERE tax_id IN (SELECT tax_id FROM custom)')
+        if skipped:
+            log.warning('skipped %s nodes with the tax_id of a node from another source' % skipped)
+        execute('DELETE FROM new_names WHERE tax_id IN (SELECT tax_id FROM custom)')
+
+        # nodes
+        execute("""CREATE TEMP TABLE changed_nodes AS
+                   SELECT * FROM new_nodes EXCEPT SELECT * FROM nodes""")
+        execute("""CREATE TEMP TABLE deleted_nodes AS
+                   SELECT tax_id FROM nodes WHERE source_id = 1
+                   EXCEPT SELECT tax_id FROM new_nodes""")
+        # nodes whose position in the tree changes
+        execute("""CREATE TEMP TABLE moved_nodes AS
+                   SELECT changed_nodes.tax_id FROM changed_nodes
+                   LEFT JOIN nodes ON nodes.tax_id = changed_nodes.tax_id
+                   WHERE nodes.parent_id IS NULL OR nodes.parent_id != changed_nodes.parent_id
+                   UNION SELECT tax_id FROM deleted_nodes""")
+
+        orphans, = cur.execute("""SELECT count(*) FROM nodes WHERE source_id != 1
+                                  AND parent_id IN (SELECT tax_id FROM deleted_nodes)""").fetchone()
+        if orphans:
+            log.warning('%s nodes from other sources have a deleted parent' % orphans)
+
+        updated, = cur.execute("""SELECT count(*) FROM changed_nodes
+                                  WHERE tax_id IN (SELECT tax_id FROM nodes)""").fetchone()
+        changed = execute('INSERT OR REPLACE INTO nodes SELECT * FROM changed_nodes')
+        counts['nodes'] = dict(inserted=changed - updated, updated=updated,
+                               deleted=execute('DELETE FROM nodes WHERE tax_id IN (SELECT tax_id FROM deleted_nodes)'))
+
+        # names and merged have no key; a changed row is deleted and inserted
+        execute("""CREATE TEMP TABLE deleted_names AS
+                   SELECT * FROM names WHERE tax_id NOT IN (SELECT tax_id FROM custom)
+                   EXCEPT SELECT * FROM new_names""")
+        execute("""CREATE TEMP TABLE inserted_names AS
+                   SELECT * FROM new_names EXCEPT SELECT * FROM names""")
+        counts['names'] = dict(
+            deleted=execute("""DELETE FROM names WHERE rowid IN (
+                               SELECT names.rowid FROM deleted_names JOIN names
+                               ON names.tax_id = deleted_names.tax_id
+                               AND names.tax_name IS deleted_names.tax_name
+                               AND names.unique_name IS deleted_names.unique_name
+                               AND names.name_class IS deleted_names.name_class
+                               AND names.is_primary IS deleted_names.is_primary)"""),
+            inserted=execute('INSERT INTO names SELECT * FROM inserted_names'))
+
+        counts['merged'] = dict(
+            deleted=execute("""DELETE FROM merged WHERE rowid IN (
+                               SELECT merged.rowid FROM merged JOIN (
+                                 SELECT * FROM merged EXCEPT SELECT * FROM new_merged) old
+                               ON merged.old_tax_id IS old.old_tax_id
+                               AND merged.new_tax_id IS old.new_tax_id)"""),
+            inserted=execute("""INSERT INTO merged
+                                SELECT * FROM new_merged EXCEPT SELECT * FROM merged"""))
+
+        moved, = cur.execute('SELECT count(*) FROM moved_nodes').fetchone()
+
+        if 'ancestors' in tables and moved:
+            # the lineages of moved nodes and of their descendants
+            execute("""CREATE TEMP TABLE stale AS
+                       SELECT tax_id FROM moved_nodes UNION
+                       SELECT tax_id FROM ancestors
+                       WHERE ancestor_id IN (SELECT tax_id FROM moved_nodes)""")
+            execute('DELETE FROM ancestors WHERE tax_id IN (SELECT tax_id FROM stale)')
+            execute(ancestors_insert % {'where': 'WHERE tax_id IN (SELECT tax_id FROM stale)'},
+                    max_depth)
+
+        if 'intervals' in tables and moved:
+            execute('DELETE FROM intervals')
+            cur.executemany('INSERT INTO intervals (tax_id, lft, rgt) VALUES (?, ?, ?)',
+                            _interval_rows(cur))
+
+        if 'name_index' in tables:
+            execute("""CREATE TEMP TABLE renamed AS
+                       SELECT tax_id FROM deleted_names UNION
+                       SELECT tax_id FROM inserted_names UNION
+                       SELECT tax_id FROM deleted_nodes""")
+            execute('DELETE FROM name_index WHERE tax_id IN (SELECT tax_id FROM renamed)')
+            _insert_name_index(con, """SELECT tax_id, tax_name, is_primary FROM names
+                                       WHERE tax_id IN (SELECT tax_id FROM renamed)""")
+
+        for tablename in ['new_nodes', 'new_names', 'new_merged', 'custom', 'changed_nodes',
+                          'deleted_nodes', 'moved_nodes', 'deleted_names', 'inserted_names',
+                          'stale', 'renamed']:
+            execute('DROP TABLE IF EXISTS temp."%s"' % tablename)
+
+        execute('COMMIT')
+    except:
+        execute('ROLLBACK')
+        raise
+    finally:
+        con.isolation_level = isolation_level
+
+    log.warning('updated database: %s' % counts)
+    return counts
+
+def build_ancestors(con, max_depth=max_lineage_depth):
+    """
+    (Re)create the table "ancestors", which contains a row (tax_id,
+    ancestor_id, depth) for each node and each of its ancestors,
+    including the node itself at depth 0. The lineage of a node is
+    the set of rows for its tax_id ordered by decreasing depth, and
+    its descendants are the rows with its tax_id as ancestor_id.
+
+    * con - connection to a database containing a populated table "nodes".
+    * max_depth - lineages are truncated at this depth (protects
+      against cycles among custom nodes).
+    """
+
+    cur = con.cursor()
+
+    # use the same representation of tax_id as table "nodes"
+    id_type = dict((row[1], row[2]) for row in cur.execute('PRAGMA table_info(nodes)'))['tax_id']
+
+    cur.execute('DROP TABLE IF EXISTS ancestors')
+    execute_script(con, ancestors_schema % {'id_type': id_type})
+
+    cmd = ancestors_insert % {'where': ''}
+    log.info(cmd)
+    cur.execute(cmd, (max_depth,))
+    con.commit()
+
+    execute_script(con, ancestors_indexes)
 
-def db_load(con, archive, root_name='root', maxrows=None):
+def build_intervals(con):
+    """
+    (Re)create the table "intervals", which numbers the nodes in
+    depth-first order (lft) and records for each node the largest
+    number in its subtree (rgt). The descendants of a node are the
+    nodes with lft in (lft, rgt] of that node, and a node is an
+    ancestor of another if its interval contains the other's lft.
+
+    * con - connection to a database containing a populated table "nodes".
+    """
+
+    cur = con.cursor()
 
-    # nodes
-    rows = read_nodes(
-        rows=read_archive(archive, 'nodes.dmp'),
-        root_name=root_name,
-        ncbi_source_id=1)
-    do_insert(con, 'nodes', rows, maxrows)
+    id_type = dict((row[1], row[2]) for row in cur.execute('PRAGMA table_info(nodes)'))['tax_id']
 
-    # names
-    rows = read_names(
-        rows=read_archive(archive, 'names.dmp')
-        )
-    do_insert(con, 'names', rows, maxrows)
+    cur.execute('DROP TABLE IF EXISTS intervals')
+    execute_script(con, intervals_schema % {'id_type': id_type})
 
-    # merged
-    rows = read_archive(archive, 'merged.dmp')
-    do_insert(con, 'merged', rows, maxrows)
+    cur.executemany('INSERT INTO intervals (tax_id, lft, rgt) VALUES (?, ?, ?)',
+                    _interval_rows(cur))
+    con.commit()
 
-def do_insert(con, tablename, rows, maxrows=None):
+    execute_script(con, intervals_indexes)
+
+def _interval_rows(cur):
+    """
+    Return an iterator of rows (tax_id, lft, rgt) for table
+    "intervals" (see build_intervals) computed from table "nodes".
+    """
+
+    parents = {}
+    children = {}
+    roots = []
+    for tax_id, parent_id in cur.execute('SELECT tax_id, parent_id FROM nodes'):
+        parents[tax_id] = parent_id
+        if tax_id == parent_id:
+            roots.append(tax_id)
+        else:
+            children.setdefault(parent_id, []).append(tax_id)
+
+    order = []
+    stack = roots[::-1]
+    while stack:
+        tax_id = stack.pop()
+        order.append(tax_id)
+        stack.extend(reversed(children.pop(tax_id, [])))
+    del children
+
+    if len(order) != len(parents):
+        log.warning('%s nodes are not connected to the root' % (len(parents) - len(order)))
+
+    # visit descendants before ancestors to find the end of each subtree
+    lft = dict((tax_id, i) for i, tax_id in enumerate(order))
+    rgt = range(len(order))
+    for i in reversed(xrange(len(order))):
+        j = lft[parents[order[i]]]
+        if rgt[i] > rgt[j]:
+            rgt[j] = rgt[i]
+    del parents
+
+    return ((tax_id, i, rgt[i]) for i, tax_id in enumerate(order))
+
+def build_name_index(con):
+    """
+    (Re)create the table "name_index", which contains a row for each
+    name in table "names" with its key (see utils.normalize_name)
+    and the reversed key. Names are found by key using an index
+    rather than by comparing every name.
+
+    * con - connection to a database containing a populated table "names".
+    """
+
+    cur = con.cursor()
+
+    id_type = dict((row[1], row[2]) for row in cur.execute('PRAGMA table_info(names)'))['tax_id']
+
+    cur.execute('DROP TABLE IF EXISTS name_index')
+    execute_script(con, name_index_schema % {'id_type': id_type})
+
+    _insert_name_index(con, 'SELECT tax_id, tax_name, is_primary FROM names')
+    con.commit()
+
+    execute_script(con, name_index_indexes)
+
+def _insert_name_index(con, query):
+    """
+    Insert a row into table "name_index" for each (tax_id,
+    tax_name, is_primary) returned by query.
+    """
+
+    def rows():
+        for tax_id, tax_name, is_primary in con.cursor().execute(query):
+            if tax_name is not None:
+                key = normalize_name(tax_name)
+                yield key, key[::-1], tax_id, tax_name, is_primary
+
+    con.cursor().executemany(
+        'INSERT INTO name_index (key, rkey, tax_id, tax_name, is_primary) '
+        'VALUES (?, ?, ?, ?, ?)', rows())
+
+def read_dump(archive, fname, root_name='root'):
+    """
+    Return an iterator of rows from the file fname in archive ready
+    to insert into the corresponding table (see dump_files).
+    """
+
+    rows = read_archive(archive, fname)
+    if fname == 'nodes.dmp':
+        rows = read_nodes(rows=rows, root_name=root_name, ncbi_source_id=1)
+    elif fname == 'names.dmp':
+        rows = read_names(rows=rows)
+
+    return rows
+
+def _parse_worker(queue, archive, tablename, fname, root_name, maxrows, chunksize):
+    """
+    Parse fname and put lists of rows on queue as (tablename,
+    rows). Puts (tablename, None) when done or (tablename, traceback)
+    on error.
+    """
+
+    try:
+        rows = read_dump(archive, fname, root_name)
+        if maxrows:
+            rows = itertools.islice(rows, maxrows)
+
+        while True:
+            chunk = list(itertools.islice(rows, chunksize))
+            if not chunk:
+                break
+            queue.put((tablename, chunk))
+    except Exception:
+        queue.put((tablename, traceback.format_exc()))
+    else:
+        queue.put((tablename, None))
+
+def parallel_insert(con, archive, root_name='root', maxrows=None, processes=3,
+                    chunksize=parse_chunksize, queue_size=parse_queue_size, commit=True):
+    """
+    Parse the files in dump_files in up to `processes` worker
+    processes and insert the rows using a single writer (this
+    process). Parsed rows are passed from the workers in lists of
+    `chunksize` rows through a queue holding at most `queue_size`
+    lists, so parsing overlaps with insertion while memory remains
+    bounded. Raises RuntimeError if a worker fails or exits (eg, is
+    killed) before it has finished.
+    """
+
+    queue = multiprocessing.Queue(maxsize=queue_size)
+    pending = list(dump_files)
+    workers = {}
+
+    def start():
+        tablename, fname = pending.pop(0)
+        p = multiprocessing.Process(
+            target=_parse_worker,
+            args=(queue, archive, tablename, fname, root_name, maxrows, chunksize))
+        p.daemon = True
+        p.start()
+        workers[tablename] = p
+        log.info('parsing %s in process %s' % (fname, p.pid))
+
+    while pending and len(workers) < processes:
+        start()
+
+    # workers found to have exited while the queue was empty
+    exited = set()
+
+    cur = con.cursor()
+    try:
+        while workers:
+            try:
+                tablename, chunk = queue.get(timeout=parse_poll_interval)
+            except Empty:
+                # a worker that exits normally puts its last message
+                # on the queue first, so allow one more interval for
+                # it to arrive
+                for name, p in workers.items():
+                    if p.is_alive():
+                        continue
+                    if name in exited:
+                        raise RuntimeError('process parsing rows for table "%s" exited '
+                                           'with code %s' % (name, p.exitcode))
+                    exited.add(name)
+                continue
+
+            if isinstance(chunk, list):
+                cmd = 'INSERT INTO "%s" VALUES (%s)' % (tablename, ', '.join(['?']*len(chunk[0])))
+                cur.executemany(cmd, chunk)
+                continue
+
+            workers.pop(tablename).join()
+            if chunk is not None:
+                raise RuntimeError('error parsing rows for table "%s":\n%s' % (tablename, chunk))
+
+            log.info('finished loading table "%s"' % tablename)
+            if commit:
+                con.commit()
+            if pending:
+                start()
+    finally:
+        for p in workers.values():
+            p.terminate()
+
+def do_insert(con, tablename, rows, maxrows=None, commit=True):
 
     cur = con.cursor()
 
@@ -165,7 +744,8 @@ def do_insert(con, tablename, rows, maxrows=None):
         rows = itertools.islice(rows, maxrows)
 
     cur.executemany(cmd, rows)
-    con.commit()
+    if commit:
+        con.commit()
 
 def fetch_data(dest_dir='.', new=False, url=ncbi_data_url):
 
@@ -206,21 +786,43 @@ def fetch_data(dest_dir='.', new=False, url=ncbi_data_url):
 
     return fout
 
-def read_archive(archive, fname):
+def _split_lines(lines):
+    """
+    Return an iterator of rows (lists of fields) from an iterator of
+    lines in NCBI's .dmp format.
+    """
+
+    for line in lines:
+        yield line.rstrip('\t|\r\n').split('\t|\t')
+
+def read_archive(archive, fname, bufsize=read_bufsize):
     """
-    Return an iterator of rows from a zip archive.
+    Return an iterator of rows from a zip archive. The compressed
+    file is decompressed incrementally, so memory use is bounded by
+    the size of the read buffer rather than the size of the file.
 
     * archive - path to the zip archive.
     * fname - name of the compressed file within the archive.
+    * bufsize - size in bytes of the read buffer.
     """
 
-    zfile = zipfile.ZipFile(archive, 'r')
-    for line in zfile.read(fname).splitlines():
-        yield line.rstrip('\t|\n').split('\t|\t')
+    with contextlib.closing(zipfile.ZipFile(archive, 'r')) as zfile:
+        with contextlib.closing(zfile.open(fname)) as member:
+            lines = io.BufferedReader(member, buffer_size=bufsize)
+            for row in _split_lines(lines):
+                yield row
+
+def read_dmp(fname, bufsize=read_bufsize):
+    """
+    Return an iterator of rows from an uncompressed .dmp file.
+
+    * fname - path to the file.
+    * bufsize - size in bytes of the read buffer.
+    """
 
-def read_dmp(fname):
-    for line in open(fname,'rU'):
-        yield line.rstrip('\t|\n').split('\t|\t')
+    with open(fname, 'rb', bufsize) as lines:
+        for row in _split_lines(lines):
+            yield row
 
 def read_nodes(rows, root_name, ncbi_source_id):
 
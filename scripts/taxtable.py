@@ -32,6 +32,7 @@ import gettext
 import logging
 import os
 import pprint
+import sqlite3
 import sys
 import textwrap
 
@@ -42,8 +43,6 @@ try:
 except ImportError:
     create_engine = None
     print("""\n\n** Warning: this script requires the sqlalchemy package for some features; see "Installation." **\n""")
-else:
-    from sqlalchemy.exc import IntegrityError
 
 import Taxonomy
 
@@ -75,7 +74,14 @@ def main():
         dest_dir = '.',
         dbfile = 'ncbi_taxonomy.db',
         new_database = False,
-        source_name = 'unknown',
+        update_database = False,
+        integer_ids = False,
+        ancestors = False,
+        intervals = False,
+        name_index = False,
+        preload_merged = False,
+        export_all = False,
+        format = 'csv',
         verbose=0
         )
 
@@ -101,18 +107,67 @@ def main():
         files if provided). [default %default]
         """))
 
+    parser.add_option("-U", "--update-database", action='store_true',
+                      dest="update_database", help=xws("""Include this
+        option to download the current NCBI taxonomy and apply only
+        the differences to an existing database, preserving nodes
+        from other sources. [default %default]
+        """))
+
+    parser.add_option("--integer-ids", action='store_true',
+                      dest="integer_ids", help=xws("""Store tax_ids as
+        integers when creating a new database, producing a smaller
+        and faster database. Custom nodes must have numeric
+        tax_ids. [default %default]"""))
+
+    parser.add_option("--ancestors", action='store_true',
+                      dest="ancestors", help=xws("""Precompute the
+        ancestors of every node when creating a new database so that
+        each lineage can be retrieved with a single query. [default %default]"""))
+
+    parser.add_option("--intervals", action='store_true',
+                      dest="intervals", help=xws("""Number the nodes in
+        depth-first order when creating a new database so that the
+        descendants of a node can be retrieved with a single range
+        scan. [default %default]"""))
+
+    parser.add_option("--name-index", action='store_true',
+                      dest="name_index", help=xws("""Index normalized
+        names when creating a new database so that names given using
+        -n are matched ignoring case and whitespace, and so that
+        misspelled names can be matched (see --approximate).
+        [default %default]"""))
+
+    parser.add_option("-j", "--processes", dest="processes", type="int",
+                      help=xws("""Number of processes used to parse the
+        downloaded archive when creating a new database. [default: parse
+        files sequentially]"""), metavar='N')
+
+    parser.add_option("--preload-merged", action='store_true',
+                      dest="preload_merged", help=xws("""Read the table of
+        merged tax_ids into memory so that obsolete tax_ids are replaced
+        without additional queries; useful when many of the tax_ids
+        provided are out of date. [default %default]"""))
+
     parser.add_option("-a", "--add-new-nodes", dest="new_nodes", help=xws("""
         An optional Excel (.xls) spreadsheet (requires xlrd) or
         csv-format file defining nodes to add to the
         taxonomy. Mandatory fields include
         "tax_id","parent_id","rank","tax_name"; optional fields
-        include "source_name", "source_id". Other columns are ignored.
+        include "source_name", "source_id"; rows without either
+        require -S/--source-name. Other columns are ignored.
     """))
 
     parser.add_option("-S", "--source-name", dest="source_name", help=xws("""
-        Names the source for new nodes. [default %default]
+        Names the source for new nodes that do not specify a
+        source_name or source_id.
     """))
 
+    parser.add_option("--snapshot", dest="snapshot", help=xws("""
+        Write a binary snapshot of the taxonomy (including any added
+        nodes) to FILENAME for use with Taxonomy.SnapshotTaxonomy.
+    """), metavar='FILENAME')
+
     parser.add_option("-t", "--tax-ids", dest="taxids", help=xws("""
         A comma delimited list of tax_ids or the name of a file
         specifying tax_ids (whitespace-delimited; lines beginning with
@@ -122,15 +177,42 @@ def main():
     parser.add_option("-n", "--tax-names", dest="taxnames", help=xws("""
         An optional file containing a list of taxonomic names to
         match against primary names and synonyms as a source
-        of tax_ids. Lines beginning with # are ignored.
+        of tax_ids (see --name-index). Lines beginning with # are ignored.
+        Exits with an error if any name is not found.
     """))
 
+    parser.add_option("--approximate", dest="min_score", type="float",
+                      metavar="SCORE", help=xws("""Accept approximate
+        matches to names given using -n with a score of at least
+        SCORE, between 0 and 1 (1 - edit distance / length of the
+        longer name; eg, 0.9 allows one edit in ten characters).
+        Requires a database created using --name-index. Approximate
+        matches are reported."""))
+
+    parser.add_option("--all", action='store_true',
+                      dest="export_all", help=xws("""Write the lineage of
+        every node in the taxonomy (in depth-first order) instead of
+        the lineages of the specified taxa; -t and -n are ignored.
+        [default %default]"""))
+
+    parser.add_option("-f", "--format", dest="format", type="choice",
+                      choices=['csv', 'columnar'], help=xws("""Output
+        format: "csv" or "columnar" (a directory of .npy files readable
+        by numpy; see Taxonomy.columnar), which requires --outfile to
+        name the directory. [default %default]"""))
+
     parser.add_option("-v", "--verbose",
         action="count", dest="verbose",
         help="increase verbosity of screen output (eg, -v is verbose, -vv more so)")
 
     (options, args) = parser.parse_args()
 
+    if options.format == 'columnar' and not options.outfile:
+        parser.error('--format=columnar requires --outfile')
+
+    if options.min_score is not None and not 0 < options.min_score <= 1:
+        parser.error('--approximate requires a score between 0 and 1')
+
     loglevel = {
         0:logging.WARNING,
         1:logging.INFO,
@@ -146,15 +228,26 @@ def main():
     # set up logging
     logging.basicConfig(file=sys.stdout, format=logformat, level=loglevel)
 
-    zfile = Taxonomy.ncbi.fetch_data(dest_dir=options.dest_dir, new=False)
+    zfile = Taxonomy.ncbi.fetch_data(dest_dir=options.dest_dir, new=options.update_database)
 
     pth, fname = os.path.split(options.dbfile)
     dbname = options.dbfile if pth else os.path.join(options.dest_dir, fname)
 
     if not os.access(dbname, os.F_OK) or options.new_database:
         log.warning('creating new database in %s using data in %s' % (dbname, zfile))
-        con = Taxonomy.ncbi.db_connect(dbname, new=True)
-        Taxonomy.ncbi.db_load(con, zfile)
+        if options.integer_ids:
+            tables, indexes = Taxonomy.ncbi.db_tables_integer, Taxonomy.ncbi.db_indexes_integer
+        else:
+            tables, indexes = Taxonomy.ncbi.db_tables, Taxonomy.ncbi.db_indexes
+        con = Taxonomy.ncbi.db_connect(dbname, schema=tables, new=True)
+        Taxonomy.ncbi.db_load(con, zfile, bulk=True, indexes=indexes,
+                              processes=options.processes, ancestors=options.ancestors,
+                              intervals=options.intervals, name_index=options.name_index)
+        con.close()
+    elif options.update_database:
+        log.warning('updating database %s using data in %s' % (dbname, zfile))
+        con = sqlite3.connect(dbname)
+        Taxonomy.ncbi.db_update(con, zfile)
         con.close()
     else:
         log.warning('using taxonomy defined in %s' % dbname)
@@ -163,25 +256,36 @@ def main():
         sys.exit('sqlalchemy is required, exiting.')
 
     engine = create_engine('sqlite:///%s' % dbname, echo = options.verbose > 1)
-    tax = Taxonomy.Taxonomy(engine, Taxonomy.ncbi.ranks)
+    tax = Taxonomy.Taxonomy(engine, Taxonomy.ncbi.ranks,
+                            preload_merged=options.preload_merged)
 
     # add nodes if necessary
     if options.new_nodes:
         log.warning('adding new nodes')
-        new_nodes = Taxonomy.utils.get_new_nodes(options.new_nodes)
-        for d in new_nodes:
-            if options.source_name:
-                d['source_name'] = options.source_name
-                try:
-                    tax.add_node(**d)
-                except IntegrityError:
-                    log.info('node with tax_id %(tax_id)s already exists' % d)
+        new_nodes = list(Taxonomy.utils.get_new_nodes(options.new_nodes))
+        unsourced = [d['tax_id'] for d in new_nodes
+                     if not (d.get('source_name') or d.get('source_id'))]
+        if unsourced and not options.source_name:
+            sys.exit('Error: -S/--source-name is required for nodes without '
+                     'a source_name or source_id (tax_ids %s)' % ', '.join(unsourced))
+        # nodes with a source of their own keep it; compute lineages
+        # so that the new nodes are written to the table
+        try:
+            tax.add_nodes(new_nodes, source_name=options.source_name,
+                          skip_existing=True, lineages=True)
+        except (KeyError, ValueError), err:
+            sys.exit('Error: %s' % err.args[0])
+
+    if options.snapshot:
+        log.warning('writing snapshot to %s' % options.snapshot)
+        Taxonomy.snapshot.write_snapshot(
+            Taxonomy.MemoryTaxonomy(engine, Taxonomy.ncbi.ranks), options.snapshot)
 
     # get a list of taxa
     taxa = set()
 
     taxids = options.taxids
-    if taxids:
+    if taxids and not options.export_all:
         if os.access(taxids, os.F_OK):
             log.warning('reading tax_ids from %s' % taxids)
             for line in getlines(taxids):
@@ -190,27 +294,30 @@ def main():
             taxa = set([x.strip() for x in taxids.split(',')])
 
     taxnames = options.taxnames
-    if taxnames:
-        for tax_name in getlines(taxnames):
-            tax_id, primary_name, is_primary = tax.primary_from_name(tax_name)
-            taxa.add(tax_id)
-            if not is_primary:
-                log.warning('%(tax_id)8s  %(tax_name)40s -(primary name)-> %(primary_name)s' % locals())
-            
-    log.warning('calculating lineages for %s taxa' % len(taxa))
-    for taxid in taxa:
-        log.warning('adding %s' % taxid)
-        tax.lineage(taxid)
+    if taxnames and not options.export_all:
+        try:
+            taxa.update(Taxonomy.utils.tax_ids_from_names(
+                    tax, getlines(taxnames), min_score=options.min_score))
+        except KeyError, err:
+            sys.exit('Error: %s' % err.args[0])
+
+    if not options.export_all:
+        log.warning('calculating lineages for %s taxa' % len(taxa))
+        tax.lineages(taxa)
 
     if options.outfile:
         pth, fname = os.path.split(options.outfile)
         csvname = options.outfile if pth else os.path.join(options.dest_dir, fname)
         log.warning('writing %s' % csvname)
-        csvfile = open(csvname, 'w')
+        csvfile = csvname if options.format == 'columnar' else open(csvname, 'w')
     else:
         csvfile = sys.stdout
 
-    tax.write_table(None, csvfile = csvfile)
+    if options.export_all:
+        log.warning('writing lineages of all taxa')
+        tax.export_all(csvfile, format = options.format)
+    else:
+        tax.write_table(None, csvfile = csvfile, format = options.format)
 
     engine.dispose()
 
@@ -0,0 +1,397 @@
+"""
+A read-only binary snapshot of the taxonomy that is accessed through
+mmap, so that processes reading the same snapshot share a single copy
+in the page cache.
+
+File format (version 1; all integers little-endian):
+
+* header - magic string 'TAXSNAP\\0', format version (uint32),
+  integer_ids flag (uint32), number of sections (uint32), followed by
+  (offset, count) pairs (two uint64) for each section in `sections`.
+* sections - each section is either an array of `count` fixed-width
+  values, or a table of `count` strings stored as count + 1 uint64
+  offsets followed by the concatenated utf-8 strings (string i occupies
+  bytes offsets[i]:offsets[i+1] of the string data).
+
+Nodes are identified by their index in the arrays "parents",
+"rank_codes", "has_name", "names" (primary name) and "ids"
+(tax_id). "id_order" lists node indices in order of tax_id to support
+lookup by binary search; "merged_old" is sorted and "merged_new" holds
+the index of the corresponding node. "all_names" lists every name in
+table "names" in sorted order with the index of its node and its
+is_primary flag; "all_names_by_node" orders the same names by node.
+"""
+
+import array
+import mmap
+import logging
+import os
+import struct
+import sys
+import threading
+import zlib
+
+log = logging
+
+from sqlalchemy.sql import select
+
+from cache import LRUCache, StripedLRUCache
+from memory import MemoryTaxonomy
+
+magic = 'TAXSNAP\x00'
+version = 1
+
+# (name, format) for each section; format is a struct format character
+# for arrays, or 's' for tables of strings
+sections = [
+    ('parents', 'i'),
+    ('rank_codes', 'H'),
+    ('has_name', 'B'),
+    ('names', 's'),
+    ('ids', 's'),
+    ('id_order', 'i'),
+    ('rank_names', 's'),
+    ('merged_old', 's'),
+    ('merged_new', 'i'),
+    ('all_names', 's'),
+    ('all_names_node', 'i'),
+    ('all_names_primary', 'B'),
+    ('all_names_by_node', 'i'),
+    ]
+
+_header = struct.Struct('<8sIII')
+_section = struct.Struct('<QQ')
+
+def _encode(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else str(s)
+
+def _write_array(fobj, typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    a.tofile(fobj)
+    return len(a)
+
+def _write_strings(fobj, strings, chunksize=10000):
+    # the array module does not support 64-bit integers in python 2
+    offset, offsets = 0, [0]
+    for s in strings:
+        offset += len(s)
+        offsets.append(offset)
+    for i in xrange(0, len(offsets), chunksize):
+        chunk = offsets[i:i + chunksize]
+        fobj.write(struct.pack('<%sQ' % len(chunk), *chunk))
+    for s in strings:
+        fobj.write(s)
+    return len(strings)
+
+def write_snapshot(tax, fname):
+    """
+    Write the contents of the MemoryTaxonomy instance tax to the
+    file fname.
+    """
+
+    n = len(tax._ids)
+    ids = [_encode(tax_id) for tax_id in tax._ids]
+    names = [_encode(tax._name(i) or '') for i in xrange(n)]
+
+    merged = sorted((_encode(old), tax._lookup(new)) for old, new in tax._merged.items()
+                    if new in tax._index)
+
+    names_table = tax.names
+    all_names = []
+    s = select([names_table.c.tax_name, names_table.c.tax_id, names_table.c.is_primary])
+    for row in s.execute():
+        i = tax._index.get(tax._api_id(row[1]))
+        if i is not None:
+            all_names.append((_encode(row[0]), i, 1 if row[2] else 0))
+    all_names.sort()
+
+    contents = {
+        'parents': tax._parents,
+        'rank_codes': tax._rank_codes,
+        'has_name': tax._has_name,
+        'names': names,
+        'ids': ids,
+        'id_order': sorted(xrange(n), key=ids.__getitem__),
+        'rank_names': [_encode(rank) for rank in tax._rank_names],
+        'merged_old': [old for old, new in merged],
+        'merged_new': [new for old, new in merged],
+        'all_names': [name for name, i, is_primary in all_names],
+        'all_names_node': [i for name, i, is_primary in all_names],
+        'all_names_primary': [is_primary for name, i, is_primary in all_names],
+        'all_names_by_node': sorted(xrange(len(all_names)), key=lambda j: all_names[j][1]),
+        }
+
+    log.info('writing snapshot of %s nodes to %s' % (n, fname))
+    with open(fname, 'wb') as fobj:
+        # reserve space for the header
+        fobj.write('\x00' * (_header.size + _section.size * len(sections)))
+
+        table = []
+        for name, fmt in sections:
+            offset = fobj.tell()
+            if fmt == 's':
+                count = _write_strings(fobj, contents[name])
+            else:
+                count = _write_array(fobj, fmt, contents[name])
+            table.append((offset, count))
+
+        fobj.seek(0)
+        fobj.write(_header.pack(magic, version, int(tax.integer_ids), len(sections)))
+        for offset, count in table:
+            fobj.write(_section.pack(offset, count))
+
+class _Array(object):
+    """
+    A read-only array of fixed-width values in a buffer.
+    """
+
+    def __init__(self, buf, offset, count, fmt):
+        self.buf, self.offset, self.count = buf, offset, count
+        self.item = struct.Struct('<' + fmt)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.item.unpack_from(self.buf, self.offset + i * self.item.size)[0]
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def data(self):
+        """
+        Returns the bytes of the array.
+        """
+
+        return self.buf[self.offset:self.offset + self.count * self.item.size]
+
+class _Strings(object):
+    """
+    A read-only table of byte strings in a buffer.
+    """
+
+    def __init__(self, buf, offset, count):
+        self.buf, self.count = buf, count
+        self.offsets = _Array(buf, offset, count + 1, 'Q')
+        self.start = offset + 8 * (count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        offsets = self.offsets
+        return self.buf[self.start + offsets[i]:self.start + offsets[i+1]]
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def data(self):
+        """
+        Returns the bytes of the table, including the offsets.
+        """
+
+        return self.buf[self.offsets.offset:self.start + self.offsets[self.count]]
+
+    def search(self, s, order=None):
+        """
+        Returns the position of the first string equal to or greater
+        than s in the table, which is sorted (or in the order defined
+        by the sequence of positions `order`).
+        """
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[order[mid] if order is not None else mid] < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+class _Names(object):
+    """
+    Emulates MemoryTaxonomy._name_heap for the primary names.
+    """
+
+    def __init__(self, strings):
+        self.strings = strings
+
+    def __getitem__(self, key):
+        start = self.strings.start
+        return self.strings.buf[start + key.start:start + key.stop]
+
+class _Index(object):
+    """
+    Emulates the dict MemoryTaxonomy._index ({tax_id: index}).
+    """
+
+    def __init__(self, ids, order):
+        self.ids, self.order = ids, order
+
+    def get(self, tax_id, default=None):
+        key = _encode(tax_id)
+        pos = self.ids.search(key, self.order)
+        if pos < len(self.order) and self.ids[self.order[pos]] == key:
+            return self.order[pos]
+        return default
+
+    def __contains__(self, tax_id):
+        return self.get(tax_id) is not None
+
+class _Merged(object):
+    """
+    Emulates the dict MemoryTaxonomy._merged ({old_tax_id: new_tax_id}).
+    """
+
+    def __init__(self, old, new, ids):
+        self.old, self.new, self.ids = old, new, ids
+
+    def get(self, tax_id, default=None):
+        key = _encode(tax_id)
+        pos = self.old.search(key)
+        if pos < len(self.old) and self.old[pos] == key:
+            return self.ids[self.new[pos]]
+        return default
+
+    def items(self):
+        return [(old, self.ids[new]) for old, new in zip(self.old, self.new)]
+
+class SnapshotTaxonomy(MemoryTaxonomy):
+
+    def __init__(self, fname, ranks, undefined_rank='no_rank', undef_prefix='below',
+                 cache=None, threadsafe=False, track_requested=None):
+        """
+        A read-only MemoryTaxonomy backed by a snapshot written by
+        write_snapshot. The file is mapped into memory rather than
+        read, so creating an instance is fast and the data is shared
+        among processes. Does not require a database connection.
+
+        * fname - path to the snapshot.
+
+        See Taxonomy for a description of the remaining arguments.
+        """
+
+        self.fname = fname
+        with open(fname, 'rb') as fobj:
+            self._buf = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(fobj.fileno())
+        # see MemoryTaxonomy._lca_file
+        self._source_key = stat.st_mtime, stat.st_size
+
+        buf = self._buf
+        _magic, _version, integer_ids, nsections = _header.unpack_from(buf, 0)
+        if _magic != magic:
+            raise ValueError('%s is not a taxonomy snapshot' % fname)
+        if _version != version or nsections != len(sections):
+            raise ValueError('%s has unsupported snapshot version %s' % (fname, _version))
+
+        data = {}
+        for i, (name, fmt) in enumerate(sections):
+            offset, count = _section.unpack_from(buf, _header.size + i * _section.size)
+            data[name] = _Strings(buf, offset, count) if fmt == 's' else _Array(buf, offset, count, fmt)
+
+        self.engine = None
+        self.integer_ids = bool(integer_ids)
+        self.ancestors = None
+        self.name_index = None
+        self.preload_merged = True
+
+        self.threadsafe = threadsafe
+        self.ranks = list(ranks)
+        self.rankset = set(self.ranks)
+        self._rank_lock = threading.Lock()
+        cache_class = StripedLRUCache if threadsafe else LRUCache
+        self.cached = cache if cache is not None else cache_class()
+        self._init_requested(track_requested)
+        self.undefined_rank = undefined_rank
+        self.undef_prefix = undef_prefix
+
+        self._ids = data['ids']
+        self._index = _Index(data['ids'], data['id_order'])
+        self._parents = data['parents']
+        self._rank_names = [rank.decode('utf-8') for rank in data['rank_names']]
+        self._rank_codes = data['rank_codes']
+        self._has_name = data['has_name']
+        self._name_offsets = data['names'].offsets
+        self._name_heap = _Names(data['names'])
+        self._merged = _Merged(data['merged_old'], data['merged_new'], data['ids'])
+
+        self._all_names = data['all_names']
+        self._all_names_node = data['all_names_node']
+        self._all_names_primary = data['all_names_primary']
+        self._all_names_by_node = data['all_names_by_node']
+
+        self._reset_derived()
+
+    def close(self):
+        self._buf.close()
+
+    def _lca_file(self):
+        return self.fname + '.lca', self._source_key
+
+    def _lca_checksum(self):
+        # computed from the sections, which avoids reading each node
+        crc = zlib.crc32(self._parents.data())
+        return zlib.crc32(self._ids.data(), crc) & 0xffffffff
+
+    def primary_from_name(self, tax_name):
+        """
+        Return tax_id and primary tax_name corresponding to tax_name.
+        """
+
+        key = _encode(tax_name)
+        pos = self._all_names.search(key)
+        if pos == len(self._all_names) or self._all_names[pos] != key:
+            raise KeyError('"%s" not found in names.tax_names' % tax_name)
+
+        i = self._all_names_node[pos]
+        is_primary = bool(self._all_names_primary[pos])
+        if not is_primary:
+            tax_name = self._name(i)
+
+        return self._tax_id(i), tax_name, is_primary
+
+    def synonyms(self, tax_id=None, tax_name=None):
+        if not bool(tax_id) ^ bool(tax_name):
+            raise ValueError('Exactly one of tax_id and tax_name may be provided.')
+
+        if tax_name:
+            tax_id = self.primary_from_name(tax_name)[0]
+
+        i = self._index.get(tax_id)
+        order, nodes = self._all_names_by_node, self._all_names_node
+
+        # binary search for the first name of node i
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if nodes[order[mid]] < i:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        output = []
+        while i is not None and lo < len(order) and nodes[order[lo]] == i:
+            j = order[lo]
+            output.append((self._all_names[j].decode('utf-8'), self._all_names_primary[j]))
+            lo += 1
+
+        if not output:
+            raise KeyError('"%s" not found in names.tax_id' % tax_id)
+
+        return output
+
+    def add_source(self, name, description=None):
+        raise ValueError('SnapshotTaxonomy is read-only')
+
+    def add_node(self, *args, **kwargs):
+        raise ValueError('SnapshotTaxonomy is read-only')
+
+    def add_nodes(self, *args, **kwargs):
+        raise ValueError('SnapshotTaxonomy is read-only')
@@ -1,20 +1,190 @@
 import logging
+import array
+import cPickle
 import csv
+import heapq
 import itertools
 import pprint
+import re
+import tempfile
+import threading
 
 log = logging
 
 import sqlalchemy
-from sqlalchemy import MetaData, create_engine, and_
+from sqlalchemy import MetaData, create_engine, and_, or_
 from sqlalchemy.sql import select
+from sqlalchemy.pool import QueuePool
 
 import newick
 
+import columnar
+from cache import LRUCache, StripedLRUCache
+from utils import normalize_name, edit_distance
+from ncbi import max_lineage_depth, _interval_rows
+
+# maximum number of values in a single IN (...) clause; sqlite limits
+# the number of parameters in a statement to 999 by default
+max_in_clause = 900
+
+# Taxonomy.add_nodes renumbers all of table "intervals" rather than
+# shifting it once for each parent of new nodes beyond this number
+max_interval_shifts = 50
+
+# number of connections kept open by an engine created for a
+# threadsafe Taxonomy (see threadsafe_engine)
+threadsafe_pool_size = 8
+
+# characters that require a label in a Newick string to be quoted
+_newick_special = re.compile(r"[\s()\[\]':;,]")
+
+# Selects the lineage of :tax_id, root first, by following parent_id;
+# max_depth stops the recursion if the nodes contain a cycle. Recursive
+# queries are wrapped in a SELECT because the sqlite3 module does not
+# describe the columns of an empty result of a statement beginning with
+# WITH, which sqlalchemy then treats as returning no rows.
+lineage_query = sqlalchemy.text("""
+SELECT tax_id, rank FROM (
+  WITH RECURSIVE chain(tax_id, parent_id, rank, depth) AS (
+    SELECT tax_id, parent_id, rank, 0 FROM nodes WHERE tax_id = :tax_id
+    UNION ALL
+    SELECT nodes.tax_id, nodes.parent_id, nodes.rank, chain.depth + 1
+    FROM nodes JOIN chain ON nodes.tax_id = chain.parent_id
+    WHERE chain.tax_id != chain.parent_id AND chain.depth < :max_depth
+  )
+  SELECT * FROM chain
+) ORDER BY depth DESC
+""")
+
+def _newick_label(label):
+    """
+    Returns label quoted if necessary for use in a Newick string.
+    """
+
+    if _newick_special.search(label):
+        return "'%s'" % label.replace("'", "''")
+    return label
+
+def _dump_run(items):
+    """
+    Writes items to a temporary file, which is returned; see _load_run.
+    """
+
+    fobj = tempfile.TemporaryFile()
+    for item in items:
+        cPickle.dump(item, fobj, cPickle.HIGHEST_PROTOCOL)
+    return fobj
+
+def _load_run(fobj):
+    """
+    Yields the items written to fobj by _dump_run.
+    """
+
+    fobj.seek(0)
+    while True:
+        try:
+            yield cPickle.load(fobj)
+        except EOFError:
+            break
+
+# names in table "name_index" whose key (or reversed key, rkey) is
+# in [lower, upper) and has a length in [shortest, longest], up to
+# limit names (see Taxonomy._name_candidates); %(n)s is appended to
+# the names of the parameters
+name_range_query = """
+SELECT key, tax_id, is_primary FROM name_index
+WHERE %(column)s >= :%(column)s_lower%(n)s AND %(column)s < :%(column)s_upper%(n)s
+  AND length(key) BETWEEN :shortest%(n)s AND :longest%(n)s
+LIMIT :limit%(n)s
+"""
+
+# the number of names in a range, up to limit
+name_count_queries = dict(
+    (column, sqlalchemy.text('SELECT count(*) FROM (%s)' %
+                             (name_range_query % {'column': column, 'n': ''})))
+    for column in ['key', 'rkey'])
+
+# the number of keys whose ranges are searched in a single query (see
+# _name_candidates_query); each key requires two compound SELECTs and
+# 12 parameters, within sqlite's limits of 500 and 999
+name_candidates_batch = 40
+
+# keys: number of keys, vals: query (see _name_candidates_query)
+_name_candidates_queries = {}
+
+def _name_candidates_query(count):
+    """
+    Returns a query for the names in both ranges (see
+    name_range_query) of each of count keys, labelled with the
+    position of the key and 0 (key) or 1 (rkey). The names of the
+    parameters of each key end with its position.
+    """
+
+    query = _name_candidates_queries.get(count)
+    if query is None:
+        parts = ['SELECT %s, %s, * FROM (%s)' % (i, side, name_range_query % {'column': column, 'n': i})
+                 for i in xrange(count) for side, column in enumerate(['key', 'rkey'])]
+        query = _name_candidates_queries[count] = sqlalchemy.text('\nUNION ALL\n'.join(parts))
+    return query
+
+def _prefix_bounds(prefix):
+    """
+    Returns (lower, upper) such that the non-empty unicode string s
+    begins with prefix if lower <= s < upper.
+    """
+
+    return prefix, prefix[:-1] + unichr(min(ord(prefix[-1]) + 1, 0xffff))
+
+def _starts_with(column, prefix):
+    """
+    Returns a clause selecting values of column beginning with the
+    unicode string prefix that can be satisfied using an index.
+    """
+
+    if not prefix:
+        return column != None
+    lower, upper = _prefix_bounds(prefix)
+    return and_(column >= lower, column < upper)
+
+def _chunks(seq, size):
+    """
+    Returns successive lists of up to size elements from the list seq.
+    """
+
+    return (seq[i:i + size] for i in xrange(0, len(seq), size))
+
+# marks a value absent from a cache (None marks a cached miss)
+_uncached = object()
+
+def _query_only(dbapi_con, connection_record):
+    dbapi_con.execute('PRAGMA query_only = ON')
+
+def threadsafe_engine(engine, pool_size=threadsafe_pool_size):
+    """
+    Returns an engine for the sqlite database of engine that can be
+    shared among threads: connections are taken from a pool of
+    pool_size connections (more are opened, then closed, while all
+    are in use) rather than opened for each statement, and are
+    read-only. Engines for other databases, whose pools are already
+    shared among threads, and for in-memory databases are returned
+    unchanged.
+    """
+
+    url = engine.url
+    if url.drivername.split('+')[0] != 'sqlite' or url.database in (None, '', ':memory:'):
+        return engine
+
+    new = create_engine(url, echo=engine.echo, poolclass=QueuePool,
+                        pool_size=pool_size, max_overflow=-1,
+                        connect_args={'check_same_thread': False})
+    sqlalchemy.event.listen(new, 'connect', _query_only)
+    return new
 
 class Taxonomy(object):
 
-    def __init__(self, engine, ranks, undefined_rank='no_rank', undef_prefix='below'):
+    def __init__(self, engine, ranks, undefined_rank='no_rank', undef_prefix='below',
+                 cache=None, name_cache_size=None, preload_merged=False,
+                 threadsafe=False, track_requested=None):
         """
         The Taxonomy class defines an object providing an interface to
         the taxonomy database.
@@ -26,10 +196,32 @@ class Taxonomy(object):
           a specific rank in the taxonomy.
         * undef_prefix - string prepended to name of parent
           rank to create new labels for undefined ranks.
+        * cache - a dict-like object used to cache lineages; the
+          default is an unbounded LRUCache. Provide an LRUCache with
+          a maxsize to limit memory use in long-running processes.
+        * name_cache_size - maximum number of entries in each of the
+          caches used by primary_from_id and primary_from_name, or
+          None for unbounded caches.
+        * preload_merged - if True, table "merged" is read into
+          memory on first use and merged tax_ids are replaced by
+          current ones before (rather than after a failed) query.
+        * threadsafe - if True, the object is read-only (add_source,
+          add_node and add_nodes raise ValueError) and may
+          be shared among threads: queries use a pool of read-only
+          connections (see threadsafe_engine) and the default caches
+          are StripedLRUCaches. A cache provided must be thread-safe.
+        * track_requested - if True, the tax_ids passed to lineage and
+          lineages are recorded in self.requested (a set that grows
+          for the life of the object) so that write_table can be
+          called without taxa. If False, self.requested is None and
+          taxa must be provided to write_table. The default (None)
+          is False if the cache has a maxsize or threadsafe is True,
+          and True otherwise.
 
         Example:
         > engine = create_engine('sqlite:///%s' % dbname, echo=False)
         > tax = Taxonomy(engine, Taxonomy.ncbi.ranks)
+        > tax = Taxonomy(engine, Taxonomy.ncbi.ranks, cache=LRUCache(maxsize=10000))
 
           """
 
@@ -41,6 +233,11 @@ class Taxonomy(object):
 
         log.debug('using database %s' % engine.url)
 
+        self.threadsafe = threadsafe
+        if threadsafe:
+            engine = threadsafe_engine(engine)
+        cache_class = StripedLRUCache if threadsafe else LRUCache
+
         self.engine = engine
         self.meta = MetaData()
         self.meta.bind = self.engine
@@ -51,12 +248,42 @@ class Taxonomy(object):
         self.names = self.meta.tables['names']
         self.source = self.meta.tables['source']
 
-        self.ranks = ranks
+        # optional table of precomputed lineages (see ncbi.build_ancestors)
+        self.ancestors = self.meta.tables.get('ancestors')
+
+        # optional table of nested-set intervals (see ncbi.build_intervals)
+        self.intervals = self.meta.tables.get('intervals')
+
+        # optional table of normalized names (see ncbi.build_name_index)
+        self.name_index = self.meta.tables.get('name_index')
+
+        # tax_ids may be stored as integers (see ncbi.db_schema_integer);
+        # if so, they are converted at the boundaries of the public
+        # interface so that tax_ids are always represented as strings
+        self.integer_ids = isinstance(self.nodes.c.tax_id.type, sqlalchemy.Integer)
+
+        # self.ranks is replaced rather than modified when a rank is
+        # added (see _add_rank)
+        self.ranks = list(ranks)
         self.rankset = set(self.ranks)
+        self._rank_lock = threading.Lock()
 
         # keys: tax_id
         # vals: lineage represented as a list of tuples: (rank, tax_id)
-        self.cached = {}
+        self.cached = cache if cache is not None else cache_class()
+
+        self._init_requested(track_requested)
+
+        # results of primary_from_id and primary_from_name; lookups
+        # that failed are cached as None
+        # keys: tax_id, vals: primary tax_name
+        self.cached_names = cache_class(maxsize=name_cache_size)
+        # keys: tax_name, vals: (tax_id, primary tax_name, is_primary)
+        self.cached_name_lookups = cache_class(maxsize=name_cache_size)
+
+        # keys: old_tax_id, vals: new_tax_id (see _merged_map)
+        self.preload_merged = preload_merged
+        self._preloaded_merged = None
 
         # keys: tax_id
         # vals: lineage represented as a dict of {rank:tax_id}
@@ -67,65 +294,164 @@ class Taxonomy(object):
 
     def _add_rank(self, rank, parent_rank):
         """
-        inserts rank into self.ranks.
+        inserts rank into self.ranks. A new list is assigned to
+        self.ranks so that other threads iterating over the old one
+        are not affected.
         """
 
-        if rank not in self.rankset:
-            self.ranks.insert(self.ranks.index(parent_rank) + 1, rank)
-        self.rankset = set(self.ranks)
+        if rank in self.rankset:
+            return
+
+        with self._rank_lock:
+            if rank not in self.rankset:
+                ranks = list(self.ranks)
+                ranks.insert(ranks.index(parent_rank) + 1, rank)
+                self.rankset = set(ranks)
+                self.ranks = ranks
+
+    def _init_requested(self, track_requested):
+        """
+        Creates self.requested (see __init__); requires self.cached
+        and self.threadsafe.
+        """
+
+        if track_requested is None:
+            track_requested = not self.threadsafe and getattr(self.cached, 'maxsize', None) is None
+
+        # tax_ids for which a lineage has been requested (see write_table)
+        self.requested = set() if track_requested else None
+        self._requested_lock = threading.Lock()
+
+    def _add_requested(self, tax_ids):
+        """
+        Adds tax_ids to self.requested, if requested tax_ids are recorded.
+        """
+
+        if self.requested is not None:
+            with self._requested_lock:
+                self.requested.update(tax_ids)
+
+    def _check_writable(self):
+        if self.threadsafe:
+            raise ValueError('a threadsafe Taxonomy is read-only')
+
+    def _db_id(self, tax_id, table='nodes'):
+        """
+        Returns tax_id in the representation used in the database.
+        """
+
+        if not self.integer_ids:
+            return tax_id
+
+        try:
+            return int(tax_id)
+        except (TypeError, ValueError):
+            raise KeyError('value "%s" not found in %s.tax_id' % (tax_id, table))
+
+    def _api_id(self, tax_id):
+        """
+        Returns a tax_id from the database as a string.
+        """
+
+        if self.integer_ids and tax_id is not None:
+            return str(tax_id)
+        return tax_id
+
+    def _db_ids(self, tax_ids, table='nodes'):
+        """
+        Returns a list of tax_ids in the representation used in the
+        database, omitting any that cannot be represented.
+        """
+
+        output = []
+        for tax_id in tax_ids:
+            try:
+                output.append(self._db_id(tax_id, table))
+            except KeyError:
+                pass
+        return output
 
     def _node(self, tax_id, retry = True):
         """
         Returns parent, rank
         """
 
+        if retry and self.preload_merged:
+            new_tax_id = self._merged_id(tax_id)
+            if new_tax_id is not None:
+                return self._node(new_tax_id, retry = False)
+            retry = False
+
         s = select([self.nodes.c.parent_id, self.nodes.c.rank],
-                   self.nodes.c.tax_id == tax_id)
+                   self.nodes.c.tax_id == self._db_id(tax_id))
         res = s.execute()
         output = res.fetchone()
 
         if not output:
 
             if retry:
-                s = select([self.merged.c.new_tax_id],
-                           self.merged.c.old_tax_id == tax_id)
-                res = s.execute()
-                new_tax_id = res.fetchone()
+                new_tax_id = self._merged_id(tax_id)
 
-                if not new_tax_id:
+                if new_tax_id is None:
                     raise KeyError('value "%s" not found in nodes.tax_id' % tax_id)
 
-                return self._node(new_tax_id[0], retry = False)
+                return self._node(new_tax_id, retry = False)
 
             else:
                 raise KeyError('value "%s" not found in nodes.tax_id' % tax_id)
 
 
         # parent_id, rank
-        return output
+        parent_id, rank = output
+        return self._api_id(parent_id), rank
 
     def primary_from_id(self, tax_id, retry = True):
         """
         Returns primary taxonomic name associated with tax_id
         """
 
+        tax_name = self.cached_names.get(tax_id, _uncached) if retry else _uncached
+
+        if tax_name is _uncached:
+            try:
+                tax_name = self._primary_from_id(tax_id, retry)
+            except KeyError:
+                tax_name = None
+            if retry:
+                self.cached_names[tax_id] = tax_name
+
+        if tax_name is None:
+            raise KeyError('value "%s" not found in names.tax_id' % tax_id)
+
+        return tax_name
+
+    def _primary_from_id(self, tax_id, retry = True):
+        """
+        Returns primary taxonomic name associated with tax_id from the
+        database.
+        """
+
+        if retry and self.preload_merged:
+            new_tax_id = self._merged_id(tax_id)
+            if new_tax_id is not None:
+                return self._primary_from_id(new_tax_id, retry = False)
+            retry = False
+
         s = select([self.names.c.tax_name],
-                   and_(self.names.c.tax_id == tax_id, self.names.c.is_primary == 1))
+                   and_(self.names.c.tax_id == self._db_id(tax_id, 'names'),
+                        self.names.c.is_primary == 1))
         res = s.execute()
         output = res.fetchone()
 
         if not output:
 
             if retry:
-                s = select([self.merged.c.new_tax_id],
-                           self.merged.c.old_tax_id == tax_id)
-                res = s.execute()
-                new_tax_id = res.fetchone()
+                new_tax_id = self._merged_id(tax_id)
 
-                if not new_tax_id:
+                if new_tax_id is None:
                     raise KeyError('value "%s" not found in names.tax_id' % tax_id)
 
-                return self.primary_from_id(new_tax_id[0], retry = False)
+                return self._primary_from_id(new_tax_id, retry = False)
             else:
                 raise KeyError('value "%s" not found in names.tax_id' % tax_id)
 
@@ -137,6 +463,26 @@ class Taxonomy(object):
         Return tax_id and primary tax_name corresponding to tax_name.
         """
 
+        result = self.cached_name_lookups.get(tax_name, _uncached)
+
+        if result is _uncached:
+            try:
+                result = self._primary_from_name(tax_name)
+            except KeyError:
+                result = None
+            self.cached_name_lookups[tax_name] = result
+
+        if result is None:
+            raise KeyError('"%s" not found in names.tax_names' % tax_name)
+
+        return result
+
+    def _primary_from_name(self, tax_name):
+        """
+        Return tax_id and primary tax_name corresponding to tax_name
+        from the database.
+        """
+
         names = self.names
 
         s1 = select([names.c.tax_id, names.c.is_primary], names.c.tax_name == tax_name)
@@ -147,58 +493,377 @@ class Taxonomy(object):
         else:
             raise KeyError('"%s" not found in names.tax_names' % tax_name)
 
+        tax_id = self._api_id(tax_id)
+
         if not is_primary:
             s2 = select([names.c.tax_name],
-                        and_(names.c.tax_id == tax_id, names.c.is_primary == 1))
+                        and_(names.c.tax_id == self._db_id(tax_id, 'names'),
+                             names.c.is_primary == 1))
             tax_name = s2.execute().fetchone()[0]
 
         return tax_id, tax_name, bool(is_primary)
 
 
-    def _get_lineage(self, tax_id, _level=0):
+    def search_names(self, prefix, limit=None):
         """
-        Returns cached lineage from self.cached or recursively builds
-        lineage of tax_id until the root node is reached.
+        Returns a list of (tax_id, tax_name, is_primary) for each
+        name in table "names" that begins with prefix, ignoring
+        differences in case and whitespace (see
+        utils.normalize_name), ordered by name. Returns at most limit
+        names if limit is provided. Requires table "name_index".
         """
 
-        indent = '.'*_level
+        n = self._require_name_index()
+        s = select([n.c.tax_id, n.c.tax_name, n.c.is_primary],
+                   _starts_with(n.c.key, normalize_name(prefix))).order_by(n.c.key)
+        if limit:
+            s = s.limit(limit)
 
-        undefined = self.undefined_rank
-        prefix = self.undef_prefix+'_'
+        return [(self._api_id(tax_id), tax_name, bool(is_primary))
+                for tax_id, tax_name, is_primary in s.execute()]
+
+    def resolve_names(self, tax_names, max_distance=2):
+        """
+        Returns a list containing, for each of tax_names, the best
+        match in table "names" as (tax_id, primary tax_name,
+        is_primary, score) (see primary_from_name), or None if
+        there is no match.
+
+        * tax_names - a sequence of names
+        * max_distance - the largest edit distance allowed between
+          the normalized forms (see utils.normalize_name) of a name
+          and its match; 0 allows only exact matches.
+
+        score is 1.0 for names that match apart from differences in
+        case and whitespace, or otherwise 1 - d / n, where d is the
+        edit distance and n the length of the longer name. Names
+        matching exactly are found for the whole batch at once; see
+        _name_candidates for the approximate search. Among equally
+        good matches, primary names are preferred. Without table
+        "name_index", only names matching exactly are found.
+        """
+
+        tax_names = list(tax_names)
+
+        if self.name_index is None:
+            output = []
+            for tax_name in tax_names:
+                try:
+                    tax_id, primary_name, is_primary = self.primary_from_name(tax_name)
+                except KeyError:
+                    output.append(None)
+                else:
+                    output.append((tax_id, primary_name, is_primary, 1.0))
+            return output
+
+        n = self.name_index
+        keys = dict((tax_name, normalize_name(tax_name)) for tax_name in set(tax_names))
+
+        # keys: normalized name, vals: (score, is_primary, tax_id)
+        best = {}
+        for chunk in _chunks(list(set(keys.values())), max_in_clause):
+            s = select([n.c.key, n.c.tax_id, n.c.is_primary], n.c.key.in_(chunk))
+            for key, tax_id, is_primary in s.execute():
+                best[key] = max(best.get(key), (1.0, bool(is_primary), self._api_id(tax_id)))
+
+        unmatched = [key for key in set(keys.values()) - set(best) if len(key) >= 2]
+        candidates = self._name_candidates(unmatched, max_distance) if max_distance > 0 else {}
+        for key, found in candidates.items():
+            for candidate, tax_id, is_primary in found:
+                d = edit_distance(key, candidate, max_distance)
+                if d <= max_distance:
+                    score = 1.0 - float(d) / max(len(key), len(candidate))
+                    best[key] = max(best.get(key), (score, bool(is_primary), self._api_id(tax_id)))
+
+        primary_names = self._primary_names(tax_id for score, is_primary, tax_id in best.values())
+
+        output = []
+        for tax_name in tax_names:
+            match = best.get(keys[tax_name])
+            if match is None or match[2] not in primary_names:
+                output.append(None)
+            else:
+                score, is_primary, tax_id = match
+                output.append((tax_id, primary_names[tax_id], is_primary, score))
+
+        return output
+
+    def _name_candidates(self, keys, max_distance, limit=200):
+        """
+        Returns a dict of {key: set of (key, tax_id, is_primary)}
+        containing, for each of keys, the names in table
+        "name_index" beginning with key[:m] or ending with key[m:]
+        with lengths within max_distance of key's. For any m, every
+        name one edit away from key is among them, as are names
+        further away that differ from key on only one side of m.
+
+        m is initially the middle of each key, and the names for
+        name_candidates_batch keys are fetched using a single query.
+        Since names often share long prefixes (eg, "uncultured
+        bacterium") or suffixes, m is then chosen by bisection for
+        each key with more than limit names on either side so that
+        neither side exceeds limit names where possible; otherwise,
+        only limit names are used from that side.
+        """
+
+        execute = self.engine.execute
+
+        def params(key, m, limit, n=''):
+            key_lower, key_upper = _prefix_bounds(key[:m])
+            rkey_lower, rkey_upper = _prefix_bounds(key[m:][::-1])
+            values = dict(key_lower=key_lower, key_upper=key_upper,
+                          rkey_lower=rkey_lower, rkey_upper=rkey_upper, limit=limit,
+                          shortest=len(key) - max_distance, longest=len(key) + max_distance)
+            return dict((name + n, value) for name, value in values.items())
+
+        def fetch(pairs):
+            # returns (prefixed, suffixed) for each (key, m) in
+            # pairs, each holding up to limit + 1 names
+            output = []
+            for chunk in _chunks(pairs, name_candidates_batch):
+                found = [([], []) for pair in chunk]
+                bound = {}
+                for i, (key, m) in enumerate(chunk):
+                    bound.update(params(key, m, limit + 1, str(i)))
+                for row in execute(_name_candidates_query(len(chunk)), **bound):
+                    found[row[0]][row[1]].append(tuple(row[2:]))
+                output.extend(found)
+            return output
+
+        def count(key, m, column):
+            return execute(name_count_queries[column], **params(key, m, limit + 1)).scalar()
+
+        def bisect(key):
+            lo, hi = 1, len(key) - 1
+            while lo < hi:
+                m = (lo + hi) // 2
+                p, s = count(key, m, 'key'), count(key, m, 'rkey')
+                if p > limit and s <= limit:
+                    lo = m + 1
+                elif s > limit and p <= limit:
+                    hi = m - 1
+                else:
+                    lo = hi = m
+            return lo
+
+        keys = list(keys)
+        output = {}
+        crowded = []
+
+        # usually both halves of the key are specific enough
+        for key, (prefixed, suffixed) in zip(keys, fetch([(key, len(key) // 2) for key in keys])):
+            if len(prefixed) > limit or len(suffixed) > limit:
+                crowded.append(key)
+            else:
+                output[key] = set(prefixed) | set(suffixed)
+
+        pairs = [(key, bisect(key)) for key in crowded]
+        for key, (prefixed, suffixed) in zip(crowded, fetch(pairs)):
+            if len(prefixed) > limit or len(suffixed) > limit:
+                log.info('more than %s names resemble "%s"; using %s of them' % (limit, key, limit))
+            output[key] = set(prefixed[:limit]) | set(suffixed[:limit])
+
+        return output
+
+    def _require_name_index(self):
+        if self.name_index is None:
+            raise ValueError('table "name_index" is required (see ncbi.build_name_index)')
+        return self.name_index
+
+    def _get_lineage(self, tax_id):
+        """
+        Returns cached lineage from self.cached or retrieves the
+        lineage of tax_id. Requires a single query if table
+        "ancestors" is available, otherwise one query for the node
+        and, unless the lineage of its parent is cached, a second
+        (recursive) query for its ancestors.
+        """
 
         lineage = self.cached.get(tax_id)
 
         if lineage:
-            log.info('%(indent)s tax_id "%(tax_id)s" is cached' % locals())
+            log.info('tax_id "%(tax_id)s" is cached' % locals())
+            return lineage
+
+        start = 0
+        if self.ancestors is not None:
+            log.info('fetching lineage of tax_id "%(tax_id)s"' % locals())
+            lineage = self._fetch_lineage(tax_id)
         else:
-            log.info('%(indent)s reconstructing lineage of tax_id "%(tax_id)s"' % locals())
             parent_id, rank = self._node(tax_id)
-            lineage = [(rank, tax_id)]
+            if parent_id == tax_id:
+                lineage = []
+            else:
+                lineage = self.cached.get(parent_id)
+                if lineage:
+                    log.info('lineage of parent "%(parent_id)s" is cached' % locals())
+                    start = len(lineage)
+                else:
+                    log.info('fetching lineage of parent "%(parent_id)s"' % locals())
+                    lineage = self._fetch_lineage(parent_id, retry=False)
+            lineage = lineage + [(rank, tax_id)]
+
+        self._rename_undefined(lineage, start=start)
+        self.cached[tax_id] = lineage
+
+        return lineage
+
+    def _rename_undefined(self, lineage, start=0):
+        """
+        Renames undefined ranks in lineage (a list of (rank, tax_id)
+        tuples, root first) in place using the name of the parent
+        rank, starting with element start (elements before start
+        must already have been renamed). The lineage of each
+        ancestor in lineage[start:-1] is added to self.cached unless
+        already present.
+        """
+
+        undefined = self.undefined_rank
+        prefix = self.undef_prefix+'_'
+        cached = self.cached
+
+        tax_id = lineage[-1][1]
+        last = len(lineage) - 1
+        _parent_rank = lineage[start - 1][0] if start > 0 else None
+        for i in xrange(start, len(lineage)):
+            _rank, _tax_id = lineage[i]
+
+            if _rank == undefined:
+                _rank = prefix + _parent_rank
+                self._add_rank(_rank, _parent_rank)
+
+                lineage[i] = (_rank, _tax_id)
+                log.debug('renamed undefined rank to %(_rank)s in element %(i)s of lineage of %(tax_id)s' \
+                              % locals())
 
-            # recursively add parent_ids until we reach the root
-            if parent_id != tax_id:
-                lineage = self._get_lineage(parent_id, _level+1) + lineage
+            if i < last and _tax_id not in cached:
+                cached[_tax_id] = lineage[:i+1]
 
-            # now that we've reached the root, rename any undefined ranks
-            _parent_rank, _parent_id = None, None
-            for i, node in enumerate(lineage):
-                _rank, _tax_id = node
+            _parent_rank = _rank
 
-                if _rank == undefined:
-                    _rank = prefix + _parent_rank
-                    self._add_rank(_rank, _parent_rank)
+    def _fetch_lineage(self, tax_id, retry=True):
+        """
+        Returns the lineage of tax_id as a list of (rank, tax_id)
+        tuples, root first, using a single query of table "ancestors"
+        if available or a recursive query of table "nodes" otherwise.
+        """
 
-                    lineage[i] = (_rank, _tax_id)
-                    self.cached[_tax_id] = lineage
-                    log.debug('renamed undefined rank to %(_rank)s in element %(i)s of lineage of %(tax_id)s' \
-                                  % locals())
+        if retry and self.preload_merged:
+            new_tax_id = self._merged_id(tax_id)
+            if new_tax_id is not None:
+                # as in _node, the merged tax_id replaces the current one
+                lineage = self._fetch_lineage(new_tax_id, retry=False)
+                lineage[-1] = (lineage[-1][0], tax_id)
+                return lineage
+            retry = False
+
+        if self.ancestors is not None:
+            a, n = self.ancestors, self.nodes
+            s = select([a.c.ancestor_id, n.c.rank],
+                       and_(a.c.tax_id == self._db_id(tax_id), n.c.tax_id == a.c.ancestor_id)
+                       ).order_by(a.c.depth.desc())
+            output = s.execute().fetchall()
+        else:
+            output = self.engine.execute(lineage_query, tax_id=self._db_id(tax_id),
+                                         max_depth=max_lineage_depth).fetchall()
+            if len(output) > max_lineage_depth:
+                raise ValueError('lineage of tax_id "%s" is deeper than %s nodes' % \
+                                     (tax_id, max_lineage_depth))
 
-                _parent_rank, _parent_id = _rank, _tax_id
+        if not output:
+            if retry:
+                new_tax_id = self._merged_id(tax_id)
+                if new_tax_id is not None:
+                    # as in _node, the merged tax_id replaces the current one
+                    lineage = self._fetch_lineage(new_tax_id, retry=False)
+                    lineage[-1] = (lineage[-1][0], tax_id)
+                    return lineage
 
-            self.cached[tax_id] = lineage
+            raise KeyError('value "%s" not found in nodes.tax_id' % tax_id)
 
+        lineage = [(rank, self._api_id(ancestor_id)) for ancestor_id, rank in output]
+        lineage[-1] = (lineage[-1][0], tax_id)
         return lineage
 
+    def descendants(self, tax_id, rank=None):
+        """
+        Returns a list of the tax_ids of all descendants of tax_id
+        (not including tax_id itself), or only of those with the
+        given rank (as recorded in table "nodes") if rank is
+        provided. Uses table "intervals" (requiring a single range
+        scan) or table "ancestors" if available.
+        """
+
+        nodes = self.nodes
+
+        if self.intervals is not None:
+            i = self.intervals
+            node = select([i.c.lft, i.c.rgt], i.c.tax_id == self._db_id(tax_id)).execute().fetchone()
+            if node is None:
+                return []
+            lft, rgt = node
+            if rank is None:
+                s = select([i.c.tax_id], and_(i.c.lft > lft, i.c.lft <= rgt))
+            else:
+                s = select([i.c.tax_id], and_(i.c.lft > lft, i.c.lft <= rgt,
+                                              i.c.tax_id == nodes.c.tax_id, nodes.c.rank == rank))
+            output = s.execute().fetchall()
+        elif self.ancestors is not None:
+            a = self.ancestors
+            if rank is None:
+                s = select([a.c.tax_id],
+                           and_(a.c.ancestor_id == self._db_id(tax_id), a.c.depth > 0))
+            else:
+                s = select([a.c.tax_id],
+                           and_(a.c.ancestor_id == self._db_id(tax_id), a.c.depth > 0,
+                                a.c.tax_id == nodes.c.tax_id, nodes.c.rank == rank))
+            output = s.execute().fetchall()
+        else:
+            # see lineage_query
+            s = sqlalchemy.text("""
+            SELECT subtree.tax_id FROM (
+              WITH RECURSIVE subtree(tax_id) AS (
+                SELECT tax_id FROM nodes WHERE parent_id = :tax_id AND tax_id != parent_id
+                UNION ALL
+                SELECT nodes.tax_id FROM nodes JOIN subtree ON nodes.parent_id = subtree.tax_id
+              )
+              SELECT tax_id FROM subtree
+            ) AS subtree JOIN nodes ON nodes.tax_id = subtree.tax_id
+            WHERE :rank IS NULL OR nodes.rank = :rank
+            """)
+            output = self.engine.execute(s, tax_id=self._db_id(tax_id), rank=rank).fetchall()
+
+        return [self._api_id(row[0]) for row in output]
+
+    def is_descendant(self, tax_id, ancestor_id):
+        """
+        Returns True if ancestor_id is an ancestor of tax_id (not
+        including tax_id itself). Merged tax_ids are replaced by the
+        current ones. Compares the intervals of the two nodes if
+        table "intervals" is available, or otherwise searches the
+        lineage of tax_id. Raises KeyError if either tax_id is not
+        found.
+        """
+
+        (tax_id, ancestor_id), merged = self.resolve_merged([tax_id, ancestor_id])
+
+        if self.intervals is not None:
+            i = self.intervals
+            s = select([i.c.tax_id, i.c.lft, i.c.rgt],
+                       i.c.tax_id.in_(self._db_ids([tax_id, ancestor_id])))
+            found = dict((self._api_id(row[0]), row[1:]) for row in s.execute())
+            for key in [tax_id, ancestor_id]:
+                if key not in found:
+                    raise KeyError('value "%s" not found in intervals.tax_id' % key)
+            lft, rgt = found[ancestor_id]
+            return lft < found[tax_id][0] <= rgt
+
+        if ancestor_id in set(node_id for rank, node_id in self._get_lineage(tax_id)[:-1]):
+            return True
+
+        self._node(ancestor_id)
+        return False
+
     def synonyms(self, tax_id=None, tax_name=None):
         if not bool(tax_id) ^ bool(tax_name):
             raise ValueError('Exactly one of tax_id and tax_name may be provided.')
@@ -215,7 +880,7 @@ class Taxonomy(object):
                 raise KeyError('"%s" not found in names.tax_names' % tax_name)
 
         s = select([names.c.tax_name, names.c.is_primary],
-                   names.c.tax_id == tax_id)
+                   names.c.tax_id == self._db_id(tax_id, 'names'))
         output = s.execute().fetchall()
 
         if not output:
@@ -235,18 +900,349 @@ class Taxonomy(object):
         if tax_name:
             tax_id, primary_name, is_primary = self.primary_from_name(tax_name)
 
-        ldict = dict(self._get_lineage(tax_id))
+        lineage = self._get_lineage(tax_id)
+        self._add_requested([tax_id])
+
+        ldict = dict(lineage)
 
         ldict['tax_id'] = tax_id
         ldict['parent_id'], _ = self._node(tax_id)
-        ldict['rank'] = self.cached[tax_id][-1][0]
+        ldict['rank'] = lineage[-1][0]
         ldict['tax_name'] = self.primary_from_id(tax_id)
 
         return ldict
 
-    def tree_lineage(self, tax_ids=None, tax_names=None):
+    def _nodes(self, tax_ids):
+        """
+        Returns a dict of {tax_id: (parent_id, rank)} for each of
+        tax_ids found in table "nodes".
+        """
+
+        nodes = self.nodes
+        output = {}
+        for chunk in _chunks(self._db_ids(set(tax_ids)), max_in_clause):
+            s = select([nodes.c.tax_id, nodes.c.parent_id, nodes.c.rank],
+                       nodes.c.tax_id.in_(chunk))
+            for tax_id, parent_id, rank in s.execute():
+                output[self._api_id(tax_id)] = (self._api_id(parent_id), rank)
+
+        return output
+
+    def _ancestor_nodes(self, tax_ids, stop=None):
+        """
+        Returns a dict of {tax_id: (parent_id, rank)} for each of
+        tax_ids and all of their ancestors, and a dict of
+        {old_tax_id: new_tax_id} for each of tax_ids that has been
+        merged (the current tax_id replaces the old one in the first
+        dict). Nodes are fetched one level of the taxonomy at a
+        time. Ancestors for which stop(tax_id) is true are omitted
+        along with their own ancestors. Raises KeyError if any
+        tax_id is not found.
+        """
+
+        tax_ids = list(tax_ids)
+        todo = set(tax_ids)
+
+        if self.preload_merged:
+            current, merged = self.resolve_merged(todo)
+            nodes = self._nodes(current)
+        else:
+            nodes = self._nodes(todo)
+            merged = self._merged_ids(todo - set(nodes))
+            nodes.update(self._nodes(set(merged.values()) - set(nodes)))
+
+        for tax_id in tax_ids:
+            if merged.get(tax_id, tax_id) not in nodes:
+                raise KeyError('value "%s" not found in nodes.tax_id' % tax_id)
+
+        frontier = set(parent_id for parent_id, rank in nodes.values())
+        while True:
+            frontier = set(tax_id for tax_id in frontier
+                           if tax_id not in nodes and not (stop and stop(tax_id)))
+            if not frontier:
+                break
+            fetched = self._nodes(frontier)
+            if len(fetched) != len(frontier):
+                missing = frontier - set(fetched)
+                raise KeyError('value "%s" not found in nodes.tax_id' % missing.pop())
+            nodes.update(fetched)
+            frontier = set(parent_id for parent_id, rank in fetched.values())
+
+        return nodes, merged
+
+    def _merged_map(self):
+        """
+        Returns a dict of {old_tax_id: new_tax_id} containing table
+        "merged", which is read on the first call.
+        """
+
+        if self._preloaded_merged is None:
+            merged = self.merged
+            s = select([merged.c.old_tax_id, merged.c.new_tax_id])
+            self._preloaded_merged = dict(
+                (self._api_id(old), self._api_id(new)) for old, new in s.execute())
+            log.info('loaded %s merged tax_ids' % len(self._preloaded_merged))
+
+        return self._preloaded_merged
+
+    def _merged_id(self, tax_id):
+        """
+        Returns the tax_id replacing tax_id in table "merged", or None.
+        """
+
+        if self.preload_merged:
+            return self._merged_map().get(tax_id)
+
+        s = select([self.merged.c.new_tax_id],
+                   self.merged.c.old_tax_id == self._db_id(tax_id))
+        output = s.execute().fetchone()
+        return self._api_id(output[0]) if output else None
+
+    def _merged_ids(self, tax_ids):
+        """
+        Returns a dict of {old_tax_id: new_tax_id} for each of tax_ids
+        found in table "merged".
+        """
+
+        if self.preload_merged:
+            merged = self._merged_map()
+            return dict((tax_id, merged.get(tax_id)) for tax_id in set(tax_ids)
+                        if merged.get(tax_id) is not None)
+
+        merged = self.merged
+        output = {}
+        for chunk in _chunks(self._db_ids(set(tax_ids)), max_in_clause):
+            s = select([merged.c.old_tax_id, merged.c.new_tax_id],
+                       merged.c.old_tax_id.in_(chunk))
+            for old_tax_id, new_tax_id in s.execute():
+                output[self._api_id(old_tax_id)] = self._api_id(new_tax_id)
+
+        return output
+
+    def resolve_merged(self, tax_ids):
+        """
+        Replaces merged tax_ids with the current ones. Returns a list
+        of tax_ids in the order provided and a dict of {old_tax_id:
+        new_tax_id} for each tax_id that was replaced. tax_ids that
+        are not merged are returned unchanged whether or not they
+        exist. Requires one query per 900 tax_ids, or none if
+        preload_merged is True.
+        """
+
+        tax_ids = list(tax_ids)
+        merged = self._merged_ids(tax_ids)
+        return [merged.get(tax_id, tax_id) for tax_id in tax_ids], merged
+
+    def _primary_names(self, tax_ids):
+        """
+        Returns a dict of {tax_id: tax_name} containing the primary
+        name of each of tax_ids found in table "names".
+        """
+
+        names = self.names
+        output = {}
+        for chunk in _chunks(self._db_ids(set(tax_ids), 'names'), max_in_clause):
+            s = select([names.c.tax_id, names.c.tax_name],
+                       and_(names.c.tax_id.in_(chunk), names.c.is_primary == 1))
+            for tax_id, tax_name in s.execute():
+                output[self._api_id(tax_id)] = tax_name
+
+        return output
+
+    def _lineage_lists(self, tax_ids):
         """
-        Public method for returning a lineage for multiple taxa; includes tax_name and rank
+        Returns a list of lineages represented as lists of (rank,
+        tax_id) tuples (see _get_lineage) for each of tax_ids, and a
+        dict of {old_tax_id: new_tax_id} for each of tax_ids that has
+        been merged, whether or not its lineage was cached. Nodes are
+        fetched for the whole batch at once using one query per level
+        of the taxonomy. Raises KeyError if any tax_id is not found.
+        """
+
+        tax_ids = list(tax_ids)
+        cached = self.cached
+
+        # lineages retrieved from the cache or built during this call;
+        # kept here as well because the cache may evict them
+        known = {}
+        def lookup(tax_id):
+            lineage = known.get(tax_id)
+            if lineage is None:
+                lineage = cached.get(tax_id)
+                if lineage:
+                    known[tax_id] = lineage
+            return lineage
+
+        # fetch uncached tax_ids and their ancestors until each
+        # lineage reaches either the root or a cached lineage
+        uncached = set(tax_id for tax_id in tax_ids if not lookup(tax_id))
+        nodes, merged = self._ancestor_nodes(uncached, stop=lookup)
+
+        # the cached lineage of a merged tax_id ends with the old
+        # tax_id, so cached tax_ids are checked for merges separately
+        merged.update(self._merged_ids(set(tax_ids) - uncached))
+
+        def get_lineage(tax_id):
+            lineage = lookup(tax_id)
+            if lineage:
+                return lineage
+
+            # walk up until we reach the root or a known lineage,
+            # then build and cache lineages on the way back down
+            path = []
+            node_id = merged.get(tax_id, tax_id)
+            while True:
+                lineage = lookup(node_id)
+                if lineage:
+                    break
+                parent_id, rank = nodes[node_id]
+                path.append((rank, node_id))
+                if parent_id == node_id:
+                    lineage = []
+                    break
+                node_id = parent_id
+
+            for rank, node_id in reversed(path):
+                lineage = lineage + [(rank, node_id)]
+                self._rename_undefined(lineage, start=len(lineage) - 1)
+                known[node_id] = cached[node_id] = lineage
+
+            if lineage[-1][1] != tax_id:
+                # as in _node, the merged tax_id replaces the current one
+                lineage = lineage[:-1] + [(lineage[-1][0], tax_id)]
+                known[tax_id] = cached[tax_id] = lineage
+
+            return lineage
+
+        return [get_lineage(tax_id) for tax_id in tax_ids], merged
+
+    def lineages(self, tax_ids):
+        """
+        Returns a list of lineages (see Taxonomy.lineage) for each of
+        tax_ids in the order provided. Nodes and names are retrieved
+        for the whole batch at once using one set of queries per level
+        of the taxonomy rather than several queries per tax_id. Raises
+        KeyError if any tax_id is not found.
+        """
+
+        tax_ids = list(tax_ids)
+        lineages, merged = self._lineage_lists(tax_ids)
+        self._add_requested(tax_ids)
+        resolved = [merged.get(tax_id, tax_id) for tax_id in tax_ids]
+
+        # primary names by tax_id as provided, using self.cached_names
+        # (see primary_from_id) where possible
+        primary_names = {}
+        for tax_id in set(tax_ids):
+            tax_name = self.cached_names.get(tax_id)
+            if tax_name is not None:
+                primary_names[tax_id] = tax_name
+
+        unnamed = set((tax_id, merged.get(tax_id, tax_id))
+                      for tax_id in tax_ids if tax_id not in primary_names)
+        found = self._primary_names(node_id for tax_id, node_id in unnamed)
+
+        for tax_id, node_id in unnamed:
+            if node_id in found:
+                primary_names[tax_id] = self.cached_names[tax_id] = found[node_id]
+
+        output = []
+        for tax_id, node_id, lineage in zip(tax_ids, resolved, lineages):
+            if tax_id not in primary_names:
+                raise KeyError('value "%s" not found in names.tax_id' % tax_id)
+
+            ldict = dict(lineage)
+            ldict['tax_id'] = tax_id
+            ldict['parent_id'] = lineage[-2][1] if len(lineage) > 1 else node_id
+            ldict['rank'] = lineage[-1][0]
+            ldict['tax_name'] = primary_names[tax_id]
+            output.append(ldict)
+
+        return output
+
+    def at_rank(self, tax_ids, rank, missing=None):
+        """
+        Returns a list containing, for each of tax_ids, the tax_id of
+        its ancestor at rank (the tax_id itself if it has that rank),
+        or missing if its lineage does not include rank. Equivalent
+        to [self.lineage(tax_id).get(rank, missing) for tax_id in
+        tax_ids], but each distinct tax_id is looked up once and
+        lineages are fetched in batches (see lineages). Raises
+        KeyError if any tax_id is not found.
+        """
+
+        tax_ids = list(tax_ids)
+        distinct = list(set(tax_ids))
+
+        lineages, merged = self._lineage_lists(distinct)
+
+        found = dict((tax_id, dict(lineage).get(rank, missing))
+                     for tax_id, lineage in zip(distinct, lineages))
+        return [found[tax_id] for tax_id in tax_ids]
+
+    def lca(self, tax_ids):
+        """
+        Returns the tax_id of the lowest common ancestor of tax_ids
+        (a non-empty sequence), ie, the last tax_id shared by their
+        lineages, or None if they have no common ancestor. Merged
+        tax_ids are replaced by the current ones. Raises KeyError if
+        any tax_id is not found.
+        """
+
+        return self.lca_many([tax_ids])[0]
+
+    def lca_many(self, groups):
+        """
+        Returns a list containing the lowest common ancestor (see lca)
+        of each of groups, a sequence of non-empty sequences of
+        tax_ids. The lineages of all of the tax_ids are fetched at
+        once (see lineages) and compared.
+
+        This implementation does not use an LCA index: the index
+        (see module lca) identifies nodes by their position in arrays
+        of all nodes, which would have to be held in memory alongside
+        a dict of every tax_id. MemoryTaxonomy and SnapshotTaxonomy,
+        which hold those arrays anyway, answer LCA queries from an
+        index that is built from table "nodes" and saved next to the
+        database; use one of them when LCA queries are frequent.
+        """
+
+        groups = [list(group) for group in groups]
+        if not all(groups):
+            raise ValueError('lca requires at least one tax_id')
+
+        distinct = list(set(itertools.chain(*groups)))
+        lineages, merged = self._lineage_lists(distinct)
+
+        # tax_ids from the root to each (current) tax_id
+        paths = {}
+        for tax_id, lineage in zip(distinct, lineages):
+            paths[tax_id] = [node_id for rank, node_id in lineage[:-1]] + \
+                [merged.get(tax_id, tax_id)]
+
+        output = []
+        for group in groups:
+            common = paths[group[0]]
+            for tax_id in group[1:]:
+                n = 0
+                for a, b in itertools.izip(common, paths[tax_id]):
+                    if a != b:
+                        break
+                    n += 1
+                common = common[:n]
+            output.append(common[-1] if common else None)
+
+        return output
+
+    def _tree(self, tax_ids=None, tax_names=None, collapse=False):
+        """
+        Returns (root, children) describing the tree connecting
+        tax_ids (or the taxa named in tax_names) to the root, where
+        children is a dict of {tax_id: [child tax_ids]} containing
+        every node in the tree (leaves have no children). The
+        children of each node are ordered by the first of tax_ids
+        found below it. If collapse is True, nodes that have a single
+        child and are not among tax_ids are omitted.
         """
 
         if not bool(tax_ids) ^ bool(tax_names):
@@ -255,39 +1251,118 @@ class Taxonomy(object):
         if tax_names:
             tax_ids = [ self.primary_from_name(tax_name)[0] for tax_name in tax_names  ]
 
-        trees = {}
+        tax_ids = list(tax_ids)
+        nodes, merged = self._ancestor_nodes(tax_ids)
+
+        children = {}
         root = None
 
         for tax_id in tax_ids:
-            subtree = newick.tree.Leaf(tax_id)
-            trees[tax_id] = subtree
+            if tax_id in children:
+                # duplicate, or an ancestor of a previous tax_id
+                continue
+
+            children[tax_id] = []
+            child_id, node_id = tax_id, merged.get(tax_id, tax_id)
 
             while True:
-                parent_id, rank = self._node(tax_id)
+                parent_id = nodes[node_id][0]
 
-                if parent_id == tax_id:
+                if parent_id == node_id:
                     # we've reached the root
                     assert root is None, "No support for trees with more than one root"
-                    root = tree
+                    root = child_id
                     break
 
-                if parent_id in trees:
-                    # we've reached a tree grown from another leaf, so add this tree
-                    tree = trees[parent_id]
-                    tree.add_edge( (subtree, None, None) )
+                if parent_id in children:
+                    # we've reached a tree grown from another leaf
+                    children[parent_id].append(child_id)
                     break
 
-                # we've not visited this parent taxon, so generate new tree
-                tree = trees[parent_id] = newick.tree.Tree()
-                tree.identifier = parent_id
-                tree.add_edge( (subtree, None, None) )
+                children[parent_id] = [child_id]
+                child_id = node_id = parent_id
+
+        if collapse:
+            keep = set(tax_ids)
+            def skip(tax_id):
+                while len(children[tax_id]) == 1 and tax_id not in keep:
+                    tax_id = children[tax_id][0]
+                return tax_id
+
+            root = skip(root)
+            collapsed, stack = {}, [root]
+            while stack:
+                tax_id = stack.pop()
+                collapsed[tax_id] = [skip(child_id) for child_id in children[tax_id]]
+                stack.extend(collapsed[tax_id])
+            children = collapsed
+
+        return root, children
+
+    def tree_lineage(self, tax_ids=None, tax_names=None, collapse=False):
+        """
+        Public method for returning a lineage for multiple taxa as a
+        newick.tree.Tree connecting tax_ids (or the taxa named in
+        tax_names) to the root. Parents are retrieved in bulk one
+        level of the taxonomy at a time. If collapse is True, internal
+        nodes with a single child are omitted.
+        """
+
+        root, children = self._tree(tax_ids, tax_names, collapse)
+
+        def make_node(tax_id):
+            if children[tax_id]:
+                node = newick.tree.Tree()
+                node.identifier = tax_id
+            else:
+                node = newick.tree.Leaf(tax_id)
+            return node
+
+        tree = make_node(root)
+        stack = [(root, tree)]
+        while stack:
+            tax_id, node = stack.pop()
+            for child_id in children[tax_id]:
+                child = make_node(child_id)
+                node.add_edge( (child, None, None) )
+                stack.append((child_id, child))
 
-                subtree = tree
-                tax_id = parent_id
+        return tree
 
-        return root
+    def tree_newick(self, tax_ids=None, tax_names=None, collapse=False):
+        """
+        Returns the tree produced by tree_lineage as a string in
+        Newick format, labelling each node with its tax_id. Faster
+        than formatting the result of tree_lineage for large trees.
+        """
 
-    def write_table(self, taxa=None, csvfile=None, full=False):
+        root, children = self._tree(tax_ids, tax_names, collapse)
+
+        # stack of ('node', tax_id) or ('text', string)
+        output = []
+        stack = [('node', root)]
+        while stack:
+            kind, value = stack.pop()
+            if kind == 'text':
+                output.append(value)
+                continue
+
+            label = _newick_label(value)
+            if not children[value]:
+                output.append(label)
+                continue
+
+            output.append('(')
+            stack.append(('text', ')' + label))
+            for i, child_id in enumerate(reversed(children[value])):
+                if i:
+                    stack.append(('text', ','))
+                stack.append(('node', child_id))
+
+        output.append(';')
+        return ''.join(output)
+
+    def write_table(self, taxa=None, csvfile=None, full=False, chunksize=None, format='csv'):
         """
         Represent the currently defined taxonomic lineages as a rectangular
         array with columns named "tax_id","rank","tax_name", followed
@@ -295,34 +1370,318 @@ class Taxonomy(object):
         specific ranks.
 
          * taxa - list of taxids to include in the output; if none are
-           provided, use self.cached.keys() (ie, those taxa loaded into the cache).
+           provided, use the taxa in self.requested (ie, those for which
+           a lineage has been requested) and all of their ancestors;
+           required unless requested tax_ids are recorded (see
+           track_requested in __init__).
          * csvfile - an open file-like object (see "csvfile" argument to csv.writer)
          * full - if True (the default), includes a column for each rank in self.ranks;
            otherwise, omits ranks (columns) the are undefined for all taxa.
+         * chunksize - if provided, taxa (which may be any iterable)
+           are processed chunksize at a time: the lineages in each
+           chunk are sorted and written to a temporary file, and the
+           sorted chunks are merged as rows are written. Memory use
+           then depends on chunksize rather than on the number of
+           taxa, provided that the caches are bounded (see
+           LRUCache).
+         * format - "csv", or "columnar" to write a binary table (see
+           module columnar) to the directory named by csvfile.
+
+        Rows are sorted by rank and then by tax_name; rows with the
+        same rank and name are written in the order of taxa.
         """
 
         if not taxa:
-            taxa = self.cached.keys()
+            if self.requested is None:
+                raise ValueError('taxa must be provided if track_requested is False')
+            # other threads may be adding to self.requested
+            with self._requested_lock:
+                taxa = set(self.requested)
+            for tax_id in list(taxa):
+                taxa.update(node[1] for node in self._get_lineage(tax_id))
+
+        taxa = iter(taxa)
+        counter = itertools.count()
+        represented = set()
+
+        # each run is a sorted list of (key, lineage) or a temporary
+        # file containing (position, lineage) in sorted order
+        runs = []
+
+        while True:
+            chunk = list(itertools.islice(taxa, chunksize) if chunksize else taxa)
+            if not chunk:
+                break
+
+            lineages = self.lineages(chunk)
+            represented.update(itertools.chain.from_iterable(lineages))
+
+            order = self._rank_order()
+            run = sorted(((order[lin['rank']], lin['tax_name'], counter.next()), lin)
+                         for lin in lineages)
+            del lineages
+
+            # keep only the most recent run in memory
+            if runs:
+                runs[-1] = _dump_run((key[2], lin) for key, lin in runs[-1])
+            runs.append(run)
+
+            if not chunksize:
+                break
 
         # which ranks are actually represented?
         if full:
             ranks = self.ranks
         else:
-            represented = set(itertools.chain.from_iterable(
-                    [[node[0] for node in lineage] for lineage in self.cached.values()])
-            )
+            represented &= self.rankset
             ranks = [r for r in self.ranks if r in represented]
 
         fields = ['tax_id','parent_id','rank','tax_name'] + ranks
-        writer = csv.DictWriter(csvfile, fieldnames=fields,
-                                extrasaction='ignore', quoting=csv.QUOTE_NONNUMERIC)
+        writer = self._table_writer(csvfile, fields, format)
+
+        if len(runs) <= 1:
+            for key, lin in itertools.chain.from_iterable(runs):
+                writer.writerow(lin)
+            if format == 'columnar':
+                writer.close()
+            return
+
+        # ranks may have been added to self.ranks since a run was
+        # sorted, but the order of the ranks already present does not
+        # change, so each run is still sorted using the final order
+        order = self._rank_order()
+        def keyed(run):
+            items = _load_run(run) if hasattr(run, 'read') else ((key[2], lin) for key, lin in run)
+            for position, lin in items:
+                yield (order[lin['rank']], lin['tax_name'], position), lin
+
+        try:
+            for key, lin in heapq.merge(*[keyed(run) for run in runs]):
+                writer.writerow(lin)
+        finally:
+            for run in runs:
+                if hasattr(run, 'close'):
+                    run.close()
+
+        if format == 'columnar':
+            writer.close()
+
+    def _table_writer(self, csvfile, fields, format):
+        """
+        Returns an object with a method writerow(lineage) for the
+        output of write_table or export_all in the given format. The
+        header row of csv output has already been written; columnar
+        output must be completed by calling close().
+        """
+
+        if format == 'csv':
+            writer = csv.DictWriter(csvfile, fieldnames=fields,
+                                    extrasaction='ignore', quoting=csv.QUOTE_NONNUMERIC)
+
+            # header row
+            writer.writerow(dict(zip(fields, fields)))
+            return writer
+        elif format == 'columnar':
+            return columnar.ColumnarWriter(csvfile, fields)
+        else:
+            raise ValueError('format must be one of "csv" or "columnar"')
+
+    def _node_arrays(self):
+        """
+        Reads table "nodes" (ordered by tax_id) and the primary names
+        using one query each. Nodes are identified by their position
+        in the output (ids, parents, rank_names, rank_codes, name):
+
+        * ids - list of tax_ids
+        * parents - array of the position of each node's parent (the
+          root is its own parent)
+        * rank_names - list of ranks
+        * rank_codes - array of the position of each node's rank in
+          rank_names
+        * name - function returning the primary name of the node at
+          a position, or None
+        """
+
+        nodes, names = self.nodes, self.names
+        api_id = self._api_id
+
+        # in a fixed order, so that positions are the same each time
+        # the nodes are read (see MemoryTaxonomy._lca_index)
+        s = select([nodes.c.tax_id, nodes.c.parent_id, nodes.c.rank]).order_by(nodes.c.tax_id)
+        rows = s.execute().fetchall()
+        log.info('loading %s nodes' % len(rows))
+
+        ids = [api_id(row[0]) for row in rows]
+        index = dict((tax_id, i) for i, tax_id in enumerate(ids))
+        parents = array.array('l', (index[api_id(row[1])] for row in rows))
 
-        # header row
-        writer.writerow(dict(zip(fields, fields)))
-        lineages = [self.lineage(tax_id) for tax_id in taxa]
+        rank_names = sorted(set(row[2] for row in rows))
+        codes = dict((rank, i) for i, rank in enumerate(rank_names))
+        rank_codes = array.array('H', (codes[row[2]] for row in rows))
+        del rows
 
-        for lin in sorted(lineages, key=lambda x: (ranks.index(x['rank']), x['tax_name'])):
-             writer.writerow(lin)
+        primary = [None] * len(ids)
+        s = select([names.c.tax_id, names.c.tax_name], names.c.is_primary == 1)
+        for tax_id, tax_name in s.execute():
+            i = index.get(api_id(tax_id))
+            if i is not None:
+                primary[i] = tax_name
+
+        return ids, parents, rank_names, rank_codes, primary.__getitem__
+
+    def _all_nodes(self):
+        """
+        Reads all nodes (see _node_arrays) and renames undefined
+        ranks, adding the new ranks to self.ranks. Returns (ids,
+        parents, order, rank_names, rank_codes, name), where order is
+        an array of positions in depth-first order (each node follows
+        its parent) and rank_codes refer to the renamed ranks.
+        """
+
+        ids, parents, rank_names, rank_codes, name = self._node_arrays()
+        order = self._depth_first(parents)
+        rank_names, rank_codes = self._rename_ranks(parents, order, rank_names, rank_codes)
+        return ids, parents, order, rank_names, rank_codes, name
+
+    def _depth_first(self, parents):
+        """
+        Returns an array of the positions of the nodes described by
+        parents (see _node_arrays) in depth-first order, so that each
+        node follows its parent.
+        """
+
+        n = len(parents)
+
+        # the children of node i are children[offsets[i]:offsets[i+1]]
+        offsets = array.array('l', [0]) * (n + 1)
+        roots = []
+        for i in xrange(n):
+            if parents[i] == i:
+                roots.append(i)
+            else:
+                offsets[parents[i] + 1] += 1
+        for i in xrange(n):
+            offsets[i + 1] += offsets[i]
+
+        children = array.array('l', [0]) * n
+        position = array.array('l', offsets)
+        for i in xrange(n):
+            parent = parents[i]
+            if parent != i:
+                children[position[parent]] = i
+                position[parent] += 1
+        del position
+
+        order = array.array('l')
+        stack = roots[::-1]
+        while stack:
+            i = stack.pop()
+            order.append(i)
+            stack.extend(reversed(children[offsets[i]:offsets[i+1]]))
+
+        return order
+
+    def _rename_ranks(self, parents, order, rank_names, rank_codes):
+        """
+        Renames undefined ranks as in _get_lineage, visiting the
+        nodes in order (parents before children) and adding the new
+        ranks to self.ranks. Returns copies of rank_names and
+        rank_codes (see _node_arrays) describing the renamed ranks.
+        """
+
+        rank_names = list(rank_names)
+        codes = dict((rank, code) for code, rank in enumerate(rank_names))
+        rank_codes = array.array('H', rank_codes)
+        undefined = codes.get(self.undefined_rank)
+        prefix = self.undef_prefix+'_'
+        for i in order:
+            if rank_codes[i] == undefined:
+                parent_rank = rank_names[rank_codes[parents[i]]]
+                rank = prefix + parent_rank
+                if rank not in codes:
+                    codes[rank] = len(rank_names)
+                    rank_names.append(rank)
+                    self._add_rank(rank, parent_rank)
+                rank_codes[i] = codes[rank]
+
+        return rank_names, rank_codes
+
+    def _iter_all(self, nodes):
+        """
+        Yields the lineage of each node in the output of _all_nodes.
+        """
+
+        ids, parents, order, rank_names, rank_codes, name = nodes
+
+        # (position, lineage) of the current node and its ancestors
+        path = []
+        for i in order:
+            parent = parents[i]
+            while path and path[-1][0] != parent:
+                path.pop()
+
+            # each lineage extends that of the parent
+            lineage = path[-1][1].copy() if path else {}
+            rank = rank_names[rank_codes[i]]
+            lineage[rank] = ids[i]
+            lineage['tax_id'] = ids[i]
+            lineage['parent_id'] = ids[parent]
+            lineage['rank'] = rank
+            lineage['tax_name'] = name(i)
+            path.append((i, lineage))
+
+            yield lineage.copy()
+
+    def iter_all_lineages(self):
+        """
+        Yields a lineage (see lineage) for every node in the taxonomy
+        in depth-first order, so that each node follows its
+        parent. The nodes and names are read once and each lineage is
+        derived from that of the parent, so this is much faster than
+        calling lineage for every node. Undefined ranks are renamed
+        (and added to self.ranks) before the first lineage is
+        returned. tax_name is None for nodes without a primary name.
+        """
+
+        return self._iter_all(self._all_nodes())
+
+    def export_all(self, csvfile, full=False, format='csv'):
+        """
+        Writes the lineage of every node in the taxonomy to csvfile in
+        the format produced by write_table, but in depth-first order
+        (see iter_all_lineages) rather than sorted by rank.
+
+         * csvfile - an open file-like object (see "csvfile" argument to csv.writer)
+         * full - if True, includes a column for each rank in self.ranks;
+           otherwise, omits ranks (columns) that are undefined for all taxa.
+         * format - "csv", or "columnar" to write a binary table (see
+           module columnar) to the directory named by csvfile.
+        """
+
+        nodes = self._all_nodes()
+
+        if full:
+            ranks = self.ranks
+        else:
+            rank_names, rank_codes = nodes[3], nodes[4]
+            represented = set(rank_names[code] for code in set(rank_codes))
+            ranks = [r for r in self.ranks if r in represented]
+
+        fields = ['tax_id','parent_id','rank','tax_name'] + ranks
+        writer = self._table_writer(csvfile, fields, format)
+
+        for lineage in self._iter_all(nodes):
+            writer.writerow(lineage)
+
+        if format == 'columnar':
+            writer.close()
+
+    def _rank_order(self):
+        """
+        Returns a dict of {rank: position in self.ranks}.
+        """
+
+        return dict((rank, i) for i, rank in enumerate(self.ranks))
 
     def add_source(self, name, description=None):
         """
@@ -330,6 +1689,8 @@ class Taxonomy(object):
         True) if the insert succeeded, (source_id, False) otherwise.
         """
 
+        self._check_writable()
+
         try:
             result = self.source.insert().execute(name = name, description = description)
             source_id, success = result.inserted_primary_key[0], True
@@ -341,23 +1702,299 @@ class Taxonomy(object):
 
     def add_node(self, tax_id, parent_id, rank, tax_name, source_id=None, source_name=None, **kwargs):
 
+        self._check_writable()
+
         if not (source_id or source_name):
             raise ValueError('Taxonomy.add_node requires source_id or source_name')
 
         if not source_id:
             source_id, source_is_new = self.add_source(name=source_name)
 
-        result = self.nodes.insert().execute(tax_id = tax_id,
-                                             parent_id = parent_id,
+        if self.intervals is not None:
+            i = self.intervals
+            s = select([i.c.lft, i.c.rgt], i.c.tax_id == self._db_id(parent_id))
+            parent = s.execute().fetchone()
+            if parent is None:
+                raise KeyError('value "%s" not found in intervals.tax_id' % parent_id)
+            parent_lft, parent_rgt = parent
+
+        result = self.nodes.insert().execute(tax_id = self._db_id(tax_id),
+                                             parent_id = self._db_id(parent_id),
                                              rank = rank,
                                              source_id = source_id)
 
-        result = self.names.insert().execute(tax_id = tax_id,
+        result = self.names.insert().execute(tax_id = self._db_id(tax_id),
                                              tax_name = tax_name,
                                              is_primary = 1)
 
+        if self.ancestors is not None:
+            a = self.ancestors
+            s = select([a.c.ancestor_id, a.c.depth], a.c.tax_id == self._db_id(parent_id))
+            rows = [dict(tax_id = self._db_id(tax_id), ancestor_id = ancestor_id, depth = depth + 1)
+                    for ancestor_id, depth in s.execute()]
+            rows.append(dict(tax_id = self._db_id(tax_id), ancestor_id = self._db_id(tax_id), depth = 0))
+            self.ancestors.insert().execute(rows)
+
+        if self.intervals is not None:
+            # the new node follows the last descendant of its parent;
+            # shift the intervals that follow it or contain it
+            i = self.intervals
+            i.update(and_(i.c.rgt >= parent_rgt,
+                          or_(i.c.lft <= parent_lft, i.c.lft > parent_rgt))).values(rgt=i.c.rgt + 1).execute()
+            i.update(i.c.lft > parent_rgt).values(lft=i.c.lft + 1).execute()
+            i.insert().execute(tax_id=self._db_id(tax_id), lft=parent_rgt + 1, rgt=parent_rgt + 1)
+
+        if self.name_index is not None:
+            key = normalize_name(tax_name)
+            self.name_index.insert().execute(key = key, rkey = key[::-1],
+                                             tax_id = self._db_id(tax_id),
+                                             tax_name = tax_name, is_primary = 1)
+
+        # discard cached names, including lookups that failed before
+        # the node was added
+        self.cached_names.pop(tax_id, None)
+        self.cached_name_lookups.pop(tax_name, None)
+        if self._preloaded_merged is not None:
+            self._preloaded_merged.pop(tax_id, None)
+
         lineage = self.lineage(tax_id)
 
         log.debug(lineage)
         return lineage
 
+    def add_nodes(self, rows, source_id=None, source_name=None, lineages=False,
+                  skip_existing=False):
+        """
+        Adds many nodes in a single transaction; returns a list of
+        the tax_ids added in the order in which they were inserted,
+        or of their lineages if lineages is True.
+
+        * rows - an iterable of dicts providing the arguments of
+          add_node ("tax_id", "parent_id", "rank", "tax_name" and
+          optionally "source_id" or "source_name"; other keys are
+          ignored), eg the output of utils.get_new_nodes
+        * source_id, source_name - the source of rows that do not
+          specify one
+        * lineages - if True, return the lineages of the new nodes
+          (computed using a single call to lineages)
+        * skip_existing - if True, rows with the tax_id of an
+          existing node are ignored; otherwise the insert fails.
+
+        Rows are inserted parents first, so a row may name another
+        row as its parent. Raises ValueError if the rows define a
+        cycle or lack a source, and KeyError if a parent is neither
+        among the rows nor in the taxonomy; nothing is added in
+        either case.
+        """
+
+        self._check_writable()
+        rows = self._new_node_rows(rows, source_id, source_name, skip_existing)
+        self._insert_nodes(rows)
+
+        for row in rows:
+            self.cached_names.pop(row['tax_id'], None)
+            self.cached_name_lookups.pop(row['tax_name'], None)
+            if self._preloaded_merged is not None:
+                self._preloaded_merged.pop(row['tax_id'], None)
+
+        tax_ids = [row['tax_id'] for row in rows]
+        log.info('added %s nodes' % len(tax_ids))
+        return self.lineages(tax_ids) if lineages else tax_ids
+
+    def _new_node_rows(self, rows, source_id, source_name, skip_existing):
+        """
+        Returns rows (see add_nodes) as a list of dicts with keys
+        tax_id, parent_id, rank, tax_name, source_id and source_name
+        in an order in which each parent precedes its children.
+        Nodes below each parent that is not among the rows are
+        listed together in depth-first order.
+        """
+
+        rows = [dict(tax_id=row['tax_id'], parent_id=row['parent_id'],
+                     rank=row['rank'], tax_name=row['tax_name'],
+                     source_id=row.get('source_id') or source_id,
+                     source_name=row.get('source_name') or source_name)
+                for row in rows]
+
+        for row in rows:
+            if not (row['source_id'] or row['source_name']):
+                raise ValueError('Taxonomy.add_nodes requires source_id or source_name '
+                                 '(tax_id %s)' % row['tax_id'])
+
+        if skip_existing:
+            existing = self._existing_ids(row['tax_id'] for row in rows)
+            for tax_id in existing:
+                log.info('node with tax_id %s already exists' % tax_id)
+            rows = [row for row in rows if row['tax_id'] not in existing]
+
+        by_id = {}
+        for row in rows:
+            if row['tax_id'] in by_id:
+                raise ValueError('tax_id %s is provided more than once' % row['tax_id'])
+            by_id[row['tax_id']] = row
+
+        children = {}
+        for row in rows:
+            children.setdefault(row['parent_id'], []).append(row)
+
+        outside = [parent_id for parent_id in children if parent_id not in by_id]
+        missing = set(outside) - self._existing_ids(outside)
+        if missing:
+            raise KeyError('value "%s" not found in nodes.tax_id' % sorted(missing)[0])
+
+        ordered = []
+        for parent_id in outside:
+            stack = children[parent_id][::-1]
+            while stack:
+                row = stack.pop()
+                ordered.append(row)
+                stack.extend(reversed(children.get(row['tax_id'], [])))
+
+        if len(ordered) != len(rows):
+            raise ValueError('the parents of %s new nodes form a cycle' % (len(rows) - len(ordered)))
+
+        return ordered
+
+    def _existing_ids(self, tax_ids):
+        """
+        Returns the set of tax_ids in table "nodes".
+        """
+
+        found = set()
+        for chunk in _chunks(self._db_ids(set(tax_ids)), max_in_clause):
+            s = select([self.nodes.c.tax_id], self.nodes.c.tax_id.in_(chunk))
+            found.update(self._api_id(tax_id) for tax_id, in s.execute())
+        return found
+
+    def _insert_nodes(self, rows):
+        """
+        Inserts rows as ordered by _new_node_rows (with any new
+        sources) into table "nodes", "names" and the optional derived
+        tables in a single transaction.
+        """
+
+        db_id = self._db_id
+        conn = self.engine.connect()
+        trans = conn.begin()
+        try:
+            sources = {}
+            for name in set(row['source_name'] for row in rows if not row['source_id']):
+                s = select([self.source.c.id], self.source.c.name == name)
+                found = conn.execute(s).fetchone()
+                if found:
+                    sources[name] = found[0]
+                else:
+                    result = conn.execute(self.source.insert(), name = name)
+                    sources[name] = result.inserted_primary_key[0]
+
+            if rows:
+                conn.execute(self.nodes.insert(), [
+                    dict(tax_id = db_id(row['tax_id']), parent_id = db_id(row['parent_id']),
+                         rank = row['rank'],
+                         source_id = row['source_id'] or sources[row['source_name']])
+                    for row in rows])
+                conn.execute(self.names.insert(), [
+                    dict(tax_id = db_id(row['tax_id']), tax_name = row['tax_name'], is_primary = 1)
+                    for row in rows])
+
+            if rows and self.ancestors is not None:
+                self._insert_ancestors(conn, rows)
+
+            if rows and self.intervals is not None:
+                self._insert_intervals(conn, rows)
+
+            if rows and self.name_index is not None:
+                keys = [normalize_name(row['tax_name']) for row in rows]
+                conn.execute(self.name_index.insert(), [
+                    dict(key = key, rkey = key[::-1], tax_id = db_id(row['tax_id']),
+                         tax_name = row['tax_name'], is_primary = 1)
+                    for key, row in zip(keys, rows)])
+
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _insert_ancestors(self, conn, rows):
+        """
+        Adds the rows of table "ancestors" for new nodes (see
+        _insert_nodes).
+        """
+
+        a = self.ancestors
+        new = set(row['tax_id'] for row in rows)
+
+        # keys: tax_id, vals: list of (ancestor_id, depth)
+        ancestors = {}
+        outside = self._db_ids(set(row['parent_id'] for row in rows) - new)
+        for chunk in _chunks(outside, max_in_clause):
+            s = select([a.c.tax_id, a.c.ancestor_id, a.c.depth], a.c.tax_id.in_(chunk))
+            for tax_id, ancestor_id, depth in conn.execute(s):
+                ancestors.setdefault(self._api_id(tax_id), []).append((ancestor_id, depth))
+
+        values = []
+        for row in rows:
+            tax_id = self._db_id(row['tax_id'])
+            lineage = [(tax_id, 0)] + [(ancestor_id, depth + 1) for ancestor_id, depth
+                                       in ancestors.get(row['parent_id'], [])]
+            ancestors[row['tax_id']] = lineage
+            values.extend(dict(tax_id = tax_id, ancestor_id = ancestor_id, depth = depth)
+                          for ancestor_id, depth in lineage)
+
+        conn.execute(a.insert(), values)
+
+    def _insert_intervals(self, conn, rows):
+        """
+        Numbers new nodes in table "intervals" (see _insert_nodes).
+        The nodes below each existing parent are placed after its
+        last descendant as a block (see add_node), so the table is
+        shifted once per parent, or renumbered from scratch if there
+        are more than max_interval_shifts parents.
+        """
+
+        i = self.intervals
+        new = set(row['tax_id'] for row in rows)
+
+        # rows below the same existing parent are adjacent
+        blocks = []
+        for row in rows:
+            if row['parent_id'] not in new and \
+                    not (blocks and blocks[-1][0] == row['parent_id']):
+                blocks.append((row['parent_id'], []))
+            blocks[-1][1].append(row)
+
+        if len(blocks) > max_interval_shifts:
+            conn.execute(i.delete())
+            cursor = conn.connection.cursor()
+            cursor.executemany('INSERT INTO intervals (tax_id, lft, rgt) VALUES (?, ?, ?)',
+                               _interval_rows(cursor))
+            return
+
+        for parent_id, block in blocks:
+            s = select([i.c.lft, i.c.rgt], i.c.tax_id == self._db_id(parent_id))
+            parent = conn.execute(s).fetchone()
+            if parent is None:
+                raise KeyError('value "%s" not found in intervals.tax_id' % parent_id)
+            parent_lft, parent_rgt = parent
+
+            k = len(block)
+            conn.execute(i.update(and_(i.c.rgt >= parent_rgt,
+                                       or_(i.c.lft <= parent_lft, i.c.lft > parent_rgt)))
+                         .values(rgt=i.c.rgt + k))
+            conn.execute(i.update(i.c.lft > parent_rgt).values(lft=i.c.lft + k))
+
+            # the block is in depth-first order (see _new_node_rows)
+            position = dict((row['tax_id'], j) for j, row in enumerate(block))
+            last = range(k)
+            for j in reversed(xrange(k)):
+                p = position.get(block[j]['parent_id'])
+                if p is not None and last[j] > last[p]:
+                    last[p] = last[j]
+
+            start = parent_rgt + 1
+            conn.execute(i.insert(), [
+                dict(tax_id = self._db_id(row['tax_id']), lft = start + j, rgt = start + last[j])
+                for j, row in enumerate(block)])
+
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+import logging
+
+from sqlalchemy import create_engine
+
+import config
+import Taxonomy
+from Taxonomy import asynchronous
+
+log = logging
+
+outputdir = os.path.abspath(config.outputdir)
+dbname = os.path.join(outputdir, 'taxtable_test.db')
+echo = False
+
+asyncio = asynchronous.asyncio
+missing = asyncio is None or asynchronous.ThreadPoolExecutor is None
+
+@unittest.skipIf(missing, 'requires asyncio (or trollius) and concurrent.futures')
+class TestAsyncTaxonomy(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks), threadsafe=True)
+        self.plain = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        self.loop = asyncio.new_event_loop()
+        self.atax = Taxonomy.AsyncTaxonomy(self.tax, loop=self.loop)
+
+        # count the batches looked up
+        self.batches = []
+        lineages = self.tax.lineages
+        def counting(tax_ids):
+            self.batches.append(list(tax_ids))
+            return lineages(tax_ids)
+        self.tax.lineages = counting
+
+    def tearDown(self):
+        self.atax.close()
+        self.loop.close()
+        self.tax.engine.dispose()
+        self.engine.dispose()
+
+    def test01(self):
+        tax_ids = ['1280', '1378', '1280', '9606', '1280']
+        futures = [self.atax.lineage(tax_id) for tax_id in tax_ids]
+        # requests for the same tax_id share a lookup but not a future
+        self.assertFalse(futures[0] is futures[2])
+        lineages = self.loop.run_until_complete(asyncio.gather(*futures))
+        self.assertTrue(lineages == [self.plain.lineage(tax_id) for tax_id in tax_ids])
+        self.assertTrue(len(self.batches) == 1 and sorted(self.batches[0]) == ['1280', '1378', '9606'])
+
+    def test02(self):
+        good, bad = self.atax.lineage('1280'), self.atax.lineage('buh')
+        self.assertRaises(KeyError, self.loop.run_until_complete, bad)
+        self.assertTrue(self.loop.run_until_complete(good)['tax_id'] == '1280')
+
+    def test03(self):
+        atax = Taxonomy.AsyncTaxonomy(self.tax, loop=self.loop, max_batch=2)
+        lineages = self.loop.run_until_complete(atax.lineages(['1280', '1378', '9606']))
+        self.assertTrue([lineage['tax_id'] for lineage in lineages] == ['1280', '1378', '9606'])
+        self.assertTrue([len(batch) for batch in self.batches] == [2, 1])
+        self.assertTrue(self.loop.run_until_complete(atax.call('primary_from_id', '1280')) ==
+                        'Staphylococcus aureus')
+        atax.close()
+
+    def test04(self):
+        self.assertRaises(ValueError, Taxonomy.AsyncTaxonomy, self.plain, loop=self.loop)
+
+    def test05(self):
+        # cancelling one request does not affect others for the same tax_id
+        impatient, patient = self.atax.lineage('1280'), self.atax.lineage('1280')
+        impatient.cancel()
+        later = self.atax.lineage('1280')
+        lineages = self.loop.run_until_complete(asyncio.gather(patient, later))
+        self.assertTrue(impatient.cancelled())
+        self.assertTrue(lineages == [self.plain.lineage('1280')] * 2)
+        self.assertTrue(self.batches == [['1280']])
+
+    def test06(self):
+        # requests sharing a lookup receive separate copies of the lineage
+        first, second = self.atax.lineage('1280'), self.atax.lineage('1280')
+        first, second = self.loop.run_until_complete(asyncio.gather(first, second))
+        self.assertFalse(first is second)
+        first['tax_name'] = 'buh'
+        self.assertTrue(second == self.plain.lineage('1280'))
+
+if __name__ == '__main__':
+    unittest.main()
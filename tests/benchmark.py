@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of loading the database and of the most frequently used
+methods of Taxonomy.
+
+Each case is run at each of several input sizes in a separate
+process, so that the peak memory use (maximum resident set size) of
+each is measured independently; the reported time is the shortest of
+several repetitions. Inputs are sampled from the test database using
+a fixed random seed, so results are comparable between runs.
+
+Examples:
+
+  # run all cases and save the results
+  python benchmark.py --save baseline.json
+
+  # compare a new version with the saved results; the exit status is
+  # 1 if any case is slower or uses more memory than allowed by
+  # --tolerance
+  python benchmark.py --compare baseline.json
+
+  # run selected cases at selected sizes
+  python benchmark.py --cases lineage_cold,lineage_warm --sizes 100,1000
+"""
+
+from optparse import OptionParser
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import StringIO
+import subprocess
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+import config
+import Taxonomy
+
+log = logging
+
+outputdir = os.path.abspath(config.outputdir)
+dbname = os.path.join(outputdir, 'taxtable_test.db')
+
+seed = 1
+default_sizes = [100, 1000, 10000]
+default_repeat = 3
+
+def get_database():
+    """
+    Creates the test database (as in taxtable_test) if necessary;
+    returns (path to the database, path to the archive).
+    """
+
+    zfile = Taxonomy.ncbi.fetch_data(dest_dir=outputdir)
+    if not os.path.isfile(dbname):
+        con = Taxonomy.ncbi.db_connect(dbname, new=True)
+        Taxonomy.ncbi.db_load(con, zfile)
+        con.close()
+    return dbname, zfile
+
+def sample(engine, query, size):
+    """
+    Returns size values of the first column of the results of query
+    chosen at random (with replacement if there are fewer rows).
+    """
+
+    values = sorted(row[0] for row in engine.execute(query))
+    rand = random.Random(seed)
+    if size <= len(values):
+        return rand.sample(values, size)
+    return [rand.choice(values) for i in xrange(size)]
+
+def sample_tax_ids(engine, size):
+    return [str(tax_id) for tax_id in sample(engine, 'SELECT tax_id FROM nodes', size)]
+
+def new_taxonomy(engine):
+    return Taxonomy.Taxonomy(engine, list(Taxonomy.ncbi.ranks))
+
+# Each case is a function of (engine, zfile, size) that performs any
+# setup shared by the repetitions and returns a function, called
+# before each repetition, that returns the code to time (a function
+# of no arguments). The number of items processed per second is size
+# divided by the time.
+
+def case_db_load(engine, zfile, size):
+    fname = os.path.join(outputdir, 'benchmark_load.db')
+
+    def run():
+        con = Taxonomy.ncbi.db_connect(fname, schema=Taxonomy.ncbi.db_tables, new=True)
+        Taxonomy.ncbi.db_load(con, zfile, maxrows=size, bulk=True)
+        con.close()
+
+    return lambda: run
+
+def case_lineage_cold(engine, zfile, size):
+    tax_ids = sample_tax_ids(engine, size)
+
+    def prepare():
+        tax = new_taxonomy(engine)
+        return lambda: [tax.lineage(tax_id) for tax_id in tax_ids]
+
+    return prepare
+
+def case_lineage_warm(engine, zfile, size):
+    tax_ids = sample_tax_ids(engine, size)
+    tax = new_taxonomy(engine)
+    run = lambda: [tax.lineage(tax_id) for tax_id in tax_ids]
+    run()
+    return lambda: run
+
+def case_lineages(engine, zfile, size):
+    tax_ids = sample_tax_ids(engine, size)
+
+    def prepare():
+        tax = new_taxonomy(engine)
+        return lambda: tax.lineages(tax_ids)
+
+    return prepare
+
+def case_primary_from_name(engine, zfile, size):
+    tax_names = sample(engine, 'SELECT tax_name FROM names', size)
+
+    def prepare():
+        tax = new_taxonomy(engine)
+        return lambda: [tax.primary_from_name(tax_name) for tax_name in tax_names]
+
+    return prepare
+
+def case_tree_lineage(engine, zfile, size):
+    tax_ids = sample_tax_ids(engine, size)
+
+    def prepare():
+        tax = new_taxonomy(engine)
+        return lambda: tax.tree_lineage(tax_ids)
+
+    return prepare
+
+def case_write_table(engine, zfile, size):
+    tax_ids = sample_tax_ids(engine, size)
+    tax = new_taxonomy(engine)
+    tax.lineages(tax_ids)
+    return lambda: lambda: tax.write_table(tax_ids, csvfile=StringIO.StringIO())
+
+cases = [
+    ('db_load', case_db_load),
+    ('lineage_cold', case_lineage_cold),
+    ('lineage_warm', case_lineage_warm),
+    ('lineages', case_lineages),
+    ('primary_from_name', case_primary_from_name),
+    ('tree_lineage', case_tree_lineage),
+    ('write_table', case_write_table),
+    ]
+
+def peak_rss_kb():
+    """
+    Returns the maximum resident set size of this process in KiB.
+    """
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on OS X and in KiB elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def run_case(name, size, repeat):
+    """
+    Runs case name in this process; returns a dict describing the
+    result.
+    """
+
+    db, zfile = get_database()
+    engine = create_engine('sqlite:///%s' % db)
+    prepare = dict(cases)[name](engine, zfile, size)
+
+    times = []
+    for i in xrange(repeat):
+        run = prepare()
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+
+    engine.dispose()
+
+    seconds = min(times)
+    return dict(case=name, size=size, seconds=seconds, repeat=repeat,
+                per_second=size / seconds if seconds else None,
+                peak_rss_kb=peak_rss_kb())
+
+def run_in_process(name, size, repeat):
+    """
+    Runs case name in a new process; returns a dict describing the result.
+    """
+
+    cmd = [sys.executable, os.path.abspath(__file__),
+           '--run-case', name, '--sizes', str(size), '--repeat', str(repeat)]
+    output = subprocess.check_output(cmd)
+    return json.loads(output.splitlines()[-1])
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the ratio of each result to the corresponding one in
+    baseline; returns the number of results that are worse than the
+    baseline by more than the fraction tolerance.
+    """
+
+    previous = dict(((r['case'], r['size']), r) for r in baseline['results'])
+    regressions = 0
+
+    print '%-20s %8s %10s %10s %8s %8s' % ('case', 'size', 'seconds', 'baseline', 'time', 'memory')
+    for result in results:
+        old = previous.get((result['case'], result['size']))
+        if old is None:
+            print '%-20s %8s %10.4f %10s' % (result['case'], result['size'], result['seconds'], '-')
+            continue
+
+        time_ratio = result['seconds'] / old['seconds'] if old['seconds'] else 1.0
+        mem_ratio = float(result['peak_rss_kb']) / old['peak_rss_kb'] if old['peak_rss_kb'] else 1.0
+        worse = time_ratio > 1 + tolerance or mem_ratio > 1 + tolerance
+        regressions += worse
+        print '%-20s %8s %10.4f %10.4f %8.2f %8.2f%s' % (
+            result['case'], result['size'], result['seconds'], old['seconds'],
+            time_ratio, mem_ratio, '  REGRESSION' if worse else '')
+
+    return regressions
+
+def main():
+
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--cases', dest='cases', metavar='NAMES',
+                      help='comma-delimited list of cases [all: %s]' % ','.join(name for name, f in cases))
+    parser.add_option('--sizes', dest='sizes', metavar='N,...',
+                      default=','.join(map(str, default_sizes)),
+                      help='comma-delimited list of input sizes [%default]')
+    parser.add_option('--repeat', dest='repeat', type='int', default=default_repeat,
+                      help='number of times each case is timed [%default]')
+    parser.add_option('--save', dest='save', metavar='FILENAME',
+                      help='write the results to FILENAME (json)')
+    parser.add_option('--compare', dest='compare', metavar='FILENAME',
+                      help='compare the results with those saved in FILENAME')
+    parser.add_option('--tolerance', dest='tolerance', type='float', default=0.2,
+                      help="""fraction by which the time or memory use of a case may exceed
+                      the baseline before it is reported as a regression [%default]""")
+    parser.add_option('--run-case', dest='run_case', help="run a single case in this process")
+
+    options, args = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',')]
+
+    if options.run_case:
+        print json.dumps(run_case(options.run_case, sizes[0], options.repeat))
+        return
+
+    names = options.cases.split(',') if options.cases else [name for name, f in cases]
+    unknown = set(names) - set(name for name, f in cases)
+    if unknown:
+        parser.error('unknown case(s): %s' % ', '.join(sorted(unknown)))
+
+    # create the database once rather than in each process
+    get_database()
+
+    results = []
+    for name in names:
+        for size in sizes:
+            result = run_in_process(name, size, options.repeat)
+            log.warning('%(case)-20s %(size)8s %(seconds)10.4f s %(peak_rss_kb)10s KiB' % result)
+            results.append(result)
+
+    output = dict(
+        date=datetime.datetime.now().isoformat(),
+        version=Taxonomy.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        sqlite=Taxonomy.ncbi.sqlite3.sqlite_version,
+        sizes=sizes,
+        repeat=options.repeat,
+        results=results)
+
+    if options.save:
+        with open(options.save, 'w') as fobj:
+            json.dump(output, fobj, indent=1, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as fobj:
+            baseline = json.load(fobj)
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='# %(message)s')
+    main()
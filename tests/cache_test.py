@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+import logging
+import threading
+
+import config
+import Taxonomy
+
+log = logging
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+
+    def test01(self):
+        cache = Taxonomy.LRUCache()
+        for i in range(100):
+            cache[i] = [i]
+        self.assertTrue(len(cache) == 100)
+        self.assertTrue(cache.evictions == 0)
+
+    def test02(self):
+        cache = Taxonomy.LRUCache(maxsize=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a']
+        cache['c'] = 3
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue(cache.evictions == 1)
+
+    def test03(self):
+        cache = Taxonomy.LRUCache(maxsize=1)
+        cache['a'] = 1
+        self.assertTrue(cache.get('a') == 1)
+        self.assertTrue(cache.get('b') is None)
+        self.assertRaises(KeyError, cache.__getitem__, 'b')
+        stats = cache.stats()
+        self.assertTrue((stats['hits'], stats['misses']) == (1, 2))
+
+    def test04(self):
+        cache = Taxonomy.LRUCache(maxsize=5, weight=len)
+        cache['a'] = [1, 2, 3]
+        cache['b'] = [1, 2, 3]
+        self.assertTrue(cache.keys() == ['b'])
+        self.assertTrue(cache.size == 3)
+
+class TestStripedLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+
+    def test01(self):
+        cache = Taxonomy.StripedLRUCache(maxsize=64, stripes=4)
+        for i in range(100):
+            cache[i] = [i]
+        self.assertTrue(len(cache) == 64)
+        self.assertTrue(cache.evictions == 36)
+        self.assertTrue(cache.get(99) == [99])
+        self.assertTrue(cache.pop(99) == [99] and 99 not in cache)
+
+    def test02(self):
+        cache = Taxonomy.StripedLRUCache()
+
+        def fill(start):
+            for i in range(start, 10000, 4):
+                cache[i] = i
+                cache.get(i - 1)
+
+        threads = [threading.Thread(target=fill, args=(start,)) for start in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(sorted(cache.keys()) == range(10000))
+        self.assertTrue(cache.stats()['entries'] == 10000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+import logging
+import shutil
+import struct
+
+from sqlalchemy import create_engine
+
+import config
+import Taxonomy
+from Taxonomy import columnar
+
+log = logging
+
+outputdir = os.path.abspath(config.outputdir)
+dbname = os.path.join(outputdir, 'taxtable_test.db')
+echo = False
+
+def read_npy(fname):
+    """
+    Returns the header and values of a one-dimensional .npy file
+    without using numpy.
+    """
+
+    with open(fname, 'rb') as fobj:
+        data = fobj.read()
+
+    self_len = struct.unpack('<H', data[8:10])[0]
+    header = eval(data[10:10 + self_len])
+    fmt = {'<i8': 'q', '<u2': 'H', '|u1': 'B'}[header['descr']]
+    count = header['shape'][0]
+    values = struct.unpack_from('<%s%s' % (count, fmt), data, 10 + self_len)
+    return header, list(values)
+
+class TestColumnarWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.dirname = os.path.join(outputdir, self.funcname)
+        if os.path.isdir(self.dirname):
+            shutil.rmtree(self.dirname)
+
+    def test01(self):
+        fields = ['tax_id', 'parent_id', 'rank', 'tax_name', 'root', 'genus', 'species']
+        writer = columnar.ColumnarWriter(self.dirname, fields)
+        writer.writerow(dict(tax_id='1', parent_id='1', rank='root', tax_name='root', root='1'))
+        writer.writerow(dict(tax_id='1280_1', parent_id='1279', rank='no_rank',
+                             tax_name=u'Staphylococcus \xe9', root='1', genus='1279'))
+        writer.close()
+
+        manifest = columnar.read_manifest(self.dirname)
+        self.assertTrue(manifest['rows'] == 2)
+        self.assertTrue(manifest['ranks'] == ['root', 'genus', 'species', 'no_rank'])
+        self.assertTrue(manifest['tax_id_strings'] == ['1280_1'])
+
+        header, values = read_npy(os.path.join(self.dirname, 'tax_id.npy'))
+        self.assertTrue(header['shape'] == (2,))
+        self.assertTrue(values == [1, -2])
+        self.assertTrue(read_npy(os.path.join(self.dirname, 'genus.npy'))[1] == [-1, 1279])
+        self.assertTrue(read_npy(os.path.join(self.dirname, 'rank.npy'))[1] == [0, 3])
+
+        offsets = read_npy(os.path.join(self.dirname, 'tax_name_offsets.npy'))[1]
+        heap = ''.join(chr(c) for c in read_npy(os.path.join(self.dirname, 'tax_name_bytes.npy'))[1])
+        self.assertTrue(heap[offsets[1]:offsets[2]].decode('utf-8') == u'Staphylococcus \xe9')
+
+    @unittest.skipIf(columnar.numpy is None, 'requires numpy')
+    def test02(self):
+        engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        tax = Taxonomy.Taxonomy(engine, list(Taxonomy.ncbi.ranks))
+        tax.write_table(['1280', '1378'], self.dirname, format='columnar')
+
+        manifest, columns = columnar.read_table(self.dirname)
+        self.assertTrue(list(columns['tax_id']) == [1280, 1378] or
+                        list(columns['tax_id']) == [1378, 1280])
+        i = list(columns['tax_id']).index(1280)
+        self.assertTrue(columns['genus'][i] == 1279)
+        self.assertTrue(manifest['ranks'][columns['rank'][i]] == 'species')
+        engine.dispose()
+
+if __name__ == '__main__':
+    unittest.main()
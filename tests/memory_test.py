@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+import logging
+import shutil
+
+from sqlalchemy import create_engine
+
+import config
+import Taxonomy
+
+log = logging
+
+module_name = os.path.split(sys.argv[0])[1].rstrip('.py')
+outputdir = os.path.abspath(config.outputdir)
+datadir = os.path.abspath(config.datadir)
+
+dbname = os.path.join(outputdir, 'taxtable_test.db')
+echo = False
+
+zfile = Taxonomy.ncbi.fetch_data(dest_dir=outputdir)
+if not os.path.isfile(dbname):
+    con = Taxonomy.ncbi.db_connect(dbname, new=True)
+    Taxonomy.ncbi.db_load(con, zfile)
+    con.close()
+
+class TestMemoryTaxonomy(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        self.mem = Taxonomy.MemoryTaxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        self.assertTrue(self.mem._node('2') == self.tax._node('2'))
+        self.assertRaises(KeyError, self.mem._node, 'buh')
+
+    def test02(self):
+        self.assertTrue(self.mem.primary_from_id('1280') == 'Staphylococcus aureus')
+        self.assertRaises(KeyError, self.mem.primary_from_id, 'buh')
+
+    def test03(self):
+        for tax_id in ['1', '1280', '1378', '131110']:
+            self.assertTrue(self.mem.lineage(tax_id) == self.tax.lineage(tax_id))
+
+    def test04(self):
+        tax_ids = ['9606', '7227', '83333', '10090']
+        self.assertTrue(str(self.mem.tree_lineage(tax_ids)) == str(self.tax.tree_lineage(tax_ids)))
+        self.assertTrue(self.mem.tree_newick(tax_ids, collapse=True) ==
+                        self.tax.tree_newick(tax_ids, collapse=True))
+
+    def test05(self):
+        tax_ids = ['9606', '7227', '83333', '10090', '1280', '1']
+        for rank in ['genus', 'species', 'below_species', 'no_rank']:
+            self.assertTrue(self.mem.at_rank(tax_ids, rank) == self.tax.at_rank(tax_ids, rank))
+
+    @unittest.skipIf(Taxonomy.memory.numpy is None, 'requires numpy')
+    def test06(self):
+        numpy = Taxonomy.memory.numpy
+        genera = self.mem.at_rank(numpy.array([1280, 1, 1280]), 'genus')
+        self.assertTrue(genera.tolist() == [1279, -1, 1279])
+        self.assertRaises(KeyError, self.mem.at_rank, numpy.array([0]), 'genus')
+
+    def test07(self):
+        groups = [['1280', '1378'], ['1280'], ['9606', '1280', '1378'], ['9606', '10090']]
+        self.assertTrue(self.mem.lca_many(groups) == self.tax.lca_many(groups))
+        self.assertTrue(os.path.isfile(dbname + '.lca'))
+
+        # the saved index is read by the next instance
+        mem = Taxonomy.MemoryTaxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        self.assertTrue(mem.lca(['9606', '10090']) == self.tax.lca(['9606', '10090']))
+
+        # a truncated index is rebuilt
+        size = os.path.getsize(dbname + '.lca')
+        with open(dbname + '.lca', 'r+b') as fobj:
+            fobj.truncate(size // 2)
+        mem = Taxonomy.MemoryTaxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        self.assertTrue(mem.lca(['9606', '10090']) == self.tax.lca(['9606', '10090']))
+        self.assertTrue(os.path.getsize(dbname + '.lca') == size)
+
+        # an index of nodes read in a different order is not used
+        fname, key = mem._lca_file()
+        crc = mem._lca_checksum()
+        self.assertTrue(key == (os.path.getmtime(dbname), os.path.getsize(dbname)))
+        self.assertTrue(Taxonomy.lca.LcaIndex.load(fname, key, crc) is not None)
+        self.assertTrue(Taxonomy.lca.LcaIndex.load(fname, key, crc ^ 1) is None)
+        parents = mem._parents[::-1]
+        self.assertTrue(Taxonomy.lca.checksum(mem._ids, parents) != crc)
+
+    def test08(self):
+        for rank in [None, 'species']:
+            self.assertTrue(sorted(self.mem.descendants('1279', rank)) ==
+                            sorted(self.tax.descendants('1279', rank)))
+        self.assertTrue(self.mem.is_descendant('1280', '1279'))
+        self.assertFalse(self.mem.is_descendant('1279', '1280'))
+
+class TestMemoryAddNodes(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.dbname = os.path.join(outputdir, self.funcname + '.db')
+        shutil.copy(dbname, self.dbname)
+        self.engine = create_engine('sqlite:///%s' % self.dbname, echo=echo)
+        self.mem = Taxonomy.MemoryTaxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        rows = [dict(tax_id='1280_2', parent_id='1280_1', rank='subspecies', tax_name='newer staph'),
+                dict(tax_id='1280_1', parent_id='1279', rank='species', tax_name='new staph')]
+        self.mem.add_nodes(rows, source_name='test')
+        self.assertTrue(self.mem.lineage('1280_2')['species'] == '1280_1')
+        self.assertTrue(self.mem.is_descendant('1280_2', '1279'))
+
+        tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        self.assertTrue(tax.lineage('1280_2') == self.mem.lineage('1280_2'))
+
+    def test02(self):
+        rows = [dict(tax_id='1280_1', parent_id='1279', rank='species', tax_name='new staph'),
+                dict(tax_id='1280', parent_id='1279', rank='species', tax_name='duplicate')]
+        self.assertRaises(Exception, self.mem.add_nodes, rows, source_name='test')
+        self.assertRaises(KeyError, self.mem.lineage, '1280_1')
+        self.assertTrue(self.mem.primary_from_id('1280') == 'Staphylococcus aureus')
+
+class TestSnapshotTaxonomy(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        self.fname = os.path.join(outputdir, 'taxonomy_snapshot.bin')
+        if not os.path.isfile(self.fname):
+            mem = Taxonomy.MemoryTaxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+            Taxonomy.snapshot.write_snapshot(mem, self.fname)
+        self.snap = Taxonomy.SnapshotTaxonomy(self.fname, list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.snap.close()
+        self.engine.dispose()
+
+    def test01(self):
+        self.assertTrue(self.snap._node('2') == self.tax._node('2'))
+        self.assertRaises(KeyError, self.snap._node, 'buh')
+
+    def test02(self):
+        for tax_id in ['1', '1280', '1378', '131110']:
+            self.assertTrue(self.snap.lineage(tax_id) == self.tax.lineage(tax_id))
+
+    def test03(self):
+        tax_id, tax_name, is_primary = self.snap.primary_from_name('Gemella Berger 1960')
+        self.assertTrue(tax_id == '1378')
+        self.assertTrue(tax_name == 'Gemella')
+        self.assertFalse(is_primary)
+
+    def test04(self):
+        synonyms = sorted(tuple(row) for row in self.snap.synonyms(tax_id='1378'))
+        self.assertTrue(synonyms == sorted(tuple(row) for row in self.tax.synonyms(tax_id='1378')))
+
+    def test05(self):
+        self.assertRaises(ValueError, self.snap.add_source, 'new source')
+        self.assertRaises(ValueError, self.snap.add_nodes, [])
+        self.assertRaises(ValueError, self.snap.add_node, tax_id='1280_1', parent_id='1279',
+                          rank='species', tax_name='new staph', source_name='test')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -44,6 +44,25 @@ class TestCreateSchema(unittest.TestCase):
     def test01(self):
         con = Taxonomy.ncbi.db_connect(self.dbname, new=True)
 
+class TestReadArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.zfile = os.path.join(outputdir, 'taxdmp.zip')
+
+    def test01(self):
+        rows = Taxonomy.ncbi.read_archive(self.zfile, 'nodes.dmp')
+        row = rows.next()
+        self.assertTrue(row[0] == '1')
+        self.assertFalse(row[-1].endswith('|'))
+
+    def test02(self):
+        # a small buffer must not change the rows produced
+        rows = Taxonomy.ncbi.read_archive(self.zfile, 'merged.dmp')
+        small = Taxonomy.ncbi.read_archive(self.zfile, 'merged.dmp', bufsize=17)
+        for row, other in itertools.islice(itertools.izip(rows, small), 1000):
+            self.assertTrue(row == other)
+
 class TestLoadData(unittest.TestCase):
 
     def setUp(self):
@@ -61,5 +80,89 @@ class TestLoadData(unittest.TestCase):
         Taxonomy.ncbi.db_load(con, self.zfile, maxrows=10)
         con.close()
 
+    def test03(self):
+        con = Taxonomy.ncbi.db_connect(self.dbname, schema=Taxonomy.ncbi.db_tables, new=True)
+        Taxonomy.ncbi.db_load(con, self.zfile, maxrows=10, bulk=True)
+        cur = con.cursor()
+        indexes = cur.execute("select name from sqlite_master where type = 'index'").fetchall()
+        self.assertTrue(('names_tax_name',) in indexes)
+        mode, = cur.execute('PRAGMA journal_mode').fetchone()
+        self.assertTrue(mode.lower() != 'off')
+        con.close()
 
+    def test04(self):
+        con = Taxonomy.ncbi.db_connect(self.dbname, new=True)
+        Taxonomy.ncbi.db_load(con, self.zfile, maxrows=10, processes=3)
+        cur = con.cursor()
+        for tablename, fname in Taxonomy.ncbi.dump_files:
+            count, = cur.execute('select count(*) from %s' % tablename).fetchone()
+            self.assertTrue(count == 10)
+        con.close()
 
+    def test05(self):
+        # pragmas are restored if a bulk load fails
+        con = Taxonomy.ncbi.db_connect(self.dbname, schema=Taxonomy.ncbi.db_tables, new=True)
+        Taxonomy.ncbi.db_load(con, self.zfile, maxrows=10)
+        self.assertRaises(sqlite3.IntegrityError, Taxonomy.ncbi.db_load,
+                          con, self.zfile, maxrows=10, bulk=True)
+        cur = con.cursor()
+        mode, = cur.execute('PRAGMA journal_mode').fetchone()
+        self.assertTrue(mode.lower() != 'off')
+        synchronous, = cur.execute('PRAGMA synchronous').fetchone()
+        self.assertTrue(synchronous != 0)
+        con.close()
+
+    def test06(self):
+        # a worker that dies without reporting is an error, not a hang
+        def die(*args):
+            os._exit(1)
+
+        worker = Taxonomy.ncbi._parse_worker
+        Taxonomy.ncbi._parse_worker = die
+        try:
+            con = Taxonomy.ncbi.db_connect(self.dbname, new=True)
+            self.assertRaises(RuntimeError, Taxonomy.ncbi.db_load,
+                              con, self.zfile, maxrows=10, processes=3)
+            con.close()
+        finally:
+            Taxonomy.ncbi._parse_worker = worker
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.dbname = os.path.join(outputdir, self.funcname + '.db')
+        self.zfile = os.path.join(outputdir, 'taxdmp.zip')
+        self.con = Taxonomy.ncbi.db_connect(self.dbname, schema=Taxonomy.ncbi.db_tables, new=True)
+        Taxonomy.ncbi.db_load(self.con, self.zfile, bulk=True, ancestors=True, name_index=True)
+
+    def tearDown(self):
+        self.con.close()
+
+    def test01(self):
+        counts = Taxonomy.ncbi.db_update(self.con, self.zfile)
+        for tablename, actions in counts.items():
+            self.assertTrue(set(actions.values()) == set([0]))
+
+    def test02(self):
+        cur = self.con.cursor()
+        cur.execute("insert into source (name) values ('custom')")
+        cur.execute("insert into nodes (tax_id, parent_id, rank, source_id) values ('1280_1', '1279', 'species', 2)")
+        cur.execute("insert into names (tax_id, tax_name, is_primary) values ('1280_1', 'new staph', 1)")
+        # simulate an older release
+        cur.execute("update nodes set parent_id = '1' where tax_id = '1279'")
+        cur.execute("delete from nodes where tax_id = '1280'")
+        cur.execute("delete from names where tax_id = '1280'")
+        self.con.commit()
+
+        counts = Taxonomy.ncbi.db_update(self.con, self.zfile)
+        self.assertTrue(counts['nodes'] == dict(inserted=1, updated=1, deleted=0))
+        self.assertTrue(counts['names']['inserted'] > 0 and counts['names']['deleted'] == 0)
+
+        self.assertTrue(cur.execute("select parent_id from nodes where tax_id = '1279'").fetchone()[0] != '1')
+        self.assertTrue(cur.execute("select count(*) from nodes where tax_id = '1280_1'").fetchone()[0] == 1)
+        ancestors = set(row[0] for row in cur.execute(
+            "select ancestor_id from ancestors where tax_id = '1280'"))
+        self.assertTrue('1279' in ancestors and '1' in ancestors)
+        self.assertTrue(cur.execute(
+            "select tax_id from name_index where key = 'staphylococcus aureus'").fetchone()[0] == '1280')
@@ -6,9 +6,12 @@ import unittest
 import logging
 import itertools
 import sqlite3
+import threading
 import shutil
 import time
 import pprint
+import re
+import csv
 
 from sqlalchemy import create_engine
 
@@ -33,6 +36,12 @@ if startover or not os.path.isfile(dbname):
     Taxonomy.ncbi.db_load(con, zfile)
     con.close()
 
+int_dbname = os.path.join(outputdir, 'taxtable_test_integer.db')
+if startover or not os.path.isfile(int_dbname):
+    con = Taxonomy.ncbi.db_connect(int_dbname, schema=Taxonomy.ncbi.db_schema_integer, new=True)
+    Taxonomy.ncbi.db_load(con, zfile, ancestors=True)
+    con.close()
+
 class TestTaxonomyInit(unittest.TestCase):
 
     def setUp(self):
@@ -72,6 +81,18 @@ class TestGetLineagePrivate(unittest.TestCase):
         self.assertTrue(lineage[0][0] == 'root')
         self.assertTrue(lineage[-1][0] == 'species')
 
+    def test03(self):
+        # ancestors are cached along with the lineage
+        lineage = self.tax._get_lineage('1280')
+        parent_lineage = self.tax.cached['1279']
+        self.assertTrue(parent_lineage == lineage[:-1])
+
+        # a lineage built from the cached lineage of the parent is
+        # the same as one fetched from the database
+        for tax_id in ['1378', '1280', '131110']:
+            other = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks)
+            self.assertTrue(self.tax._get_lineage(tax_id) == other._get_lineage(tax_id))
+
 
 class TestTaxNameSearch(unittest.TestCase):
 
@@ -167,6 +188,29 @@ class TestGetLineagePublic(unittest.TestCase):
         # self.assertTrue(lineage['rank'] == 'genus')
 
 
+class TestGetLineagesPublic(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks)
+        self.other = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        tax_ids = ['1378', '1280', '1', '131110', '1280']
+        lineages = self.tax.lineages(tax_ids)
+        self.assertTrue([l['tax_id'] for l in lineages] == tax_ids)
+        self.assertTrue(lineages == [self.other.lineage(tax_id) for tax_id in tax_ids])
+
+    def test02(self):
+        self.assertRaises(KeyError, self.tax.lineages, ['1280', 'buh'])
+
+    def test03(self):
+        self.assertTrue(self.tax.lineages([]) == [])
+
 class TestGetTreeLineagePublic(unittest.TestCase):
 
     def setUp(self):
@@ -194,6 +238,23 @@ class TestGetTreeLineagePublic(unittest.TestCase):
         tree.dfs_traverse(tv)
         self.assertTrue( leafs == ['9606', '10090', '7227', '83333'] )
 
+    def test02(self):
+        tax_ids = ['9606', '7227', '83333', '10090']
+        tree = self.tax.tree_newick(tax_ids)
+        self.assertTrue(tree.endswith('1;'))
+
+        # leaves are preceded by "(" or ","
+        leafs = re.findall(r'[(,](\d+)', tree)
+        self.assertTrue( leafs == ['9606', '10090', '7227', '83333'] )
+
+    def test03(self):
+        tax_ids = ['9606', '7227', '83333', '10090']
+        tree = self.tax.tree_newick(tax_ids, collapse=True)
+
+        # no node has a single child
+        self.assertFalse(re.search(r'\(\w+\)', tree))
+        self.assertTrue(re.search(r'\(9606,10090\)\d+', tree))
+
 
 class TestTaxTable(unittest.TestCase):
 
@@ -228,8 +289,114 @@ class TestTaxTable(unittest.TestCase):
 
         with open(self.fname,'w') as fout:
             self.tax.write_table(taxa=None, csvfile=fout)
-            
 
+    def test05(self):
+        taxa = set()
+        for tax_id in ['1378','1280','131110']:
+            taxa.update(node[1] for node in self.tax._get_lineage(tax_id))
+        taxa = sorted(taxa)
+
+        with open(self.fname,'w') as fout:
+            self.tax.write_table(taxa=taxa, csvfile=fout)
+
+        # the output is the same when lineages are sorted in chunks
+        chunked = self.fname.replace('.csv', '_chunked.csv')
+        with open(chunked,'w') as fout:
+            self.tax.write_table(taxa=iter(taxa), csvfile=fout, chunksize=2)
+
+        self.assertTrue(open(self.fname).read() == open(chunked).read())
+
+
+class TestExportAll(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        self.other = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        seen = set()
+        for lineage in self.tax.iter_all_lineages():
+            # parents precede their children
+            self.assertTrue(lineage['parent_id'] in seen or lineage['tax_id'] == '1')
+            seen.add(lineage['tax_id'])
+
+            if lineage['tax_id'] in ['1', '1280', '1378', '131110']:
+                self.assertTrue(lineage == self.other.lineage(lineage['tax_id']))
+
+    def test02(self):
+        fname = os.path.join(outputdir, self.funcname)+'.csv'
+        with open(fname,'w') as fout:
+            self.tax.export_all(fout)
+
+        with open(fname) as fin:
+            rows = list(csv.DictReader(fin))
+
+        count = self.engine.execute('select count(*) from nodes').fetchone()[0]
+        self.assertTrue(len(rows) == count)
+
+class TestBoundedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks,
+                                     cache=Taxonomy.LRUCache(maxsize=3), track_requested=True)
+        self.other = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        for tax_id in ['1378','1280','131110']:
+            self.tax.lineage(tax_id)
+            self.other.lineage(tax_id)
+
+        self.assertTrue(len(self.tax.cached) <= 3)
+        self.assertTrue(self.tax.cached.evictions > 0)
+
+        # eviction does not change the output
+        fname = os.path.join(outputdir, self.funcname)
+        with open(fname + '.csv', 'w') as fout:
+            self.tax.write_table(taxa=None, csvfile=fout)
+        with open(fname + '_unbounded.csv', 'w') as fout:
+            self.other.write_table(taxa=None, csvfile=fout)
+
+        self.assertTrue(open(fname + '.csv').read() == open(fname + '_unbounded.csv').read())
+
+    def test02(self):
+        # requested tax_ids are not recorded, so taxa must be provided
+        tax = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks,
+                                cache=Taxonomy.LRUCache(maxsize=3), track_requested=False)
+        taxa = ['1378', '1280']
+        tax.lineages(taxa)
+        self.assertTrue(tax.requested is None)
+
+        fname = os.path.join(outputdir, self.funcname)
+        with open(fname + '.csv', 'w') as fout:
+            self.assertRaises(ValueError, tax.write_table, taxa=None, csvfile=fout)
+            tax.write_table(taxa=taxa, csvfile=fout)
+        with open(fname + '_tracked.csv', 'w') as fout:
+            self.other.write_table(taxa=taxa, csvfile=fout)
+
+        self.assertTrue(open(fname + '.csv').read() == open(fname + '_tracked.csv').read())
+
+    def test03(self):
+        # by default, requested tax_ids are recorded only if the
+        # cache is unbounded and the object is not threadsafe
+        bounded = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks,
+                                    cache=Taxonomy.LRUCache(maxsize=3))
+        bounded.lineage('1280')
+        self.assertTrue(bounded.requested is None)
+        self.assertTrue(self.other.requested is not None)
+
+        threadsafe = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks, threadsafe=True)
+        self.assertTrue(threadsafe.requested is None)
+        threadsafe.engine.dispose()
 
 class TestMethods(unittest.TestCase):
 
@@ -261,5 +428,424 @@ class TestMethods(unittest.TestCase):
     #                       source_name = "Fredricks Lab",
     #                       tax_name = 'BVAB1')
 
+class TestIntegerIds(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % int_dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        self.assertTrue(self.tax.integer_ids)
+
+    def test02(self):
+        lineage = self.tax.lineage('1280')
+        self.assertTrue(lineage['parent_id'] == '1279')
+        self.assertTrue(lineage['genus'] == '1279')
+        self.assertTrue(lineage['tax_name'] == 'Staphylococcus aureus')
+
+    def test03(self):
+        tax_id, tax_name, is_primary = self.tax.primary_from_name('Gemella')
+        self.assertTrue(tax_id == '1378')
+
+    def test04(self):
+        self.assertRaises(KeyError, self.tax._node, 'buh')
+
+class TestAncestors(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % int_dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks)
+        self.plain = Taxonomy.Taxonomy(create_engine('sqlite:///%s' % dbname, echo=echo),
+                                       Taxonomy.ncbi.ranks)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.plain.engine.dispose()
+
+    def test01(self):
+        self.assertTrue(self.tax.ancestors is not None)
+        self.assertTrue(self.plain.ancestors is None)
+
+    def test02(self):
+        tax_id = '1378' # Gemella; lineage has two successive no_rank taxa
+        self.assertTrue(self.tax._get_lineage(tax_id) == self.plain._get_lineage(tax_id))
+
+    def test03(self):
+        descendants = self.tax.descendants('1279') # Staphylococcus
+        self.assertTrue('1280' in descendants)
+        self.assertFalse('1279' in descendants)
+        self.assertTrue(set(descendants) == set(self.plain.descendants('1279')))
+
+    def test04(self):
+        # no_rank ancestors are cached with their own lineages
+        self.tax._get_lineage('29391') # Gemella sanguinis
+        lineage = self.tax._get_lineage('539738') # no_rank below Bacillales
+        self.assertTrue(lineage[-1] == ('below_order', '539738'))
+        self.assertTrue(lineage == self.plain._get_lineage('539738'))
+
+class TestIntervals(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.dbname = os.path.join(outputdir, self.funcname + '.db')
+        shutil.copy(dbname, self.dbname)
+        con = sqlite3.connect(self.dbname)
+        Taxonomy.ncbi.build_intervals(con)
+        con.close()
+        self.engine = create_engine('sqlite:///%s' % self.dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        self.plain = Taxonomy.Taxonomy(create_engine('sqlite:///%s' % dbname, echo=echo),
+                                       list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.plain.engine.dispose()
+
+    def test01(self):
+        self.assertTrue(self.tax.intervals is not None)
+        for rank in [None, 'species']:
+            descendants = self.tax.descendants('1279', rank) # Staphylococcus
+            self.assertTrue('1280' in descendants)
+            self.assertFalse('1279' in descendants)
+            self.assertTrue(set(descendants) == set(self.plain.descendants('1279', rank)))
+
+    def test02(self):
+        for tax in [self.tax, self.plain]:
+            self.assertTrue(tax.is_descendant('1280', '1279'))
+            self.assertTrue(tax.is_descendant('1280', '1'))
+            self.assertFalse(tax.is_descendant('1279', '1280'))
+            self.assertFalse(tax.is_descendant('1280', '1280'))
+            self.assertFalse(tax.is_descendant('1280', '1378'))
+            self.assertRaises(KeyError, tax.is_descendant, '1280', 'buh')
+
+    def test03(self):
+        self.tax.add_node(tax_id='1280_1', parent_id='1279', rank='species',
+                          tax_name='new staph', source_name='test')
+        self.assertTrue('1280_1' in self.tax.descendants('1279'))
+        self.assertTrue(self.tax.is_descendant('1280_1', '1239'))
+        self.assertTrue(set(self.tax.descendants('1')) == set(self.plain.descendants('1')) | set(['1280_1']))
+
+class TestNameCache(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.dbname = os.path.join(outputdir, self.funcname + '.db')
+        shutil.copyfile(dbname, self.dbname)
+        self.engine = create_engine('sqlite:///%s' % self.dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks)
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.dbname)
+
+    def test01(self):
+        self.assertTrue(self.tax.primary_from_id('1280') == 'Staphylococcus aureus')
+        self.assertTrue(self.tax.primary_from_id('1280') == 'Staphylococcus aureus')
+        self.assertTrue(self.tax.cached_names.hits == 1)
+
+    def test02(self):
+        result = self.tax.primary_from_name('Gemella')
+        self.assertTrue(self.tax.primary_from_name('Gemella') == result)
+        self.assertTrue(self.tax.cached_name_lookups.hits == 1)
+
+    def test03(self):
+        # misses are cached until the node is added
+        self.assertRaises(KeyError, self.tax.primary_from_id, '1280_1')
+        self.assertRaises(KeyError, self.tax.primary_from_name, 'new staph')
+        self.assertTrue(self.tax.cached_names['1280_1'] is None)
+
+        self.tax.add_node(tax_id='1280_1', parent_id='1279', rank='species',
+                          tax_name='new staph', source_name='test')
+        self.assertTrue(self.tax.primary_from_id('1280_1') == 'new staph')
+        self.assertTrue(self.tax.primary_from_name('new staph')[0] == '1280_1')
+
+    def test04(self):
+        lineages = self.tax.lineages(['1280', '1378'])
+        self.assertTrue(self.tax.cached_names['1280'] == lineages[0]['tax_name'])
+
+class TestResolveMerged(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks)
+        self.preloaded = Taxonomy.Taxonomy(self.engine, Taxonomy.ncbi.ranks,
+                                           preload_merged=True)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        merged = self.tax._merged_map()
+        old_tax_id = sorted(merged)[0]
+        for tax in [self.tax, self.preloaded]:
+            current, remapped = tax.resolve_merged([old_tax_id, '1280', 'buh'])
+            self.assertTrue(current == [merged[old_tax_id], '1280', 'buh'])
+            self.assertTrue(remapped == {old_tax_id: merged[old_tax_id]})
+
+    def test02(self):
+        old_tax_id, new_tax_id = sorted(self.tax._merged_map().items())[0]
+        self.assertTrue(self.preloaded._node(old_tax_id) == self.tax._node(new_tax_id))
+        self.assertTrue(self.preloaded.primary_from_id(old_tax_id) ==
+                        self.tax.primary_from_id(new_tax_id))
+        self.assertTrue(self.preloaded.lineages([old_tax_id]) == self.tax.lineages([old_tax_id]))
+        self.assertRaises(KeyError, self.preloaded._node, 'buh')
+
+class TestAtRank(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        tax_ids = ['1280', '1378', '1280', '1']
+        genera = self.tax.at_rank(tax_ids, 'genus')
+        self.assertTrue(genera == ['1279', '1378', '1279', None])
+        self.assertTrue(self.tax.at_rank(tax_ids, 'genus', missing='') == ['1279', '1378', '1279', ''])
+
+    def test02(self):
+        tax_ids = ['1280', '1378', '131110']
+        for rank in ['phylum', 'species', 'below_root']:
+            self.assertTrue(self.tax.at_rank(tax_ids, rank) ==
+                            [self.tax.lineage(tax_id).get(rank) for tax_id in tax_ids])
+
+    def test03(self):
+        self.assertRaises(KeyError, self.tax.at_rank, ['1280', 'buh'], 'genus')
+
+class TestLca(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        self.assertTrue(self.tax.lca(['1280']) == '1280')
+        self.assertTrue(self.tax.lca(['1280', '1279']) == '1279')
+        self.assertTrue(self.tax.lca(['1280', '1378']) == self.tax.lineage('1280')['order'])
+
+    def test02(self):
+        groups = [['1280', '1378'], ['1280'], ['9606', '1280', '1378']]
+        self.assertTrue(self.tax.lca_many(groups) == [self.tax.lca(group) for group in groups])
+
+    def test03(self):
+        self.assertRaises(ValueError, self.tax.lca, [])
+        self.assertRaises(KeyError, self.tax.lca, ['1280', 'buh'])
+
+    def test04(self):
+        # merged tax_ids are replaced whether or not their lineages are cached
+        old_tax_id, new_tax_id = sorted(self.tax._merged_map().items())[0]
+        expected = self.tax.lca([new_tax_id, '1378'])
+        self.assertTrue(self.tax.lca([old_tax_id]) == new_tax_id)
+        self.assertTrue(self.tax.lca([old_tax_id, '1378']) == expected)
+
+        self.tax.lineage(old_tax_id)
+        self.assertTrue(self.tax.lca([old_tax_id]) == new_tax_id)
+        self.assertTrue(self.tax.lca([old_tax_id, '1378']) == expected)
+        self.assertTrue(self.tax.lineages([old_tax_id])[0]['tax_name'] ==
+                        self.tax.primary_from_id(new_tax_id))
+
+class TestNameIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.dbname = os.path.join(outputdir, self.funcname + '.db')
+        shutil.copy(dbname, self.dbname)
+        con = sqlite3.connect(self.dbname)
+        Taxonomy.ncbi.build_name_index(con)
+        con.close()
+        self.engine = create_engine('sqlite:///%s' % self.dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        names = self.tax.search_names('staphylococcus  AUR')
+        self.assertTrue(('1280', 'Staphylococcus aureus', True) in names)
+        self.assertTrue(len(self.tax.search_names('staphylococcus', limit=2)) == 2)
+
+    def test02(self):
+        matches = self.tax.resolve_names(['Staphylococcus aureus', 'staphylococcus  AUREUS',
+                                          'Staphylococus aureus', 'buh'])
+        self.assertTrue(matches[0] == ('1280', 'Staphylococcus aureus', True, 1.0))
+        self.assertTrue(matches[1] == matches[0])
+        tax_id, tax_name, is_primary, score = matches[2]
+        self.assertTrue(tax_id == '1280' and 0.9 < score < 1)
+        self.assertTrue(matches[3] is None)
+        self.assertTrue(self.tax.resolve_names(['Staphylococus aureus'], max_distance=0) == [None])
+
+    def test03(self):
+        plain = Taxonomy.Taxonomy(create_engine('sqlite:///%s' % dbname, echo=echo),
+                                  list(Taxonomy.ncbi.ranks))
+        self.assertTrue(plain.resolve_names(['Staphylococcus aureus', 'buh']) ==
+                        [('1280', 'Staphylococcus aureus', True, 1.0), None])
+        self.assertRaises(ValueError, plain.search_names, 'staph')
+        plain.engine.dispose()
+
+    def test04(self):
+        self.tax.add_node(tax_id='1280_1', parent_id='1279', rank='species',
+                          tax_name='new staph', source_name='test')
+        self.assertTrue(self.tax.resolve_names(['New Staph'])[0][0] == '1280_1')
+
+    def test05(self):
+        # by default, names that do not match exactly are errors
+        tax_ids = Taxonomy.utils.tax_ids_from_names(self.tax, ['staphylococcus  AUREUS', 'Gemella'])
+        self.assertTrue(tax_ids == ['1280', '1378'])
+        self.assertRaises(KeyError, Taxonomy.utils.tax_ids_from_names,
+                          self.tax, ['Staphylococcus aureus', 'Staphylococus aureus'])
+
+    def test06(self):
+        # approximate matches are accepted only above min_score
+        names = ['Staphylococcus aureus', 'Staphylococus aureus']
+        tax_ids = Taxonomy.utils.tax_ids_from_names(self.tax, names, min_score=0.9)
+        self.assertTrue(tax_ids == ['1280', '1280'])
+        self.assertRaises(KeyError, Taxonomy.utils.tax_ids_from_names,
+                          self.tax, ['Gemela'], min_score=0.9)
+        self.assertRaises(KeyError, Taxonomy.utils.tax_ids_from_names,
+                          self.tax, ['buh'], min_score=0.1)
+
+    def test07(self):
+        # more names than fit in one query; crowded ranges are truncated
+        keys = [u'staphylococus aureus', u'gemela'] * 30 + [u'staphylococcus aureu%s' % i
+                                                             for i in range(50)]
+        candidates = self.tax._name_candidates(keys, 2, limit=3)
+        self.assertTrue(set(candidates) == set(keys))
+        self.assertTrue(all(len(found) <= 6 for found in candidates.values()))
+
+        matches = self.tax.resolve_names(['Staphylococus aureus', 'Gemela'] * 30)
+        self.assertTrue(matches[0][0] == '1280' and matches[1][0] == '1378')
+        self.assertTrue(matches == matches[:2] * 30)
+
+class TestAddNodes(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.dbname = os.path.join(outputdir, self.funcname + '.db')
+        shutil.copy(dbname, self.dbname)
+        con = sqlite3.connect(self.dbname)
+        Taxonomy.ncbi.build_ancestors(con)
+        Taxonomy.ncbi.build_intervals(con)
+        con.close()
+        self.engine = create_engine('sqlite:///%s' % self.dbname, echo=echo)
+        self.tax = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+        # children are listed before their parents
+        self.rows = [dict(tax_id='1280_2', parent_id='1280_1', rank='subspecies', tax_name='newer staph'),
+                     dict(tax_id='1280_1', parent_id='1279', rank='species', tax_name='new staph'),
+                     dict(tax_id='1378_1', parent_id='1378', rank='species', tax_name='new gemella',
+                          source_name='other')]
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test01(self):
+        tax_ids = self.tax.add_nodes(self.rows, source_name='test')
+        self.assertTrue(tax_ids.index('1280_1') < tax_ids.index('1280_2'))
+        lineage = self.tax.lineage('1280_2')
+        self.assertTrue(lineage['species'] == '1280_1' and lineage['genus'] == '1279')
+        self.assertTrue(self.tax.is_descendant('1280_2', '1279'))
+        self.assertTrue(set(['1280_1', '1280_2']) <= set(self.tax.descendants('1279')))
+        self.assertTrue(self.tax.primary_from_id('1378_1') == 'new gemella')
+
+    def test02(self):
+        lineages = self.tax.add_nodes(self.rows, source_name='test', lineages=True)
+        self.assertTrue(set(lineage['tax_id'] for lineage in lineages) == set(['1280_1', '1280_2', '1378_1']))
+
+    def test03(self):
+        # nothing is added if any row fails
+        rows = self.rows + [dict(tax_id='1280_3', parent_id='buh', rank='species', tax_name='lost')]
+        self.assertRaises(KeyError, self.tax.add_nodes, rows, source_name='test')
+        self.assertRaises(ValueError, self.tax.add_nodes, self.rows)
+        self.assertRaises(KeyError, self.tax.lineage, '1280_1')
+
+    def test04(self):
+        self.tax.add_nodes(self.rows[1:], source_name='test')
+        tax_ids = self.tax.add_nodes(self.rows, source_name='test', skip_existing=True)
+        self.assertTrue(tax_ids == ['1280_2'])
+
+    def test05(self):
+        # as in taxtable.py -a: nodes read from a file are written to
+        # the table of requested taxa
+        fname = os.path.join(outputdir, self.funcname + '_nodes.csv')
+        with open(fname, 'w') as fout:
+            writer = csv.DictWriter(fout, ['tax_id', 'parent_id', 'rank', 'tax_name', 'source_name'])
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+        rows = Taxonomy.utils.get_new_nodes(fname)
+        self.assertRaises(ValueError, self.tax.add_nodes, rows, skip_existing=True)
+        self.tax.add_nodes(rows, source_name='test', skip_existing=True, lineages=True)
+
+        # the source in the file is kept; the default fills in the rest
+        sources = dict(self.engine.execute(
+                'select tax_id, name from nodes join source on nodes.source_id = source.id '
+                'where tax_id in (?, ?, ?)', '1280_1', '1280_2', '1378_1').fetchall())
+        self.assertTrue(sources == {'1280_1': 'test', '1280_2': 'test', '1378_1': 'other'})
+
+        outfile = os.path.join(outputdir, self.funcname + '.csv')
+        with open(outfile, 'w') as fout:
+            self.tax.write_table(None, csvfile=fout)
+        with open(outfile) as fin:
+            written = set(row['tax_id'] for row in csv.DictReader(fin))
+        self.assertTrue(set(['1280_1', '1280_2', '1378_1', '1279']) <= written)
+
+class TestThreadsafe(unittest.TestCase):
+
+    def setUp(self):
+        self.funcname = '_'.join(self.id().split('.')[-2:])
+        self.engine = create_engine('sqlite:///%s' % dbname, echo=echo)
+        self.ranks = list(Taxonomy.ncbi.ranks)
+        self.tax = Taxonomy.Taxonomy(self.engine, self.ranks, threadsafe=True)
+        self.plain = Taxonomy.Taxonomy(self.engine, list(Taxonomy.ncbi.ranks))
+
+    def tearDown(self):
+        self.tax.engine.dispose()
+        self.engine.dispose()
+
+    def test01(self):
+        tax_ids = ['1280', '1378', '131110', '9606', '7227', '83333', '10090']
+        results, errors = {}, []
+
+        def lookup(tax_id):
+            try:
+                results[tax_id] = (self.tax.lineage(tax_id), self.tax.primary_from_id(tax_id))
+            except Exception, err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=lookup, args=(tax_id,)) for tax_id in tax_ids * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse(errors)
+        for tax_id in tax_ids:
+            self.assertTrue(results[tax_id] == (self.plain.lineage(tax_id),
+                                                self.plain.primary_from_id(tax_id)))
+        # ranks added while renaming undefined ranks do not modify
+        # the list provided
+        self.assertTrue(self.ranks == Taxonomy.ncbi.ranks)
+        self.assertTrue('below_root' in self.tax.ranks)
+
+    def test02(self):
+        self.assertRaises(ValueError, self.tax.add_node, tax_id='1280_1', parent_id='1279',
+                          rank='species', tax_name='new staph', source_name='test')
+        self.assertRaises(ValueError, self.tax.add_source, 'test')
+        self.assertRaises(ValueError, self.tax.add_nodes, [])
+        self.assertRaises(Exception, self.tax.engine.execute, "delete from nodes where tax_id = '1280'")
+        self.assertTrue(self.plain.primary_from_id('1280') == 'Staphylococcus aureus')
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -79,4 +79,26 @@ class TestWriteConfig(unittest.TestCase):
             optdict = options,
             sections = dict(sec1=['opt1','opt2'], sec2=['opt3','opt4'])
             )
-    
+
+class TestNormalizeName(unittest.TestCase):
+
+    def test01(self):
+        normalize_name = Taxonomy.utils.normalize_name
+        self.assertTrue(normalize_name('  Staphylococcus   AUREUS ') == u'staphylococcus aureus')
+        self.assertTrue(normalize_name("'Bacillus'_sp.") == u'bacillus sp.')
+        self.assertTrue(normalize_name('[Clostridium] difficile') == u'clostridium difficile')
+
+class TestEditDistance(unittest.TestCase):
+
+    def test01(self):
+        edit_distance = Taxonomy.utils.edit_distance
+        self.assertTrue(edit_distance('aureus', 'aureus') == 0)
+        self.assertTrue(edit_distance('kitten', 'sitting') == 3)
+        self.assertTrue(edit_distance('', 'abc') == 3)
+        self.assertTrue(edit_distance('staphylococus', 'staphylococcus') == 1)
+
+    def test02(self):
+        edit_distance = Taxonomy.utils.edit_distance
+        # distances larger than maxdist are only known to exceed it
+        self.assertTrue(edit_distance('kitten', 'sitting', 2) > 2)
+        self.assertTrue(edit_distance('kitten', 'sitting', 3) == 3)
@@ -1,5 +1,7 @@
+import csv
 import datetime
 import logging
+import re
 
 log = logging
 
@@ -70,11 +72,118 @@ def get_new_nodes(fname):
                   'parent_id':'%i'
                   })
     elif fname.endswith('.csv'):
-        reader = csv.DictReader(fname)
-        rows = (d for d in reader if d['tax_id'])
+        with open(fname) as f:
+            rows = [d for d in csv.DictReader(f) if d['tax_id']]
     else:
         raise ValueError('Error: %s must be in .csv or .xls format')
 
     return rows
 
-
+_name_separators = re.compile(r'[\s_]+')
+_name_quotes = re.compile(r"[\"'\[\]]")
+
+def normalize_name(tax_name):
+    """
+    Returns a key for matching taxonomic names that ignores case,
+    quotes, square brackets, underscores and differences in
+    whitespace. Keys are unicode strings.
+    """
+
+    if not isinstance(tax_name, unicode):
+        tax_name = tax_name.decode('utf-8')
+    tax_name = _name_quotes.sub('', tax_name.lower())
+    return _name_separators.sub(' ', tax_name).strip()
+
+def edit_distance(a, b, maxdist=None):
+    """
+    Returns the Levenshtein distance between strings a and b (the
+    number of single-character insertions, deletions or
+    substitutions transforming one into the other). If maxdist is
+    provided, returns maxdist + 1 as soon as the distance is known
+    to exceed maxdist; only the cells of the table of distances
+    between prefixes within maxdist of the diagonal are computed.
+    """
+
+    if len(a) < len(b):
+        a, b = b, a
+
+    if maxdist is None:
+        maxdist = len(a)
+    elif len(a) - len(b) > maxdist:
+        return maxdist + 1
+
+    big = maxdist + 1
+
+    # common prefixes and suffixes do not change the distance
+    start, end = 0, 0
+    while start < len(b) and a[start] == b[start]:
+        start += 1
+    while end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start:len(a) - end], b[start:len(b) - end]
+
+    # each character found in only one of the strings requires an edit
+    sa, sb = set(a), set(b)
+    if len(sa - sb) > maxdist or len(sb - sa) > maxdist:
+        return big
+
+    # distances between a prefix of a and each prefix of b
+    previous = [min(j, big) for j in xrange(len(b) + 1)]
+    for i, ca in enumerate(a, 1):
+        current = [big] * (len(b) + 1)
+        current[0] = lowest = min(i, big)
+        for j in xrange(max(1, i - maxdist), min(len(b), i + maxdist) + 1):
+            d = previous[j - 1] + (ca != b[j - 1])
+            if previous[j] < d:
+                d = previous[j] + 1
+            if current[j - 1] < d:
+                d = current[j - 1] + 1
+            if d > big:
+                d = big
+            current[j] = d
+            if d < lowest:
+                lowest = d
+        if lowest > maxdist:
+            return big
+        previous = current
+
+    return previous[-1]
+
+def tax_ids_from_names(tax, tax_names, min_score=None):
+    """
+    Returns a list of the tax_ids of the taxa named in tax_names
+    using tax.resolve_names (see Taxonomy.resolve_names). Names
+    matching a synonym are logged with the primary name.
+
+    * tax - a Taxonomy instance
+    * tax_names - a sequence of names
+    * min_score - if None, only exact matches are accepted (ignoring
+      case and whitespace if table "name_index" is present);
+      otherwise, approximate matches with at least this score are
+      also accepted and are logged.
+
+    Raises KeyError if any name is not matched.
+    """
+
+    tax_names = list(tax_names)
+    max_distance = 0 if min_score is None else 2
+
+    tax_ids, unmatched = [], []
+    for tax_name, match in zip(tax_names, tax.resolve_names(tax_names, max_distance)):
+        if match is None or (min_score is not None and match[3] < min_score):
+            log.error('no match for "%s"' % tax_name)
+            unmatched.append(tax_name)
+            continue
+
+        tax_id, primary_name, is_primary, score = match
+        tax_ids.append(tax_id)
+        if score < 1:
+            log.warning('%(tax_id)8s  %(tax_name)40s -(approximate match, score %(score).2f)-> %(primary_name)s' % locals())
+        elif not is_primary:
+            log.warning('%(tax_id)8s  %(tax_name)40s -(primary name)-> %(primary_name)s' % locals())
+
+    if unmatched:
+        raise KeyError('no match for %s of %s names, including "%s"' % (
+                len(unmatched), len(tax_names), unmatched[0]))
+
+    return tax_ids